@@ -0,0 +1,112 @@
+"""
+Times every attention backend that supports each attention call of the Wan transformer, on random inputs of the
+shapes of a generation, and reports the backend that `attention` selects for it and the largest difference of each
+backend to the float32 `chunked` one.
+
+The shapes are those of the self-attention, the cross-attention on padded prompts, and the block-wise causal
+self-attention of diffusion forcing. `--downscale` divides the height and width of the latents, to run it on the CPU:
+
+    python benchmarks/benchmark_attention.py --device cpu --downscale 8 --num_frames 17
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODEL_HEADS = {"1.3B": 12, "14B": 40}
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_backend(backend, inputs, kwargs, repeats):
+    output = backend.fn(*inputs, **kwargs)
+    synchronize(inputs[0].device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        backend.fn(*inputs, **kwargs)
+    synchronize(inputs[0].device)
+    return (time.perf_counter() - start) / max(repeats, 1), output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="1.3B", choices=list(MODEL_HEADS))
+    parser.add_argument("--resolution", type=str, default="540P", choices=["540P", "720P"])
+    parser.add_argument("--num_frames", type=int, default=97)
+    parser.add_argument("--downscale", type=int, default=1, help="Divide the latent height and width by this.")
+    parser.add_argument("--causal_block_size", type=int, default=5)
+    parser.add_argument("--batch_size", type=int, default=1, help="2 for batched classifier free guidance.")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    from skyreels_v2_infer.modules.attention import ATTENTION_BACKENDS
+    from skyreels_v2_infer.modules.attention import select_attention_backend
+    from skyreels_v2_infer.modules.transformer import WanModel
+
+    device = torch.device(args.device)
+    dtype = torch.bfloat16
+    height, width = (544, 960) if args.resolution == "540P" else (720, 1280)
+    # latent frames, and tokens after the 2x2 patch embedding
+    frames = (args.num_frames - 1) // 4 + 1
+    h, w = height // 16 // args.downscale, width // 16 // args.downscale
+    b, n, d, seq_len = args.batch_size, MODEL_HEADS[args.model], 128, frames * h * w
+
+    def randn(length):
+        return torch.randn(b, length, n, d, dtype=dtype, device=device)
+
+    cases = [
+        ("self_attn", (randn(seq_len), randn(seq_len), randn(seq_len)), {}),
+        (
+            "cross_attn",
+            (randn(seq_len), randn(512), randn(512)),
+            {"k_lens": torch.tensor([120, 40][:b] + [120] * (b - 2), dtype=torch.int32, device=device)},
+        ),
+        (
+            "causal_block_mask",
+            (randn(seq_len), randn(seq_len), randn(seq_len)),
+            {
+                "block_mask": WanModel._prepare_blockwise_causal_attn_mask(
+                    device, num_frames=frames, frame_seqlen=h * w, num_frame_per_block=args.causal_block_size
+                )
+            },
+        ),
+    ]
+
+    print(f"{b} x {seq_len} tokens, {n} heads of {d} on {device}")
+    print(f"{'call':<18} {'backend':<9} {'selected':>8} {'ms':>10} {'max diff':>9}")
+    for name, inputs, call_kwargs in cases:
+        kwargs = dict(
+            q_lens=None,
+            k_lens=None,
+            dropout_p=0.0,
+            softmax_scale=None,
+            q_scale=None,
+            causal=False,
+            window_size=(-1, -1),
+            deterministic=False,
+            dtype=dtype,
+            block_mask=None,
+        )
+        kwargs.update(call_kwargs)
+        features = dict(varlen=kwargs["k_lens"] is not None, block_mask=kwargs["block_mask"] is not None)
+        selected = select_attention_backend(inputs[0], **features)
+        _, reference = time_backend(ATTENTION_BACKENDS["chunked"], inputs, kwargs, 0)
+        for backend in ATTENTION_BACKENDS.values():
+            if not backend.supports(inputs[0], **features):
+                continue
+            seconds, output = time_backend(backend, inputs, kwargs, args.repeats)
+            diff = (output.float() - reference.float()).abs().max().item()
+            marker = "*" if backend is selected else ""
+            print(f"{name:<18} {backend.name:<9} {marker:>8} {seconds * 1000:>10.2f} {diff:>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Measures the throughput of batched generation, one pipeline call for several prompts and seeds, against generating
+the same videos one call at a time, for several batch sizes.
+
+Both sides run the same prompts and seeds, so the script also reports how far the batched videos are from the
+videos generated alone, which only differ by the numerics of the batched kernels.
+
+    python benchmarks/benchmark_batch.py --model_id Skywork/SkyReels-V2-DF-1.3B-540P --batch_sizes 1 2 4
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROMPTS = [
+    "A serene lake surrounded by towering mountains, with a few swans gracefully gliding across the water and "
+    "sunlight dancing on the surface.",
+    "A woman in a red coat walks through a crowded night market, the camera following her past glowing food stalls.",
+    "A close-up of a hummingbird hovering next to a bright orange flower, its wings a blur.",
+    "An aerial shot of waves crashing against black volcanic rocks at sunrise.",
+]
+
+
+def generate(pipe, kwargs, prompts, seeds):
+    generators = [torch.Generator(device="cuda").manual_seed(seed) for seed in seeds]
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.amp.autocast("cuda", dtype=pipe.transformer.dtype), torch.no_grad():
+        videos = pipe(prompt=prompts, generator=generators, **kwargs)
+    torch.cuda.synchronize()
+    return videos, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_id", type=str, default="Skywork/SkyReels-V2-DF-1.3B-540P")
+    parser.add_argument("--resolution", type=str, default="540P", choices=["540P", "720P"])
+    parser.add_argument("--image", type=str, default=None, help="Input image of the I2V models.")
+    parser.add_argument("--num_frames", type=int, default=97)
+    parser.add_argument("--inference_steps", type=int, default=30)
+    parser.add_argument("--guidance_scale", type=float, default=6.0)
+    parser.add_argument("--shift", type=float, default=8.0)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batched_cfg", action="store_true")
+    parser.add_argument("--variable_text_len", action="store_true")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    from diffusers.utils import load_image
+
+    from skyreels_v2_infer.modules import download_model
+    from skyreels_v2_infer.pipelines import DiffusionForcingPipeline
+    from skyreels_v2_infer.pipelines import Image2VideoPipeline
+    from skyreels_v2_infer.pipelines import resizecrop
+    from skyreels_v2_infer.pipelines import Text2VideoPipeline
+    from skyreels_v2_infer.server.inference_server import DF_NEGATIVE_PROMPT
+    from skyreels_v2_infer.server.inference_server import T2V_NEGATIVE_PROMPT
+
+    model_path = download_model(args.model_id)
+    task = "df" if "DF" in args.model_id else "i2v" if "I2V" in args.model_id else "t2v"
+    height, width = (544, 960) if args.resolution == "540P" else (720, 1280)
+    pipeline_kwargs = dict(model_path=model_path, dit_path=model_path)
+    kwargs = dict(
+        negative_prompt=DF_NEGATIVE_PROMPT if task == "df" else T2V_NEGATIVE_PROMPT,
+        num_frames=args.num_frames,
+        num_inference_steps=args.inference_steps,
+        guidance_scale=args.guidance_scale,
+        shift=args.shift,
+        batched_cfg=args.batched_cfg,
+        variable_text_len=args.variable_text_len,
+    )
+    if task == "df":
+        pipe = DiffusionForcingPipeline(device=torch.device("cuda"), **pipeline_kwargs)
+        kwargs.update(base_num_frames=args.num_frames)
+    elif task == "i2v":
+        assert args.image is not None, "The I2V models need `--image`."
+        pipe = Image2VideoPipeline(**pipeline_kwargs)
+        image = load_image(args.image)
+        if image.height > image.width:
+            height, width = width, height
+        kwargs.update(image=resizecrop(image, height, width).convert("RGB"))
+    else:
+        pipe = Text2VideoPipeline(**pipeline_kwargs)
+    kwargs.update(height=height, width=width)
+
+    # compiles the kernels and fills the caches outside of the measurements
+    generate(pipe, kwargs, PROMPTS[:1], [args.seed])
+
+    print(f"{'batch':>5} {'looped s':>9} {'batched s':>10} {'videos/s':>9} {'speedup':>8} {'max abs diff':>13}")
+    for batch_size in args.batch_sizes:
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(batch_size)]
+        seeds = [args.seed + i for i in range(batch_size)]
+        looped_videos, looped_seconds = [], 0.0
+        for prompt, seed in zip(prompts, seeds):
+            videos, seconds = generate(pipe, kwargs, [prompt], [seed])
+            looped_videos.extend(videos)
+            looped_seconds += seconds
+        batched_videos, batched_seconds = generate(pipe, kwargs, prompts, seeds)
+        difference = max(
+            np.abs(a.astype(np.int16) - b.astype(np.int16)).max() for a, b in zip(looped_videos, batched_videos)
+        )
+        print(
+            f"{batch_size:>5} {looped_seconds:>9.1f} {batched_seconds:>10.1f} {batch_size / batched_seconds:>9.3f} "
+            f"{looped_seconds / batched_seconds:>8.2f} {difference:>13}"
+        )
+
+
+if __name__ == "__main__":
+    main()
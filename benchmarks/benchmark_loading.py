@@ -0,0 +1,134 @@
+"""
+Measures the cold-start time and the peak memory of loading each model component, comparing the previous loading
+(model initialized on the target device, whole checkpoints read into host memory, then copied) with the meta-device,
+memory-mapped loader of `skyreels_v2_infer.modules`.
+
+Every measurement runs in a fresh process, so that the peak host RSS is its own. The page cache is not dropped
+between runs, run the script twice or drop it yourself (`echo 3 > /proc/sys/vm/drop_caches`) for cold-disk numbers.
+
+    python benchmarks/benchmark_loading.py --model_id Skywork/SkyReels-V2-DF-1.3B-540P --num_threads 1 4
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+COMPONENTS = ["transformer", "t5", "clip", "vae"]
+
+
+def load_legacy(component, model_path, device):
+    from safetensors.torch import load_file
+
+    from skyreels_v2_infer.modules import CLIPModel
+    from skyreels_v2_infer.modules import T5EncoderModel
+    from skyreels_v2_infer.modules import WanModel
+    from skyreels_v2_infer.modules.vae import WanVAE_
+
+    if component == "transformer":
+        model = WanModel.from_config(os.path.join(model_path, "config.json")).to(torch.bfloat16).to(device)
+        for file in os.listdir(model_path):
+            if file.endswith(".safetensors"):
+                state_dict = load_file(os.path.join(model_path, file))
+                model.load_state_dict(state_dict, strict=False)
+                del state_dict
+                gc.collect()
+    elif component == "t5":
+        model = T5EncoderModel(
+            checkpoint_path=os.path.join(model_path, "models_t5_umt5-xxl-enc-bf16.pth"),
+            tokenizer_path=os.path.join(model_path, "google", "umt5-xxl"),
+        )
+        model = model.to(device).to(torch.bfloat16)
+    elif component == "clip":
+        model = CLIPModel(
+            os.path.join(model_path, "models_clip_open-clip-xlm-roberta-large-vit-huge-14.pth"),
+            os.path.join(model_path, "xlm-roberta-large"),
+        )
+        model = model.to(torch.bfloat16).to(device)
+    else:
+        # the VAE was already built on the meta device, but its checkpoint was read whole
+        from skyreels_v2_infer.modules import WanVAE
+
+        model = WanVAE(os.path.join(model_path, "Wan2.1_VAE.pth")).to(device)
+    return model
+
+
+def load_meta(component, model_path, device, num_threads):
+    from skyreels_v2_infer.modules import get_image_encoder
+    from skyreels_v2_infer.modules import get_text_encoder
+    from skyreels_v2_infer.modules import get_transformer
+    from skyreels_v2_infer.modules import get_vae
+
+    if component == "transformer":
+        return get_transformer(model_path, device, torch.bfloat16, num_threads=num_threads)
+    elif component == "t5":
+        return get_text_encoder(model_path, device, torch.bfloat16)
+    elif component == "clip":
+        return get_image_encoder(model_path, device, torch.bfloat16)
+    return get_vae(os.path.join(model_path, "Wan2.1_VAE.pth"), device)
+
+
+def run_worker(args):
+    start = time.perf_counter()
+    if args.method == "legacy":
+        model = load_legacy(args.worker, args.model_path, args.device)
+    else:
+        model = load_meta(args.worker, args.model_path, args.device, args.threads)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    del model
+    result = {
+        "seconds": seconds,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_host_gb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2,
+        "peak_gpu_gb": torch.cuda.max_memory_allocated() / 1024**3 if torch.cuda.is_available() else 0.0,
+    }
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_id", type=str, default="Skywork/SkyReels-V2-DF-1.3B-540P")
+    parser.add_argument("--components", type=str, nargs="+", default=COMPONENTS, choices=COMPONENTS)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--num_threads", type=int, nargs="+", default=[1], help="Shard reading threads to compare.")
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--method", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--model_path", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--threads", type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        return run_worker(args)
+
+    from skyreels_v2_infer.modules import download_model
+
+    model_path = download_model(args.model_id)
+    print(f"{'component':<12} {'loader':<16} {'seconds':>8} {'peak host GB':>13} {'peak GPU GB':>12}")
+    for component in args.components:
+        runs = [("legacy", 1)] + [("meta", threads) for threads in args.num_threads]
+        if component != "transformer":
+            # only the transformer is sharded
+            runs = runs[:2]
+        for method, threads in runs:
+            cmd = [sys.executable, os.path.abspath(__file__), "--worker", component, "--method", method]
+            cmd += ["--model_path", model_path, "--device", args.device, "--threads", str(threads)]
+            output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            name = method if method == "legacy" else f"meta, {threads} thread{'s' if threads > 1 else ''}"
+            print(
+                f"{component:<12} {name:<16} {result['seconds']:>8.2f} {result['peak_host_gb']:>13.2f}"
+                f" {result['peak_gpu_gb']:>12.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
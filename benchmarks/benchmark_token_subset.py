@@ -0,0 +1,91 @@
+"""
+Measures the time the transformer of diffusion forcing spends per generation with the token subset, which runs the
+output head and the last blocks only on the frames that a step updates, against the full forward, for several
+`ar_step` settings.
+
+The steps follow the schedule of `DiffusionForcingPipeline` for one chunk of `base_num_frames` frames, on random
+latents, and `--max_rows` of them, evenly spread, are timed. The totals are extrapolated to the whole schedule.
+
+    python benchmarks/benchmark_token_subset.py --ar_steps 0 5 --subset_blocks 0 1 2
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def time_forward(transformer, x, t, context, output_frames, repeats):
+    kwargs = {} if output_frames is None else {"output_frames": output_frames}
+    transformer(x, t=t, context=context, **kwargs)
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        transformer(x, t=t, context=context, **kwargs)
+    torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_id", type=str, default="Skywork/SkyReels-V2-DF-1.3B-540P")
+    parser.add_argument("--resolution", type=str, default="540P", choices=["540P", "720P"])
+    parser.add_argument("--base_num_frames", type=int, default=97)
+    parser.add_argument("--inference_steps", type=int, default=30)
+    parser.add_argument("--ar_steps", type=int, nargs="+", default=[0, 5])
+    parser.add_argument("--causal_block_size", type=int, default=5)
+    parser.add_argument("--subset_blocks", type=int, nargs="+", default=[0, 1], help="Token subset blocks to compare.")
+    parser.add_argument("--max_rows", type=int, default=12, help="Steps of each schedule that are timed.")
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    from skyreels_v2_infer.modules import download_model
+    from skyreels_v2_infer.modules import get_transformer
+    from skyreels_v2_infer.pipelines import DiffusionForcingPipeline
+
+    transformer = get_transformer(download_model(args.model_id), "cuda", torch.bfloat16)
+    height, width = (544, 960) if args.resolution == "540P" else (720, 1280)
+    num_frames = (args.base_num_frames - 1) // 4 + 1
+    context = torch.zeros(1, 512, 4096, dtype=torch.bfloat16, device="cuda")
+
+    print(f"{'ar_step':>7} {'steps':>6} {'updated':>8} {'mode':<16} {'seconds':>9} {'saving':>7}")
+    for ar_step in args.ar_steps:
+        # synchronous generation runs all frames as one block
+        causal_block_size = args.causal_block_size if ar_step > 0 else 1
+        num_iterations = args.inference_steps + 1
+        step_index, step_update_mask, valid_interval = DiffusionForcingPipeline._build_timestep_index_matrix(
+            num_frames // causal_block_size,
+            num_iterations,
+            num_frames // causal_block_size,
+            ar_step,
+            0,
+            causal_block_size,
+            False,
+        )
+        rows = torch.linspace(0, len(step_index) - 1, min(args.max_rows, len(step_index))).long().unique().tolist()
+        updated = sum(step_update_mask[row, slice(*valid_interval[row])].float().mean().item() for row in rows)
+        updated /= len(rows)
+
+        totals = {}
+        for row in rows:
+            start, end = valid_interval[row]
+            timestep = (1000 * (1 - step_index[row, start:end] / num_iterations)).float().cuda()[None]
+            x = torch.randn(1, 16, end - start, height // 8, width // 8, dtype=torch.bfloat16, device="cuda")
+            update_mask = step_update_mask[row, start:end]
+            modes = [("full", None, 0)] + [(f"subset, {n} blocks", update_mask, n) for n in args.subset_blocks]
+            for name, output_frames, num_blocks in modes:
+                transformer.set_token_subset(output_frames is not None, num_blocks)
+                with torch.amp.autocast("cuda", dtype=torch.bfloat16), torch.no_grad():
+                    seconds = time_forward(transformer, x, timestep, context, output_frames, args.repeats)
+                totals[name] = totals.get(name, 0.0) + seconds * len(step_index) / len(rows)
+
+        for name, seconds in totals.items():
+            saving = 1 - seconds / totals["full"]
+            print(f"{ar_step:>7} {len(step_index):>6} {updated:>8.0%} {name:<16} {seconds:>9.1f} {saving:>7.1%}")
+
+
+if __name__ == "__main__":
+    main()
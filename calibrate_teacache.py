@@ -0,0 +1,248 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from diffusers.utils import load_image
+
+from skyreels_v2_infer.modules import download_model
+from skyreels_v2_infer.modules.transformer import TEACACHE_COEFFICIENTS_FILE
+from skyreels_v2_infer.pipelines import DiffusionForcingPipeline
+from skyreels_v2_infer.pipelines import Image2VideoPipeline
+from skyreels_v2_infer.pipelines import resizecrop
+from skyreels_v2_infer.pipelines import Text2VideoPipeline
+from skyreels_v2_infer.server.inference_server import DF_NEGATIVE_PROMPT
+from skyreels_v2_infer.server.inference_server import T2V_NEGATIVE_PROMPT
+
+DEFAULT_PROMPTS = [
+    "A serene lake surrounded by towering mountains, with a few swans gracefully gliding across the water and "
+    "sunlight dancing on the surface.",
+    "A woman in a red coat walks through a crowded night market, the camera following her past glowing food stalls.",
+]
+
+
+def relative_l1(current, previous):
+    return ((current.float() - previous.float()).abs().mean() / previous.float().abs().mean()).item()
+
+
+class TeaCacheRecorder:
+    """
+    Records, for every transformer call, the relative L1 change of the time embeddings `e`, of the modulation `e0`
+    and of the residual that the blocks add to their input, against the previous call of the same stream. The
+    conditional and unconditional calls alternate, like TeaCache expects them.
+
+    Args:
+        transformer (WanModel): Transformer whose calls are recorded
+        num_streams (int): Number of interleaved call streams
+    """
+
+    def __init__(self, transformer, num_streams=2):
+        self.num_streams = num_streams
+        self.previous = [None] * num_streams
+        # (call index, change of e, change of e0, change of the residual)
+        self.records = []
+        self.num_calls = 0
+        self.num_block_calls = 0
+        self._input = self._e0 = self._residual = None
+        self.handles = [
+            transformer.blocks[0].register_forward_pre_hook(self._before_blocks, with_kwargs=True),
+            transformer.blocks[-1].register_forward_hook(self._after_blocks),
+            transformer.head.register_forward_pre_hook(self._before_head),
+        ]
+
+    def _before_blocks(self, module, args, kwargs):
+        self._input, self._e0 = args[0], kwargs["e"]
+        self.num_block_calls += 1
+
+    def _after_blocks(self, module, args, output):
+        self._residual = output - self._input
+
+    def _before_head(self, module, args):
+        stream = self.num_calls % self.num_streams
+        current = None if self._residual is None else (args[1], self._e0, self._residual)
+        previous = self.previous[stream]
+        if current is not None and previous is not None and all(c.shape == p.shape for c, p in zip(current, previous)):
+            self.records.append((self.num_calls, *(relative_l1(c, p) for c, p in zip(current, previous))))
+        self.previous[stream] = current
+        self.num_calls += 1
+        self._input = self._e0 = self._residual = None
+
+    def reset(self):
+        self.previous = [None] * self.num_streams
+        self.records = []
+        self.num_calls = self.num_block_calls = 0
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+def fit_coefficients(records, num_calls, use_ret_steps, degree):
+    """
+    Fits the polynomial that maps the change of the modulated input to the change of the residual, on the calls
+    where TeaCache may skip, see `TeaCache`.
+    """
+    ret_steps, cutoff_steps = (5 * 2, num_calls) if use_ret_steps else (1 * 2, num_calls - 2)
+    rows = np.array([record for record in records if ret_steps <= record[0] < cutoff_steps])
+    inputs, residuals = rows[:, 2 if use_ret_steps else 1], rows[:, 3]
+    coefficients = np.polyfit(inputs, residuals, degree)
+    fit_error = np.abs(np.poly1d(coefficients)(inputs) - residuals).mean()
+    return coefficients.tolist(), fit_error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fits the TeaCache rescale polynomials of a model on reference sampling passes and writes them to "
+        f"<model_dir>/{TEACACHE_COEFFICIENTS_FILE}, which WanModel.initialize_teacache then loads, and reports the "
+        "speedup and the error of TeaCache at several thresholds."
+    )
+    parser.add_argument("--model_id", type=str, default="Skywork/SkyReels-V2-DF-1.3B-540P")
+    parser.add_argument("--prompts", type=str, nargs="+", default=DEFAULT_PROMPTS)
+    parser.add_argument("--image", type=str, default=None, help="Input image of the I2V models.")
+    parser.add_argument("--resolution", type=str, default="540P", choices=["540P", "720P"])
+    parser.add_argument("--num_frames", type=int, default=97)
+    parser.add_argument("--inference_steps", type=int, default=30)
+    parser.add_argument("--guidance_scale", type=float, default=6.0)
+    parser.add_argument("--shift", type=float, default=8.0)
+    parser.add_argument("--ar_step", type=int, default=0, help="Diffusion forcing models only.")
+    parser.add_argument("--causal_block_size", type=int, default=1, help="Diffusion forcing models only.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--degree", type=int, default=4, help="Degree of the rescale polynomials.")
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="*",
+        default=[0.05, 0.1, 0.2, 0.3],
+        help="teacache_thresh values whose speedup and error are measured on the first prompt.")
+    parser.add_argument(
+        "--use_ret_steps",
+        action="store_true",
+        help="Measure the thresholds with the polynomial of the retention steps.")
+    parser.add_argument("--offload", action="store_true")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Coefficients file, next to the checkpoint by default.")
+    args = parser.parse_args()
+    assert args.guidance_scale > 1, "TeaCache pairs the conditional and unconditional calls of every step."
+
+    model_path = download_model(args.model_id)
+    output = args.output or os.path.join(model_path, TEACACHE_COEFFICIENTS_FILE)
+    task = "df" if "DF" in args.model_id else "i2v" if "I2V" in args.model_id else "t2v"
+    height, width = (544, 960) if args.resolution == "540P" else (720, 1280)
+
+    pipeline_kwargs = dict(model_path=model_path, dit_path=model_path, offload=args.offload)
+    image = None
+    if task == "df":
+        pipe = DiffusionForcingPipeline(device=torch.device("cuda"), **pipeline_kwargs)
+        if args.ar_step > 0:
+            pipe.transformer.set_ar_attention(args.causal_block_size)
+    elif task == "i2v":
+        assert args.image is not None, "The I2V models need `--image`."
+        pipe = Image2VideoPipeline(**pipeline_kwargs)
+        image = load_image(args.image)
+        if image.height > image.width:
+            height, width = width, height
+        image = resizecrop(image, height, width).convert("RGB")
+    else:
+        pipe = Text2VideoPipeline(**pipeline_kwargs)
+
+    def generate(prompt):
+        kwargs = dict(
+            prompt=prompt,
+            negative_prompt=DF_NEGATIVE_PROMPT if task == "df" else T2V_NEGATIVE_PROMPT,
+            height=height,
+            width=width,
+            num_frames=args.num_frames,
+            num_inference_steps=args.inference_steps,
+            guidance_scale=args.guidance_scale,
+            shift=args.shift,
+            generator=torch.Generator(device="cuda").manual_seed(args.seed),
+        )
+        if task == "df":
+            kwargs.update(
+                image=image,
+                base_num_frames=args.num_frames,
+                ar_step=args.ar_step,
+                causal_block_size=args.causal_block_size,
+            )
+        elif task == "i2v":
+            kwargs.update(image=image)
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.cuda.amp.autocast(dtype=pipe.transformer.dtype), torch.no_grad():
+            video = pipe(**kwargs)[0]
+        torch.cuda.synchronize()
+        return video, time.perf_counter() - start
+
+    # reference passes without TeaCache
+    recorder = TeaCacheRecorder(pipe.transformer)
+    records = []
+    for prompt in args.prompts:
+        recorder.reset()
+        generate(prompt)
+        records.extend(recorder.records)
+        num_calls = recorder.num_calls
+    print(f"{len(records)} calls recorded over {len(args.prompts)} prompts, {num_calls} calls per generation")
+
+    coefficients, fit_error = fit_coefficients(records, num_calls, False, args.degree)
+    ret_steps_coefficients, ret_steps_fit_error = fit_coefficients(records, num_calls, True, args.degree)
+    print(f"coefficients: {coefficients}, mean absolute fit error {fit_error:.4f}")
+    print(f"ret_steps_coefficients: {ret_steps_coefficients}, mean absolute fit error {ret_steps_fit_error:.4f}")
+    fitted = {
+        "coefficients": coefficients,
+        "ret_steps_coefficients": ret_steps_coefficients,
+        "calibration": {
+            "model_id": args.model_id,
+            "prompts": args.prompts,
+            "resolution": args.resolution,
+            "num_frames": args.num_frames,
+            "inference_steps": args.inference_steps,
+            "guidance_scale": args.guidance_scale,
+            "shift": args.shift,
+            "ar_step": args.ar_step,
+            "fit_error": fit_error,
+            "ret_steps_fit_error": ret_steps_fit_error,
+        },
+        "thresholds": [],
+    }
+
+    # the thresholds, on the first prompt against its reference video, timed again now that the kernels are compiled
+    if args.thresholds:
+        reference_video, reference_seconds = generate(args.prompts[0])
+        print(f"{'thresh':>7} {'seconds':>9} {'speedup':>8} {'computed':>9} {'mean abs err':>13} {'psnr':>7}")
+        print(f"{'-':>7} {reference_seconds:>9.1f} {1.0:>8.2f} {1.0:>9.0%} {0.0:>13.4f} {'inf':>7}")
+    for thresh in args.thresholds:
+        pipe.transformer.initialize_teacache(
+            enable_teacache=True,
+            teacache_thresh=thresh,
+            use_ret_steps=args.use_ret_steps,
+            coefficients=ret_steps_coefficients if args.use_ret_steps else coefficients,
+        )
+        recorder.reset()
+        video, seconds = generate(args.prompts[0])
+        pipe.transformer.initialize_teacache(enable_teacache=False)
+        difference = (video.astype(np.float32) - reference_video.astype(np.float32)) / 255
+        error = np.abs(difference).mean()
+        psnr = 10 * np.log10(1 / max((difference**2).mean(), 1e-10))
+        computed = recorder.num_block_calls / recorder.num_calls
+        speedup = reference_seconds / seconds
+        print(f"{thresh:>7} {seconds:>9.1f} {speedup:>8.2f} {computed:>9.0%} {error:>13.4f} {psnr:>7.2f}")
+        fitted["thresholds"].append(
+            dict(
+                teacache_thresh=thresh,
+                use_ret_steps=args.use_ret_steps,
+                speedup=speedup,
+                computed_calls=computed,
+                mean_abs_error=float(error),
+                psnr=float(psnr),
+            )
+        )
+    recorder.remove()
+
+    with open(output, "w") as f:
+        json.dump(fitted, f, indent=2)
+    print(f"wrote {output}")
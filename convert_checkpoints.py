@@ -0,0 +1,72 @@
+import argparse
+import logging
+import os
+
+import torch
+
+from skyreels_v2_infer.modules import CHECKPOINT_FILES
+from skyreels_v2_infer.modules import CLIPModel
+from skyreels_v2_infer.modules import T5EncoderModel
+from skyreels_v2_infer.modules import WanModel
+from skyreels_v2_infer.modules import WanVAE
+from skyreels_v2_infer.modules import convert_checkpoint
+from skyreels_v2_infer.modules import download_model
+
+COMPONENTS = ["transformer", "t5", "clip", "vae"]
+
+
+def empty_model(component, model_path):
+    """
+    Returns the module of `component` built on the meta device and its checkpoint files, or None if the model has no
+    such component.
+    """
+    if component == "transformer":
+        from accelerate import init_empty_weights
+
+        with init_empty_weights():
+            model = WanModel.from_config(os.path.join(model_path, "config.json"))
+        files = sorted(
+            os.path.join(model_path, file) for file in os.listdir(model_path) if file.endswith(".safetensors")
+        )
+        return model, files
+
+    checkpoint_path = os.path.join(model_path, CHECKPOINT_FILES[component])
+    if not os.path.exists(checkpoint_path):
+        return None
+    if component == "t5":
+        model = T5EncoderModel(
+            checkpoint_path, os.path.join(model_path, "google", "umt5-xxl"), empty_weights=True
+        ).model
+    elif component == "clip":
+        model = CLIPModel(checkpoint_path, os.path.join(model_path, "xlm-roberta-large"), empty_weights=True).model
+    else:
+        model = WanVAE(checkpoint_path, empty_weights=True).vae
+    return model, [checkpoint_path]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rewrites the checkpoints of a model directory into dtype-final safetensors shards with an index "
+        "under <model_dir>/converted, which get_transformer, get_text_encoder, get_image_encoder and get_vae then "
+        "load instead."
+    )
+    parser.add_argument("--model_id", type=str, default="Skywork/SkyReels-V2-DF-1.3B-540P")
+    parser.add_argument("--components", type=str, nargs="+", default=COMPONENTS, choices=COMPONENTS)
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["bfloat16", "float16", "float32"])
+    parser.add_argument("--max_shard_size_gb", type=float, default=5.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    model_path = download_model(args.model_id)
+    for component in args.components:
+        built = empty_model(component, model_path)
+        if built is None:
+            print(f"{component}: no checkpoint in {model_path}, skipped")
+            continue
+        model, files = built
+        # the VAE runs in float32 whatever the dtype of the other components
+        dtype = torch.float32 if component == "vae" else getattr(torch, args.dtype)
+        shards = convert_checkpoint(
+            model, files, model_path, component, dtype, max_shard_size=int(args.max_shard_size_gb * 1024**3)
+        )
+        print(f"{component}: {len(files)} checkpoint(s) -> {len(shards)} {dtype} shard(s)")
@@ -8,7 +8,9 @@ import imageio
 import torch
 from diffusers.utils import load_image
 
+from skyreels_v2_infer.modules import ATTENTION_BACKENDS
 from skyreels_v2_infer.modules import download_model
+from skyreels_v2_infer.modules import set_attention_backend
 from skyreels_v2_infer.pipelines import Image2VideoPipeline
 from skyreels_v2_infer.pipelines import PromptEnhancer
 from skyreels_v2_infer.pipelines import resizecrop
@@ -42,6 +44,11 @@ if __name__ == "__main__":
     parser.add_argument("--offload", action="store_true")
     parser.add_argument("--fps", type=int, default=24)
     parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--num_videos",
+        type=int,
+        default=1,
+        help="Generate this many videos, with the seeds seed, seed + 1, ..., denoised together in one batch.")
     parser.add_argument(
         "--prompt",
         type=str,
@@ -60,12 +67,64 @@ if __name__ == "__main__":
         action="store_true",
         help="Using Retention Steps will result in faster generation speed and better generation quality.")
     parser.add_argument("--token", type=str, default=None, help="Hugging Face token for private models.")
+    parser.add_argument(
+        "--batched_cfg",
+        action="store_true",
+        help="Run the conditional and unconditional passes in one batched transformer forward.")
+    parser.add_argument(
+        "--variable_text_len",
+        action="store_true",
+        help="Keep only the real prompt tokens instead of padding the text embeddings to 512 tokens.")
+    parser.add_argument(
+        "--context_cache",
+        action="store_true",
+        help="Reuse the cross-attention keys and values of the prompt embeddings across denoising steps.")
+    parser.add_argument(
+        "--vae_tiling",
+        action="store_true",
+        help="Run the VAE in overlapping spatial tiles to lower its peak memory.")
+    parser.add_argument(
+        "--block_offload",
+        type=int,
+        default=0,
+        help="Keep the transformer blocks on the CPU and stream them to the GPU while they run, with this many of them "
+        "on the GPU at a time. Implies --offload.")
+    parser.add_argument(
+        "--prompt_cache_dir",
+        type=str,
+        default=None,
+        help="Cache the T5 embeddings of the prompts in this directory, repeated prompts skip loading the text encoder.")
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        default=None,
+        choices=list(ATTENTION_BACKENDS),
+        help="Attention backend used for every call it supports, the fastest one that supports each call by default. "
+        "Also set by the SKYREELS_ATTENTION_BACKEND environment variable.")
+    parser.add_argument(
+        "--server",
+        type=str,
+        default=None,
+        help="Submit the job to a running inference_server.py (host:port or unix:///path) instead of loading the models.")
     args = parser.parse_args()
 
+    if args.server:
+        assert not args.prompt_enhancer and not args.use_usp, "`--prompt_enhancer` and `--use_usp` are not supported with `--server`."
+        assert args.num_videos == 1, "`--num_videos` is not supported with `--server`."
+        from skyreels_v2_infer.server import JOB_DEFAULTS
+        from skyreels_v2_infer.server import submit_cli_job
+
+        job = submit_cli_job(args.server, args, JOB_DEFAULTS)
+        exit(0 if job["status"] == "succeeded" else 1)
+
+    if args.attention_backend:
+        set_attention_backend(args.attention_backend)
+
     args.model_id = download_model(args.model_id, token=args.token)
     print("model_id:", args.model_id)
 
     assert (args.use_usp and args.seed is not None) or (not args.use_usp), "usp mode need seed"
+    assert args.num_videos == 1 or not args.use_usp, "`--num_videos` is not supported with `--use_usp`."
     if args.seed is None:
         random.seed(time.time())
         args.seed = int(random.randrange(4294967294))
@@ -117,13 +176,21 @@ if __name__ == "__main__":
         assert "T2V" in args.model_id, f"check model_id:{args.model_id}"
         print("init text2video pipeline")
         pipe = Text2VideoPipeline(
-            model_path=args.model_id, dit_path=args.model_id, use_usp=args.use_usp, offload=args.offload
+            model_path=args.model_id,
+            dit_path=args.model_id,
+            use_usp=args.use_usp,
+            offload=args.offload or args.block_offload > 0,
+            prompt_cache_dir=args.prompt_cache_dir,
         )
     else:
         assert "I2V" in args.model_id, f"check model_id:{args.model_id}"
         print("init img2video pipeline")
         pipe = Image2VideoPipeline(
-            model_path=args.model_id, dit_path=args.model_id, use_usp=args.use_usp, offload=args.offload
+            model_path=args.model_id,
+            dit_path=args.model_id,
+            use_usp=args.use_usp,
+            offload=args.offload or args.block_offload > 0,
+            prompt_cache_dir=args.prompt_cache_dir,
         )
         args.image = load_image(args.image)
         image_width, image_height = args.image.size
@@ -131,8 +198,17 @@ if __name__ == "__main__":
             height, width = width, height
         args.image = resizecrop(args.image, height, width)
 
+    if args.context_cache:
+        pipe.transformer.set_context_cache()
+
+    if args.block_offload:
+        pipe.transformer.set_block_offload("cuda", args.block_offload)
+
+    if args.vae_tiling:
+        pipe.vae.enable_tiling()
+
     if args.teacache:
-        pipe.transformer.initialize_teacache(enable_teacache=True, num_steps=args.inference_steps, 
+        pipe.transformer.initialize_teacache(enable_teacache=True,
                                              teacache_thresh=args.teacache_thresh, use_ret_steps=args.use_ret_steps, 
                                              ckpt_dir=args.model_id)
         
@@ -144,9 +220,11 @@ if __name__ == "__main__":
         "num_inference_steps": args.inference_steps,
         "guidance_scale": args.guidance_scale,
         "shift": args.shift,
-        "generator": torch.Generator(device="cuda").manual_seed(args.seed),
+        "generator": [torch.Generator(device="cuda").manual_seed(args.seed + i) for i in range(args.num_videos)],
         "height": height,
         "width": width,
+        "batched_cfg": args.batched_cfg,
+        "variable_text_len": args.variable_text_len,
     }
 
     if image is not None:
@@ -157,10 +235,11 @@ if __name__ == "__main__":
 
     with torch.cuda.amp.autocast(dtype=pipe.transformer.dtype), torch.no_grad():
         print(f"infer kwargs:{kwargs}")
-        video_frames = pipe(**kwargs)[0]
+        videos = pipe(**kwargs)
 
     if local_rank == 0:
         current_time = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
-        video_out_file = f"{args.prompt[:100].replace('/','')}_{args.seed}_{current_time}.mp4"
-        output_path = os.path.join(save_dir, video_out_file)
-        imageio.mimwrite(output_path, video_frames, fps=args.fps, quality=8, output_params=["-loglevel", "error"])
+        for seed, video_frames in zip(range(args.seed, args.seed + args.num_videos), videos):
+            video_out_file = f"{args.prompt[:100].replace('/','')}_{seed}_{current_time}.mp4"
+            output_path = os.path.join(save_dir, video_out_file)
+            imageio.mimwrite(output_path, video_frames, fps=args.fps, quality=8, output_params=["-loglevel", "error"])
@@ -9,8 +9,11 @@ import torch
 from diffusers.utils import load_image
 
 from skyreels_v2_infer import DiffusionForcingPipeline
+from skyreels_v2_infer.modules import ATTENTION_BACKENDS
 from skyreels_v2_infer.modules import download_model
+from skyreels_v2_infer.modules import set_attention_backend
 from skyreels_v2_infer.pipelines import PromptEnhancer
+from skyreels_v2_infer.pipelines import StreamingVideoWriter
 from skyreels_v2_infer.pipelines.image2video_pipeline import resizecrop
 from moviepy.editor import VideoFileClip
 
@@ -45,6 +48,11 @@ if __name__ == "__main__":
     parser.add_argument("--offload", action="store_true")
     parser.add_argument("--fps", type=int, default=24)
     parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--num_videos",
+        type=int,
+        default=1,
+        help="Generate this many short videos, with the seeds seed, seed + 1, ..., denoised together in one batch.")
     parser.add_argument(
         "--prompt",
         type=str,
@@ -61,12 +69,92 @@ if __name__ == "__main__":
         "--use_ret_steps",
         action="store_true",
         help="Using Retention Steps will result in faster generation speed and better generation quality.")
+    parser.add_argument(
+        "--teacache_frame_blocks",
+        action="store_true",
+        help="With --teacache, decide per causal block of frames whether to reuse its cached residual.")
+    parser.add_argument(
+        "--batched_cfg",
+        action="store_true",
+        help="Run the conditional and unconditional passes in one batched transformer forward.")
+    parser.add_argument(
+        "--variable_text_len",
+        action="store_true",
+        help="Keep only the real prompt tokens instead of padding the text embeddings to 512 tokens.")
+    parser.add_argument(
+        "--context_cache",
+        action="store_true",
+        help="Reuse the cross-attention keys and values of the prompt embeddings across denoising steps.")
+    parser.add_argument(
+        "--latent_overlap",
+        action="store_true",
+        help="Carry the overlap_history frames over to the next chunk as latents instead of decoding and re-encoding them.")
+    parser.add_argument(
+        "--stream_output",
+        action="store_true",
+        help="Encode each finished chunk of a long video to the output file while the next one is generated.")
+    parser.add_argument(
+        "--vae_tiling",
+        action="store_true",
+        help="Run the VAE in overlapping spatial tiles to lower its peak memory.")
+    parser.add_argument(
+        "--causal_kv_cache",
+        action="store_true",
+        help="With --causal_attention and --ar_step > 0, cache the keys and values of the fully denoised frames and "
+        "run the transformer only on the frames still being denoised. Not supported with --addnoise_condition.")
+    parser.add_argument(
+        "--token_subset",
+        action="store_true",
+        help="Run the output head only on the frames updated by each step.")
+    parser.add_argument(
+        "--token_subset_blocks",
+        type=int,
+        default=0,
+        help="Also run the last N transformer blocks only on the frames updated by each step, without "
+        "--causal_attention. 1 keeps the results unchanged, more blocks are faster but approximate. Implies --token_subset.")
+    parser.add_argument(
+        "--block_offload",
+        type=int,
+        default=0,
+        help="Keep the transformer blocks on the CPU and stream them to the GPU while they run, with this many of them "
+        "on the GPU at a time. Implies --offload.")
+    parser.add_argument(
+        "--prompt_cache_dir",
+        type=str,
+        default=None,
+        help="Cache the T5 embeddings of the prompts in this directory, repeated prompts skip loading the text encoder.")
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        default=None,
+        choices=list(ATTENTION_BACKENDS),
+        help="Attention backend used for every call it supports, the fastest one that supports each call by default. "
+        "Also set by the SKYREELS_ATTENTION_BACKEND environment variable.")
+    parser.add_argument(
+        "--server",
+        type=str,
+        default=None,
+        help="Submit the job to a running inference_server.py (host:port or unix:///path) instead of loading the models.")
     args = parser.parse_args()
 
+    if args.server:
+        assert not args.prompt_enhancer and not args.use_usp, "`--prompt_enhancer` and `--use_usp` are not supported with `--server`."
+        assert args.num_videos == 1, "`--num_videos` is not supported with `--server`."
+        from skyreels_v2_infer.server import JOB_DEFAULTS
+        from skyreels_v2_infer.server import submit_cli_job
+
+        job = submit_cli_job(args.server, args, JOB_DEFAULTS)
+        exit(0 if job["status"] == "succeeded" else 1)
+
+    if args.attention_backend:
+        set_attention_backend(args.attention_backend)
+
     args.model_id = download_model(args.model_id)
     print("model_id:", args.model_id)
 
     assert (args.use_usp and args.seed is not None) or (not args.use_usp), "usp mode need seed"
+    assert args.num_videos == 1 or not args.use_usp, "`--num_videos` is not supported with `--use_usp`."
+    assert args.num_videos == 1 or not args.stream_output, "`--num_videos` is not supported with `--stream_output`."
     if args.seed is None:
         random.seed(time.time())
         args.seed = int(random.randrange(4294967294))
@@ -134,26 +222,50 @@ if __name__ == "__main__":
         device=torch.device("cuda"),
         weight_dtype=torch.bfloat16,
         use_usp=args.use_usp,
-        offload=args.offload,
+        offload=args.offload or args.block_offload > 0,
+        prompt_cache_dir=args.prompt_cache_dir,
     )
 
     if args.causal_attention:
         pipe.transformer.set_ar_attention(args.causal_block_size)
+
+    if args.causal_kv_cache:
+        assert args.causal_attention and not args.use_usp, "`--causal_kv_cache` needs `--causal_attention` and no `--use_usp`."
+        assert args.addnoise_condition == 0, "`--causal_kv_cache` is not supported with `--addnoise_condition`."
+        pipe.transformer.set_causal_kv_cache()
+
+    if args.token_subset or args.token_subset_blocks > 0:
+        assert not args.use_usp, "`--token_subset` is not supported with `--use_usp`."
+        pipe.transformer.set_token_subset(num_blocks=args.token_subset_blocks)
     
+    if args.context_cache:
+        pipe.transformer.set_context_cache()
+
+    if args.block_offload:
+        pipe.transformer.set_block_offload("cuda", args.block_offload)
+
+    if args.vae_tiling:
+        pipe.vae.enable_tiling()
+
     if args.teacache:
-        if args.ar_step > 0:
-            num_steps = args.inference_steps + (((args.base_num_frames - 1) // 4 + 1) // args.causal_block_size - 1) * args.ar_step
-            print('num_steps:', num_steps)
-        else:
-            num_steps = args.inference_steps
-        pipe.transformer.initialize_teacache(enable_teacache=True, num_steps=num_steps, 
+        frame_block_size = args.causal_block_size if args.teacache_frame_blocks else None
+        assert not (args.teacache_frame_blocks and args.use_usp), "`--teacache_frame_blocks` needs no `--use_usp`."
+        pipe.transformer.initialize_teacache(enable_teacache=True,
                                              teacache_thresh=args.teacache_thresh, use_ret_steps=args.use_ret_steps, 
-                                             ckpt_dir=args.model_id)
+                                             ckpt_dir=args.model_id,
+                                             frame_block_size=frame_block_size)
 
     print(f"prompt:{prompt_input}")
+    current_time = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
+    video_out_file = f"{args.prompt[:100].replace('/','')}_{args.seed}_{current_time}.mp4"
+    output_path = os.path.join(save_dir, video_out_file)
+    video_writer = None
+    if args.stream_output and local_rank == 0:
+        video_writer = StreamingVideoWriter(output_path, fps=fps, quality=8)
     print(f"guidance_scale:{guidance_scale}")
 
     if os.path.exists(args.video_path):
+        assert args.num_videos == 1, "`--num_videos` is not supported when extending a video."
         (v_width, v_height), input_num_frames = get_video_num_frames_moviepy(args.video_path)
         assert input_num_frames >= args.overlap_history, "The input video is too short."
 
@@ -177,7 +289,11 @@ if __name__ == "__main__":
             ar_step=args.ar_step,
             causal_block_size=args.causal_block_size,
             fps=fps,
-        )[0]
+            batched_cfg=args.batched_cfg,
+            variable_text_len=args.variable_text_len,
+            latent_overlap=args.latent_overlap,
+            video_writer=video_writer,
+        )
     else:
         if args.image:
             args.image = load_image(args.image)
@@ -204,17 +320,23 @@ if __name__ == "__main__":
                 num_inference_steps=args.inference_steps,
                 shift=shift,
                 guidance_scale=guidance_scale,
-                generator=torch.Generator(device="cuda").manual_seed(args.seed),
+                generator=[torch.Generator(device="cuda").manual_seed(args.seed + i) for i in range(args.num_videos)],
                 overlap_history=args.overlap_history,
                 addnoise_condition=args.addnoise_condition,
                 base_num_frames=args.base_num_frames,
                 ar_step=args.ar_step,
                 causal_block_size=args.causal_block_size,
                 fps=fps,
-            )[0]
+                batched_cfg=args.batched_cfg,
+                variable_text_len=args.variable_text_len,
+                latent_overlap=args.latent_overlap,
+                video_writer=video_writer,
+            )
 
-    if local_rank == 0:
-        current_time = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
-        video_out_file = f"{args.prompt[:100].replace('/','')}_{args.seed}_{current_time}.mp4"
-        output_path = os.path.join(save_dir, video_out_file)
-        imageio.mimwrite(output_path, video_frames, fps=fps, quality=8, output_params=["-loglevel", "error"])
+    if video_writer is not None:
+        video_writer.close()
+    elif local_rank == 0:
+        imageio.mimwrite(output_path, video_frames[0], fps=fps, quality=8, output_params=["-loglevel", "error"])
+        for seed, frames in zip(range(args.seed + 1, args.seed + args.num_videos), video_frames[1:]):
+            output_path = os.path.join(save_dir, f"{args.prompt[:100].replace('/','')}_{seed}_{current_time}.mp4")
+            imageio.mimwrite(output_path, frames, fps=fps, quality=8, output_params=["-loglevel", "error"])
@@ -1,4 +1,5 @@
 import os
+import signal
 import subprocess
 import sys
 import threading
@@ -120,6 +121,7 @@ def run_generation(
     overlap_history_var,
     addnoise_var,
     causal_block_size_var,
+    server_var,
     output,
 ):
     script_name = SCRIPTS[script_var.get()]
@@ -174,6 +176,8 @@ def run_generation(
     if enhancer_var.get():
         cmd.append("--prompt_enhancer")
         cmd.extend(["--prompt_enhancer_model_size", prompt_enhancer_model_size_var.get()])
+    if server_var.get():
+        cmd.extend(["--server", server_var.get()])
 
     output.delete(1.0, tk.END)
     threaded(app, cmd, output)
@@ -417,6 +421,7 @@ class SkyReelsApp:
         self.overlap_history_var = tk.StringVar()
         self.addnoise_var = tk.StringVar(value="0")
         self.causal_block_size_var = tk.StringVar(value="1")
+        self.server_var = tk.StringVar()
 
         self.create_widgets()
 
@@ -494,6 +499,9 @@ class SkyReelsApp:
             row=2, column=3, sticky="w"
         )
 
+        ttk.Label(extra_frame, text="Server").grid(row=3, column=0, sticky="w")
+        tk.Entry(extra_frame, textvariable=self.server_var, width=30).grid(row=3, column=1, columnspan=3, sticky="w")
+
         df_frame = ttk.LabelFrame(self.root, text="Diffusion Forcing Options")
         df_frame.grid(row=2, column=0, columnspan=3, sticky="ew", pady=5, padx=5)
 
@@ -647,12 +655,17 @@ class SkyReelsApp:
             self.overlap_history_var,
             self.addnoise_var,
             self.causal_block_size_var,
+            self.server_var,
             self.output,
         )
 
     def cancel_process(self):
         if hasattr(self, "process") and self.process.poll() is None:
-            self.process.terminate()
+            if self.server_var.get() and os.name == "posix":
+                # lets generate_video.py cancel its job on the inference server before exiting
+                self.process.send_signal(signal.SIGINT)
+            else:
+                self.process.terminate()
             self.output.insert(tk.END, "\nProcess cancelled by user.\n")
             self.cancel_button.config(state="disabled")
             self.run_button.config(state="normal")
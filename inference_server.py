@@ -0,0 +1,75 @@
+import argparse
+
+from skyreels_v2_infer.modules import ATTENTION_BACKENDS
+from skyreels_v2_infer.modules import set_attention_backend
+from skyreels_v2_infer.server import InferenceServer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default=None, help="Serve on a Unix domain socket instead of TCP.")
+    parser.add_argument("--offload", action="store_true")
+    parser.add_argument("--max_pipelines", type=int, default=3, help="Number of pipelines kept resident.")
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=1,
+        help="Run up to this many queued jobs with the same model, video shape and step schedule as one batch.")
+    parser.add_argument(
+        "--max_wait",
+        type=float,
+        default=0.0,
+        help="Seconds a job waits for compatible jobs to fill its batch before it runs with fewer.")
+    parser.add_argument(
+        "--preload",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Model ids to load before serving, e.g. Skywork/SkyReels-V2-DF-1.3B-540P.")
+    parser.add_argument(
+        "--context_cache",
+        action="store_true",
+        help="Reuse the cross-attention keys and values of the prompt embeddings across denoising steps.")
+    parser.add_argument(
+        "--vae_tiling",
+        action="store_true",
+        help="Run the VAE in overlapping spatial tiles to lower its peak memory.")
+    parser.add_argument(
+        "--block_offload",
+        type=int,
+        default=0,
+        help="Keep the transformer blocks on the CPU and stream them to the GPU while they run, with this many of them "
+        "on the GPU at a time. Implies --offload.")
+    parser.add_argument(
+        "--prompt_cache_dir",
+        type=str,
+        default=None,
+        help="Cache the T5 embeddings of the prompts in this directory, repeated prompts skip loading the text encoder.")
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        default=None,
+        choices=list(ATTENTION_BACKENDS),
+        help="Attention backend used for every call it supports, the fastest one that supports each call by default. "
+        "Also set by the SKYREELS_ATTENTION_BACKEND environment variable.")
+    args = parser.parse_args()
+
+    if args.attention_backend:
+        set_attention_backend(args.attention_backend)
+
+    server = InferenceServer(
+        offload=args.offload,
+        block_offload=args.block_offload,
+        max_pipelines=args.max_pipelines,
+        context_cache=args.context_cache,
+        vae_tiling=args.vae_tiling,
+        prompt_cache_dir=args.prompt_cache_dir,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait,
+    )
+    for model_id in args.preload:
+        task = "df" if "DF" in model_id else "i2v" if "I2V" in model_id else "t2v"
+        server.get_pipeline(task, model_id)
+    server.serve_forever(host=args.host, port=args.port, unix_socket=args.unix_socket)
@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+import time
+
+from skyreels_v2_infer.modules import ATTENTION_BACKENDS
+from skyreels_v2_infer.modules import set_attention_backend
+from skyreels_v2_infer.server import InferenceClient
+from skyreels_v2_infer.server import InferenceServer
+from skyreels_v2_infer.server.inference_server import FINISHED
+
+
+def read_jobs(path):
+    """
+    Reads one job per line, a JSON object with the parameters of `JOB_DEFAULTS`, blank lines are skipped.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def wait_all(get, job_ids, poll_interval):
+    states = {}
+    while len(states) < len(job_ids):
+        for job_id in job_ids:
+            if job_id in states:
+                continue
+            job = get(job_id)
+            if job["status"] in FINISHED:
+                states[job_id] = job
+                print(f"job {job_id}: {job['status']}, batch of {job['batch_size']}", flush=True)
+        if len(states) < len(job_ids):
+            time.sleep(poll_interval)
+    return [states[job_id] for job_id in job_ids]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs the generation jobs of a JSONL file, one JSON object of generate_video.py / "
+        "generate_video_df.py parameters per line. Jobs with the same model, video shape and step schedule run "
+        "together as batches. Writes one result file per job and reports the queueing delay and batch size of each."
+    )
+    parser.add_argument("jobs", type=str, help="JSONL file with one job per line.")
+    parser.add_argument(
+        "--results_dir",
+        type=str,
+        default=os.path.join("result", "jobs"),
+        help="Directory of the per-job result files, <line>.json with the final state of the job of that line.")
+    parser.add_argument("--max_batch_size", type=int, default=4, help="Number of compatible jobs run as one batch.")
+    parser.add_argument(
+        "--max_wait",
+        type=float,
+        default=0.0,
+        help="Seconds a job waits for compatible jobs to fill its batch before it runs with fewer.")
+    parser.add_argument(
+        "--server",
+        type=str,
+        default=None,
+        help="Submit the jobs to a running inference_server.py (host:port or unix:///path) instead of loading the "
+        "models, which batches them with its own --max_batch_size and --max_wait.")
+    parser.add_argument("--poll_interval", type=float, default=2.0)
+    parser.add_argument("--offload", action="store_true")
+    parser.add_argument("--max_pipelines", type=int, default=3, help="Number of pipelines kept resident.")
+    parser.add_argument(
+        "--vae_tiling",
+        action="store_true",
+        help="Run the VAE in overlapping spatial tiles to lower its peak memory.")
+    parser.add_argument(
+        "--block_offload",
+        type=int,
+        default=0,
+        help="Keep the transformer blocks on the CPU and stream them to the GPU while they run, with this many of them "
+        "on the GPU at a time. Implies --offload.")
+    parser.add_argument(
+        "--prompt_cache_dir",
+        type=str,
+        default=None,
+        help="Cache the T5 embeddings of the prompts in this directory, repeated prompts skip loading the text encoder.")
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        default=None,
+        choices=list(ATTENTION_BACKENDS),
+        help="Attention backend used for every call it supports, the fastest one that supports each call by default. "
+        "Also set by the SKYREELS_ATTENTION_BACKEND environment variable.")
+    args = parser.parse_args()
+
+    job_params = read_jobs(args.jobs)
+    start = time.time()
+    if args.server:
+        client = InferenceClient(args.server)
+        job_ids = [client.submit(params)["id"] for params in job_params]
+        get = client.get
+    else:
+        if args.attention_backend:
+            set_attention_backend(args.attention_backend)
+        server = InferenceServer(
+            offload=args.offload,
+            block_offload=args.block_offload,
+            max_pipelines=args.max_pipelines,
+            vae_tiling=args.vae_tiling,
+            prompt_cache_dir=args.prompt_cache_dir,
+            max_batch_size=args.max_batch_size,
+            max_wait=args.max_wait,
+        )
+        # all jobs are queued before the worker starts, so that the first batches are full
+        job_ids = [server.submit(params).id for params in job_params]
+        server.start()
+
+        def get(job_id):
+            return server.get(job_id).to_dict()
+
+    print(f"queued {len(job_ids)} jobs from {args.jobs}")
+    jobs = wait_all(get, job_ids, args.poll_interval)
+    seconds = time.time() - start
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    print(f"{'line':>5} {'status':<10} {'batch':>5} {'queued s':>9} {'run s':>7} output")
+    for line, job in enumerate(jobs):
+        with open(os.path.join(args.results_dir, f"{line:05d}.json"), "w") as f:
+            json.dump(job, f, indent=2)
+        queue_delay = "-" if job["queue_delay"] is None else f"{job['queue_delay']:.1f}"
+        run_seconds = "-" if job["started_at"] is None else f"{job['finished_at'] - job['started_at']:.1f}"
+        print(
+            f"{line:>5} {job['status']:<10} {job['batch_size'] or '-':>5} {queue_delay:>9} {run_seconds:>7} "
+            f"{job['output_path'] or job['error'] or ''}"
+        )
+    ran = [job for job in jobs if job["batch_size"]]
+    if ran:
+        mean_batch_size = sum(job["batch_size"] for job in ran) / len(ran)
+        mean_delay = sum(job["queue_delay"] for job in ran) / len(ran)
+        print(f"mean batch size {mean_batch_size:.2f}, mean queueing delay {mean_delay:.1f} s")
+    succeeded = sum(job["status"] == "succeeded" for job in jobs)
+    print(f"{succeeded}/{len(jobs)} jobs succeeded in {seconds:.1f} s, results in {args.results_dir}")
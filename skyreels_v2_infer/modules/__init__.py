@@ -1,11 +1,22 @@
 import gc
+import json
+import logging
+import mmap
 import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from itertools import islice
 
 import torch
-from safetensors.torch import load_file
+from safetensors.torch import save_file
 
+from .attention import ATTENTION_BACKENDS
+from .attention import set_attention_backend
 from .clip import CLIPModel
 from .t5 import T5EncoderModel
+from .text_encoder_cache import CachedTextEncoder
 from .transformer import WanModel
 from .vae import WanVAE
 
@@ -18,8 +29,190 @@ def download_model(model_id, token=None):
     return model_id
 
 
+# checkpoint file of each component besides the transformer, relative to the model directory
+CHECKPOINT_FILES = {
+    "t5": "models_t5_umt5-xxl-enc-bf16.pth",
+    "clip": "models_clip_open-clip-xlm-roberta-large-vit-huge-14.pth",
+    "vae": "Wan2.1_VAE.pth",
+}
+CONVERTED_DIR = "converted"
+CONVERTED_FORMAT = "skyreels-v2-converted"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def _mmap_safetensors(path):
+    """
+    Returns the tensors of a safetensors file as views of a private memory map of it, nothing is read until used.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header.pop("__metadata__", None)
+    state_dict = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if start == end:
+            state_dict[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        count = (end - start) // dtype.itemsize
+        state_dict[name] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=8 + header_size + start)
+        state_dict[name] = state_dict[name].view(info["shape"])
+    return state_dict
+
+
+def _read_checkpoint(path):
+    if path.endswith(".safetensors"):
+        return _mmap_safetensors(path)
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        # checkpoints in the legacy format can not be memory-mapped
+        return torch.load(path, map_location="cpu", weights_only=True)
+
+
+def load_checkpoint(model, checkpoint_paths, device="cuda", weight_dtype=None, num_threads=1):
+    """
+    Loads `.safetensors` or `.pth` checkpoints into a model whose weights are on the meta device.
+
+    The checkpoints are memory-mapped and every tensor is cast and moved to `device` on its own before it takes the
+    place of its meta tensor, so neither an initialized copy of the model nor a whole host copy of a checkpoint is ever
+    allocated. With `num_threads` > 1 up to `num_threads` checkpoint files are read in parallel. Floating point tensors
+    are cast to `weight_dtype`, unless it is None.
+    """
+    if isinstance(checkpoint_paths, str):
+        checkpoint_paths = [checkpoint_paths]
+
+    def read(path):
+        state_dict = {}
+        for name, tensor in _read_checkpoint(path).items():
+            if weight_dtype is not None and tensor.is_floating_point():
+                state_dict[name] = tensor.to(device, weight_dtype)
+            else:
+                state_dict[name] = tensor.to(device)
+        return state_dict
+
+    unexpected = []
+    num_threads = max(num_threads, 1)
+    paths = iter(checkpoint_paths)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # a window of at most `num_threads` files in flight, the next one is only read once a state dict is assigned
+        # and released along with the future that holds it
+        pending = deque((path, executor.submit(read, path)) for path in islice(paths, num_threads))
+        while pending:
+            path, future = pending.popleft()
+            state_dict = future.result()
+            del future
+            logging.info(f"loading {path}")
+            unexpected += model.load_state_dict(state_dict, strict=False, assign=True).unexpected_keys
+            del state_dict
+            pending.extend((path, executor.submit(read, path)) for path in islice(paths, 1))
+    if unexpected:
+        logging.warning(f"unexpected weights in {checkpoint_paths}: {unexpected}")
+
+    missing = [name for name, tensor in chain(model.named_parameters(), model.named_buffers()) if tensor.is_meta]
+    if missing:
+        raise ValueError(f"weights missing from {checkpoint_paths}: {missing}")
+    # buffers created with the model are not part of the checkpoints
+    return model.to(device)
+
+
+def _converted_index(model_dir, component):
+    return os.path.join(model_dir, CONVERTED_DIR, f"{component}.safetensors.index.json")
+
+
+def convert_checkpoint(model, checkpoint_paths, model_dir, component, weight_dtype, max_shard_size=5 * 1024**3):
+    """
+    Rewrites the checkpoints of `model`, built on the meta device, into safetensors shards under
+    `model_dir/converted` that hold exactly its weights, in its order and already cast to `weight_dtype`, along with
+    an index mapping every weight to its shard. Loading them then needs neither unpickling nor casting, and the
+    shards can be memory-mapped without copies.
+    """
+    if isinstance(checkpoint_paths, str):
+        checkpoint_paths = [checkpoint_paths]
+    sources = {}
+    for path in checkpoint_paths:
+        sources.update(_read_checkpoint(path))
+
+    # plan the shards from the shapes of the model, so that their names hold the shard count
+    expected = model.state_dict()
+    missing = [name for name in expected if name not in sources]
+    if missing:
+        raise ValueError(f"weights missing from {checkpoint_paths}: {missing}")
+    shards, size = [[]], 0
+    for name, meta in expected.items():
+        if tuple(sources[name].shape) != tuple(meta.shape):
+            raise ValueError(f"{name} has shape {tuple(sources[name].shape)}, expected {tuple(meta.shape)}")
+        dtype = weight_dtype if sources[name].is_floating_point() else sources[name].dtype
+        nbytes = sources[name].numel() * dtype.itemsize
+        if shards[-1] and size + nbytes > max_shard_size:
+            shards.append([])
+            size = 0
+        shards[-1].append(name)
+        size += nbytes
+
+    output_dir = os.path.join(model_dir, CONVERTED_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+    weight_map = {}
+    for i, names in enumerate(shards):
+        file = f"{component}-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+        state_dict = {}
+        for name in names:
+            tensor = sources[name]
+            dtype = weight_dtype if tensor.is_floating_point() else tensor.dtype
+            state_dict[name] = tensor.to(dtype, copy=True).contiguous()
+            weight_map[name] = file
+        save_file(state_dict, os.path.join(output_dir, file), metadata={"format": "pt"})
+        del state_dict
+        logging.info(f"wrote {file}")
+
+    index = {
+        "metadata": {
+            "format": CONVERTED_FORMAT,
+            "dtype": str(weight_dtype).replace("torch.", ""),
+            "sources": {os.path.basename(path): os.path.getsize(path) for path in checkpoint_paths},
+        },
+        "weight_map": weight_map,
+    }
+    with open(_converted_index(model_dir, component), "w") as f:
+        json.dump(index, f, indent=2)
+    return [os.path.join(output_dir, file) for file in sorted(set(weight_map.values()))]
+
+
+def checkpoint_files(model_dir, component, source_files):
+    """
+    Returns the shards written by `convert_checkpoint` for `component` if `model_dir` holds a conversion of
+    `source_files`, else `source_files`.
+    """
+    index_path = _converted_index(model_dir, component)
+    if not os.path.exists(index_path):
+        return source_files
+    with open(index_path) as f:
+        index = json.load(f)
+    sources = {os.path.basename(path): os.path.getsize(path) for path in source_files}
+    if index["metadata"].get("format") != CONVERTED_FORMAT or index["metadata"].get("sources") != sources:
+        logging.warning(f"ignoring {index_path}, it was converted from other checkpoints")
+        return source_files
+    return [os.path.join(model_dir, CONVERTED_DIR, file) for file in sorted(set(index["weight_map"].values()))]
+
+
 def get_vae(model_path, device="cuda", weight_dtype=torch.float32) -> WanVAE:
-    vae = WanVAE(model_path).to(device).to(weight_dtype)
+    vae = WanVAE(model_path, empty_weights=True)
+    load_checkpoint(vae.vae, checkpoint_files(os.path.dirname(model_path), "vae", [model_path]), device, weight_dtype)
+    vae.to(device).to(weight_dtype)
     vae.vae.requires_grad_(False)
     vae.vae.eval()
     gc.collect()
@@ -27,18 +220,15 @@ def get_vae(model_path, device="cuda", weight_dtype=torch.float32) -> WanVAE:
     return vae
 
 
-def get_transformer(model_path, device="cuda", weight_dtype=torch.bfloat16) -> WanModel:
-    config_path = os.path.join(model_path, "config.json")
-    transformer = WanModel.from_config(config_path).to(weight_dtype).to(device)
+def get_transformer(model_path, device="cuda", weight_dtype=torch.bfloat16, num_threads=1) -> WanModel:
+    from accelerate import init_empty_weights
 
-    for file in os.listdir(model_path):
-        if file.endswith(".safetensors"):
-            file_path = os.path.join(model_path, file)
-            state_dict = load_file(file_path)
-            transformer.load_state_dict(state_dict, strict=False)
-            del state_dict
-            gc.collect()
-            torch.cuda.empty_cache()
+    config_path = os.path.join(model_path, "config.json")
+    # only the parameters go to the meta device, the rope table is computed on the host
+    with init_empty_weights():
+        transformer = WanModel.from_config(config_path)
+    files = sorted(os.path.join(model_path, file) for file in os.listdir(model_path) if file.endswith(".safetensors"))
+    load_checkpoint(transformer, checkpoint_files(model_path, "transformer", files), device, weight_dtype, num_threads)
 
     transformer.requires_grad_(False)
     transformer.eval()
@@ -48,9 +238,10 @@ def get_transformer(model_path, device="cuda", weight_dtype=torch.bfloat16) -> W
 
 
 def get_text_encoder(model_path, device="cuda", weight_dtype=torch.bfloat16) -> T5EncoderModel:
-    t5_model = os.path.join(model_path, "models_t5_umt5-xxl-enc-bf16.pth")
+    t5_model = os.path.join(model_path, CHECKPOINT_FILES["t5"])
     tokenizer_path = os.path.join(model_path, "google", "umt5-xxl")
-    text_encoder = T5EncoderModel(checkpoint_path=t5_model, tokenizer_path=tokenizer_path).to(device).to(weight_dtype)
+    text_encoder = T5EncoderModel(checkpoint_path=t5_model, tokenizer_path=tokenizer_path, empty_weights=True)
+    load_checkpoint(text_encoder.model, checkpoint_files(model_path, "t5", [t5_model]), device, weight_dtype)
     text_encoder.requires_grad_(False)
     text_encoder.eval()
     gc.collect()
@@ -58,10 +249,27 @@ def get_text_encoder(model_path, device="cuda", weight_dtype=torch.bfloat16) ->
     return text_encoder
 
 
+def get_cached_text_encoder(
+    model_path, device="cuda", weight_dtype=torch.bfloat16, cache_dir=None, max_cache_size=32
+) -> CachedTextEncoder:
+    t5_model = os.path.join(model_path, CHECKPOINT_FILES["t5"])
+    tokenizer_path = os.path.join(model_path, "google", "umt5-xxl")
+    return CachedTextEncoder(
+        lambda: get_text_encoder(model_path, device, weight_dtype),
+        t5_model,
+        tokenizer_path,
+        device=device,
+        weight_dtype=weight_dtype,
+        cache_dir=cache_dir,
+        max_cache_size=max_cache_size,
+    )
+
+
 def get_image_encoder(model_path, device="cuda", weight_dtype=torch.bfloat16) -> CLIPModel:
-    checkpoint_path = os.path.join(model_path, "models_clip_open-clip-xlm-roberta-large-vit-huge-14.pth")
+    checkpoint_path = os.path.join(model_path, CHECKPOINT_FILES["clip"])
     tokenizer_path = os.path.join(model_path, "xlm-roberta-large")
-    image_enc = CLIPModel(checkpoint_path, tokenizer_path).to(weight_dtype).to(device)
+    image_enc = CLIPModel(checkpoint_path, tokenizer_path, empty_weights=True)
+    load_checkpoint(image_enc.model, checkpoint_files(model_path, "clip", [checkpoint_path]), device, weight_dtype)
     image_enc.requires_grad_(False)
     image_enc.eval()
     gc.collect()
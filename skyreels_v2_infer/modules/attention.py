@@ -1,5 +1,9 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import math
+import os
+
 import torch
+from torch.nn.attention.flex_attention import flex_attention
 
 try:
     import flash_attn_interface
@@ -20,8 +24,16 @@ import warnings
 __all__ = [
     "flash_attention",
     "attention",
+    "ATTENTION_BACKENDS",
+    "AttentionBackend",
+    "register_attention_backend",
+    "select_attention_backend",
+    "set_attention_backend",
 ]
 
+# name of a backend that is used for every call it supports, e.g. to compare backends
+ATTENTION_BACKEND_ENV = "SKYREELS_ATTENTION_BACKEND"
+
 
 def flash_attention(
     q,
@@ -42,8 +54,8 @@ def flash_attention(
     q:              [B, Lq, Nq, C1].
     k:              [B, Lk, Nk, C1].
     v:              [B, Lk, Nk, C2]. Nq must be divisible by Nk.
-    q_lens:         [B].
-    k_lens:         [B].
+    q_lens:         [B]. Number of valid queries of each sample, the outputs of the padding queries are zero.
+    k_lens:         [B]. Number of valid keys of each sample, the padding keys are ignored.
     dropout_p:      float. Dropout probability.
     softmax_scale:  float. The scaling of QK^T before applying softmax.
     causal:         bool. Whether to apply causal attention mask.
@@ -62,15 +74,23 @@ def flash_attention(
         return x if x.dtype in half_dtypes else x.to(dtype)
 
     # preprocess query
-
-    q = half(q.flatten(0, 1))
-    q_lens = torch.tensor([lq] * b, dtype=torch.int32).to(device=q.device, non_blocking=True)
+    if q_lens is None:
+        q = half(q.flatten(0, 1))
+        q_lens = torch.tensor([lq] * b, dtype=torch.int32).to(device=q.device, non_blocking=True)
+    else:
+        q = half(torch.cat([u[:v] for u, v in zip(q, q_lens.tolist())]))
+        q_lens = q_lens.to(device=q.device, dtype=torch.int32)
 
     # preprocess key, value
-
-    k = half(k.flatten(0, 1))
-    v = half(v.flatten(0, 1))
-    k_lens = torch.tensor([lk] * b, dtype=torch.int32).to(device=k.device, non_blocking=True)
+    if k_lens is None:
+        k = half(k.flatten(0, 1))
+        v = half(v.flatten(0, 1))
+        k_lens = torch.tensor([lk] * b, dtype=torch.int32).to(device=k.device, non_blocking=True)
+    else:
+        k_lens_list = k_lens.tolist()
+        k = half(torch.cat([u[:v] for u, v in zip(k, k_lens_list)]))
+        v = half(torch.cat([u[:v] for u, v in zip(v, k_lens_list)]))
+        k_lens = k_lens.to(device=k.device, dtype=torch.int32)
 
     q = q.to(v.dtype)
     k = k.to(v.dtype)
@@ -102,7 +122,7 @@ def flash_attention(
             softmax_scale=softmax_scale,
             causal=causal,
             deterministic=deterministic,
-        )[0].unflatten(0, (b, lq))
+        )[0]
     else:
         assert FLASH_ATTN_2_AVAILABLE
         x = flash_attn.flash_attn_varlen_func(
@@ -122,13 +142,308 @@ def flash_attention(
             causal=causal,
             window_size=window_size,
             deterministic=deterministic,
-        ).unflatten(0, (b, lq))
+        )
     torch.cuda.nvtx.range_pop()
 
+    if x.size(0) == b * lq:
+        x = x.unflatten(0, (b, lq))
+    else:
+        x = torch.stack([torch.nn.functional.pad(u, (0, 0, 0, 0, 0, lq - len(u))) for u in x.split(q_lens.tolist())])
+
     # output
     return x
 
 
+class AttentionBackend:
+    """
+    An attention implementation and the features it supports.
+
+    `fn` takes the arguments of `attention` besides `fa_version` and `backend`, and returns the output of shape
+    [B, Lq, Nq, C2] in the half dtype of the inputs, or `dtype` if they are not half.
+
+    Args:
+        name (str): Name of the backend
+        fn (Callable): Implementation
+        available (bool): Whether its dependencies are installed
+        devices (Tuple[str], *optional*): Device types it runs on, all of them if None
+        varlen (bool): Supports `q_lens` and `k_lens`
+        causal (bool): Supports causal attention
+        block_mask (bool): Supports flex attention block masks
+        window (bool): Supports sliding window attention
+        max_head_dim (int, *optional*): Largest supported head dimension
+    """
+
+    def __init__(
+        self,
+        name,
+        fn,
+        available=True,
+        devices=None,
+        varlen=False,
+        causal=False,
+        block_mask=False,
+        window=False,
+        max_head_dim=None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.available = available
+        self.devices = devices
+        self.varlen = varlen
+        self.causal = causal
+        self.block_mask = block_mask
+        self.window = window
+        self.max_head_dim = max_head_dim
+
+    def supports(self, q, varlen=False, causal=False, block_mask=False, window=False):
+        return (
+            self.available
+            and (self.devices is None or q.device.type in self.devices)
+            and (self.max_head_dim is None or q.size(-1) <= self.max_head_dim)
+            and (self.varlen or not varlen)
+            and (self.causal or not causal)
+            and (self.block_mask or not block_mask)
+            and (self.window or not window)
+        )
+
+
+# registered backends, from the fastest to the slowest
+ATTENTION_BACKENDS = {}
+_forced_backend = None
+_fallback_warnings = set()
+
+
+def register_attention_backend(backend):
+    """
+    Add a backend after the registered ones, or replace the one of the same name in place.
+    """
+    ATTENTION_BACKENDS[backend.name] = backend
+    return backend
+
+
+def set_attention_backend(name=None):
+    """
+    Use the backend `name` for every call it supports, the other calls use the fastest backend that supports them.
+    The fastest valid backend is chosen for every call if `name` is None.
+    """
+    global _forced_backend
+    if name is not None and name not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {name!r}, expected one of {list(ATTENTION_BACKENDS)}")
+    _forced_backend = name
+
+
+def select_attention_backend(q, varlen=False, causal=False, block_mask=False, window=False, preferred=None):
+    r"""
+    Returns the `AttentionBackend` of a call: the forced one if it supports the call, then `preferred`, then the
+    first registered one that supports it.
+    """
+    features = dict(varlen=varlen, causal=causal, block_mask=block_mask, window=window)
+    if preferred is not None and preferred not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {preferred!r}, expected one of {list(ATTENTION_BACKENDS)}")
+    candidates = [name for name in (_forced_backend, preferred) if name is not None] + list(ATTENTION_BACKENDS)
+    for name in candidates:
+        backend = ATTENTION_BACKENDS[name]
+        if backend.supports(q, **features):
+            if _forced_backend is not None and name != _forced_backend:
+                key = (_forced_backend, q.device.type, *features.values())
+                if key not in _fallback_warnings:
+                    _fallback_warnings.add(key)
+                    warnings.warn(
+                        f"Attention backend {_forced_backend!r} does not support {features} on {q.device.type}, "
+                        f"using {name!r} instead."
+                    )
+            return backend
+    raise RuntimeError(f"No attention backend supports {features} on {q.device.type}")
+
+
+def _half(x, dtype):
+    return x if x.dtype in (torch.float16, torch.bfloat16) else x.to(dtype)
+
+
+def _attention_mask(rows, lq, lk, q_lens, k_lens, causal, window_size, block_mask, device):
+    r"""
+    Boolean mask of shape [B or 1, 1, len(rows), Lk] of the keys that the queries at positions `rows` attend, None if
+    they attend all keys. Like flash attention, causal masks and windows are aligned to the bottom right, the last
+    valid query of each sample is at the position of its last valid key.
+    """
+    q_idx = rows.view(1, -1, 1)
+    kv_idx = torch.arange(lk, device=device).view(1, 1, -1)
+    masks = []
+    if k_lens is not None:
+        k_lens = k_lens.to(device).view(-1, 1, 1)
+        masks.append(kv_idx < k_lens)
+    if causal or tuple(window_size) != (-1, -1):
+        q_count = lq if q_lens is None else q_lens.to(device).view(-1, 1, 1)
+        k_count = lk if k_lens is None else k_lens
+        diagonal = q_idx + (k_count - q_count)
+        left, right = window_size
+        if causal:
+            masks.append(kv_idx <= diagonal)
+        elif right >= 0:
+            masks.append(kv_idx <= diagonal + right)
+        if left >= 0:
+            masks.append(kv_idx >= diagonal - left)
+    if block_mask is not None:
+        zero = torch.zeros((), dtype=torch.long, device=device)
+        masks.append(block_mask.mask_mod(zero, zero, q_idx[0], kv_idx[0])[None])
+    if not masks:
+        return None
+    mask = masks[0]
+    for other in masks[1:]:
+        mask = mask & other
+    return mask[:, None]
+
+
+def _zero_invalid_rows(out, mask, rows, q_lens):
+    r"""
+    Zero the outputs [B, N, len(rows), C] of the padding queries and of the queries that attend no key.
+    """
+    valid = None if mask is None else mask.any(-1, keepdim=True)
+    if q_lens is not None:
+        valid_rows = rows.view(1, 1, -1, 1) < q_lens.to(out.device).view(-1, 1, 1, 1)
+        valid = valid_rows if valid is None else valid & valid_rows
+    return out if valid is None else torch.where(valid, out, out.new_zeros(()))
+
+
+def _flash3_attention(
+    q, k, v, q_lens, k_lens, dropout_p, softmax_scale, q_scale, causal, window_size, deterministic, dtype, block_mask
+):
+    return flash_attention(
+        q, k, v, q_lens, k_lens, dropout_p, softmax_scale, q_scale, causal, window_size, deterministic, dtype, version=3
+    )
+
+
+def _flash2_attention(
+    q, k, v, q_lens, k_lens, dropout_p, softmax_scale, q_scale, causal, window_size, deterministic, dtype, block_mask
+):
+    return flash_attention(
+        q, k, v, q_lens, k_lens, dropout_p, softmax_scale, q_scale, causal, window_size, deterministic, dtype, version=2
+    )
+
+
+def _sdpa_attention(
+    q, k, v, q_lens, k_lens, dropout_p, softmax_scale, q_scale, causal, window_size, deterministic, dtype, block_mask
+):
+    r"""
+    torch scaled_dot_product_attention, which dispatches to its flash, memory-efficient or math kernel. The lengths,
+    causality and window are applied with a dense boolean mask, unless plain causal attention can use `is_causal`.
+    """
+    b, lq, lk, n = q.size(0), q.size(1), k.size(1), q.size(2)
+    q, k, v = _half(q, dtype), _half(k, dtype), _half(v, dtype)
+    q, k = q.to(v.dtype), k.to(v.dtype)
+    if q_scale is not None:
+        q = q * q_scale
+
+    is_causal = causal and q_lens is None and k_lens is None and lq == lk and tuple(window_size) == (-1, -1)
+    rows = torch.arange(lq, device=q.device)
+    mask = None if is_causal else _attention_mask(rows, lq, lk, q_lens, k_lens, causal, window_size, None, q.device)
+    out = torch.nn.functional.scaled_dot_product_attention(
+        q.transpose(1, 2),
+        k.transpose(1, 2).repeat_interleave(n // k.size(2), dim=1),
+        v.transpose(1, 2).repeat_interleave(n // v.size(2), dim=1),
+        attn_mask=mask,
+        is_causal=is_causal,
+        dropout_p=dropout_p,
+        scale=softmax_scale,
+    )
+    return _zero_invalid_rows(out, mask, rows, q_lens).transpose(1, 2).contiguous()
+
+
+# the query and key lengths change with the frames in the causal kv cache from step to step, the kernels are compiled
+# for dynamic shapes so that they don't recompile for every length and fall back to eager after the recompile limit
+_compiled_flex_attention = torch.compile(flex_attention, dynamic=True, mode="max-autotune")
+
+
+def _flex_attention(
+    q, k, v, q_lens, k_lens, dropout_p, softmax_scale, q_scale, causal, window_size, deterministic, dtype, block_mask
+):
+    r"""
+    flex_attention with a `BlockMask` built on the sequences right padded to a multiple of 128.
+    """
+    b, lq, lk, n, d = q.size(0), q.size(1), k.size(1), q.size(2), q.size(3)
+    q, k, v = _half(q, dtype), _half(k, dtype), _half(v, dtype)
+    q, k = q.to(v.dtype), k.to(v.dtype)
+    if q_scale is not None:
+        q = q * q_scale
+    if block_mask is not None:
+        q = torch.cat([q, q.new_zeros(b, math.ceil(lq / 128) * 128 - lq, n, d)], dim=1)
+        kv_padding = math.ceil(lk / 128) * 128 - lk
+        k = torch.cat([k, k.new_zeros(b, kv_padding, *k.shape[2:])], dim=1)
+        v = torch.cat([v, v.new_zeros(b, kv_padding, *v.shape[2:])], dim=1)
+    x = _compiled_flex_attention(
+        query=q.transpose(1, 2),
+        key=k.transpose(1, 2),
+        value=v.transpose(1, 2),
+        block_mask=block_mask,
+        scale=softmax_scale,
+        enable_gqa=n != k.size(2),
+    )
+    return x[:, :, :lq].transpose(1, 2)
+
+
+# number of attention scores the chunked backend computes at a time
+CHUNKED_ATTENTION_MAX_SCORES = 2**26
+
+
+def _chunked_attention(
+    q, k, v, q_lens, k_lens, dropout_p, softmax_scale, q_scale, causal, window_size, deterministic, dtype, block_mask
+):
+    r"""
+    Plain PyTorch attention in float32 over chunks of queries, which bounds the memory of the scores. It supports
+    every feature, block masks are evaluated from their `mask_mod`, and runs on any device.
+    """
+    b, lq, lk, n, out_dtype = q.size(0), q.size(1), k.size(1), q.size(2), _half(v, dtype).dtype
+    scale = softmax_scale if softmax_scale is not None else q.size(-1) ** -0.5
+    q = q.float().transpose(1, 2)
+    if q_scale is not None:
+        q = q * q_scale
+    k = k.float().transpose(1, 2).repeat_interleave(n // k.size(2), dim=1)
+    v = v.float().transpose(1, 2).repeat_interleave(n // v.size(2), dim=1)
+
+    out = q.new_empty(b, n, lq, v.size(-1))
+    chunk_size = max(1, CHUNKED_ATTENTION_MAX_SCORES // (b * n * lk))
+    for start in range(0, lq, chunk_size):
+        rows = torch.arange(start, min(start + chunk_size, lq), device=q.device)
+        scores = torch.matmul(q[:, :, start : start + len(rows)], k.transpose(-1, -2)) * scale
+        mask = _attention_mask(rows, lq, lk, q_lens, k_lens, causal, window_size, block_mask, q.device)
+        if mask is not None:
+            scores = scores.masked_fill(~mask, float("-inf"))
+        probs = torch.nn.functional.dropout(scores.softmax(-1), dropout_p) if dropout_p > 0 else scores.softmax(-1)
+        out[:, :, start : start + len(rows)] = _zero_invalid_rows(torch.matmul(probs, v), mask, rows, q_lens)
+    return out.transpose(1, 2).to(out_dtype).contiguous()
+
+
+register_attention_backend(
+    AttentionBackend(
+        "flash3",
+        _flash3_attention,
+        available=FLASH_ATTN_3_AVAILABLE,
+        devices=("cuda",),
+        varlen=True,
+        causal=True,
+        max_head_dim=256,
+    )
+)
+register_attention_backend(
+    AttentionBackend(
+        "flash2",
+        _flash2_attention,
+        available=FLASH_ATTN_2_AVAILABLE,
+        devices=("cuda",),
+        varlen=True,
+        causal=True,
+        window=True,
+        max_head_dim=256,
+    )
+)
+register_attention_backend(AttentionBackend("sdpa", _sdpa_attention, varlen=True, causal=True, window=True))
+register_attention_backend(AttentionBackend("flex", _flex_attention, devices=("cuda",), block_mask=True))
+register_attention_backend(
+    AttentionBackend("chunked", _chunked_attention, varlen=True, causal=True, block_mask=True, window=True)
+)
+set_attention_backend(os.environ.get(ATTENTION_BACKEND_ENV) or None)
+
+
 def attention(
     q,
     k,
@@ -143,37 +458,39 @@ def attention(
     deterministic=False,
     dtype=torch.bfloat16,
     fa_version=None,
+    block_mask=None,
+    backend=None,
 ):
-    if FLASH_ATTN_2_AVAILABLE or FLASH_ATTN_3_AVAILABLE:
-        return flash_attention(
-            q=q,
-            k=k,
-            v=v,
-            q_lens=q_lens,
-            k_lens=k_lens,
-            dropout_p=dropout_p,
-            softmax_scale=softmax_scale,
-            q_scale=q_scale,
-            causal=causal,
-            window_size=window_size,
-            deterministic=deterministic,
-            dtype=dtype,
-            version=fa_version,
-        )
-    else:
-        if q_lens is not None or k_lens is not None:
-            warnings.warn(
-                "Padding mask is disabled when using scaled_dot_product_attention. It can have a significant impact on performance."
-            )
-        attn_mask = None
-
-        q = q.transpose(1, 2).to(dtype)
-        k = k.transpose(1, 2).to(dtype)
-        v = v.transpose(1, 2).to(dtype)
-
-        out = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v, attn_mask=attn_mask, is_causal=causal, dropout_p=dropout_p
-        )
+    r"""
+    Attention with the fastest registered backend that supports the call, see `select_attention_backend`.
 
-        out = out.transpose(1, 2).contiguous()
-        return out
+    Takes the arguments of `flash_attention`, and:
+        fa_version:     int. Flash attention version preferred when it supports the call.
+        block_mask:     BlockMask. Flex attention block mask built on the sequences padded to a multiple of 128.
+        backend:        str. Backend preferred when it supports the call, overrides `fa_version`.
+    """
+    if backend is None and fa_version is not None:
+        backend = f"flash{fa_version}"
+    selected = select_attention_backend(
+        q,
+        varlen=q_lens is not None or k_lens is not None,
+        causal=causal,
+        block_mask=block_mask is not None,
+        window=tuple(window_size) != (-1, -1),
+        preferred=backend,
+    )
+    return selected.fn(
+        q,
+        k,
+        v,
+        q_lens,
+        k_lens,
+        dropout_p,
+        softmax_scale,
+        q_scale,
+        causal,
+        window_size,
+        deterministic,
+        dtype,
+        block_mask,
+    )
@@ -0,0 +1,114 @@
+import torch
+
+
+class BlockOffloader:
+    """
+    Streams transformer blocks from host memory to `device` one at a time.
+
+    The weights of every block stay in pinned host memory. `num_resident_blocks` slots of device tensors shaped like
+    one block are allocated once, and block i runs in slot i % num_resident_blocks: right before its forward, its
+    parameters are pointed at the slot, and right after, back at their host copies while the slot is refilled with
+    block i + num_resident_blocks. On CUDA the refills run on a side stream, so the copy of the next blocks overlaps
+    the compute of the current one, and the peak memory of the blocks is that of `num_resident_blocks` of them.
+
+    On any other device the copies are synchronous, which runs the same code path with the slots as a separate copy
+    of the weights, e.g. to test it on the CPU.
+
+    Args:
+        blocks (nn.ModuleList): Blocks of identical shapes, run in order
+        device: Device the blocks run on
+        num_resident_blocks (int): Number of blocks on the device at a time, all blocks stay there if it is not
+            smaller than their count
+    """
+
+    def __init__(self, blocks, device, num_resident_blocks=2):
+        self.blocks = blocks
+        self.device = torch.device(device)
+        self.num_slots = max(1, num_resident_blocks)
+        self.use_streams = self.device.type == "cuda"
+        self.handles = []
+
+        if self.num_slots >= len(blocks):
+            blocks.to(self.device)
+            return
+
+        # (module, name, is_parameter, host tensor) of every weight of every block
+        self.host_tensors = []
+        for block in blocks:
+            entries = []
+            for module in block.modules():
+                for tensors, is_parameter in ((module._parameters, True), (module._buffers, False)):
+                    for name, tensor in tensors.items():
+                        if tensor is None:
+                            continue
+                        host = tensor.data.to("cpu")
+                        if self.use_streams:
+                            host = host.pin_memory()
+                        entries.append((module, name, is_parameter, host))
+            self.host_tensors.append(entries)
+            self._point_to(len(self.host_tensors) - 1, [host for _, _, _, host in entries])
+        shapes = [[(host.shape, host.dtype) for _, _, _, host in entries] for entries in self.host_tensors]
+        assert all(shape == shapes[0] for shape in shapes), "block offload needs blocks of identical shapes"
+
+        self.slots = [
+            [torch.empty_like(host, device=self.device) for _, _, _, host in self.host_tensors[0]]
+            for _ in range(self.num_slots)
+        ]
+        self.slot_block = [None] * self.num_slots
+        self.loaded_events = [None] * self.num_slots
+        self.free_events = [None] * self.num_slots
+        self.copy_stream = torch.cuda.Stream(self.device) if self.use_streams else None
+
+        for i, block in enumerate(blocks):
+            self.handles.append(block.register_forward_pre_hook(lambda module, args, i=i: self._before_block(i)))
+            self.handles.append(block.register_forward_hook(lambda module, args, output, i=i: self._after_block(i)))
+        for i in range(self.num_slots):
+            self._load(i)
+
+    def _point_to(self, index, tensors):
+        for (module, name, is_parameter, _), tensor in zip(self.host_tensors[index], tensors):
+            if is_parameter:
+                module._parameters[name].data = tensor
+            else:
+                module._buffers[name] = tensor
+
+    def _load(self, index):
+        slot = index % self.num_slots
+        self.slot_block[slot] = index
+        sources = [host for _, _, _, host in self.host_tensors[index]]
+        if not self.use_streams:
+            for target, source in zip(self.slots[slot], sources):
+                target.copy_(source)
+            return
+        with torch.cuda.stream(self.copy_stream):
+            # the slot is only overwritten once the block that used it last is computed
+            if self.free_events[slot] is not None:
+                self.copy_stream.wait_event(self.free_events[slot])
+            for target, source in zip(self.slots[slot], sources):
+                target.copy_(source, non_blocking=True)
+            self.loaded_events[slot] = torch.cuda.Event()
+            self.loaded_events[slot].record(self.copy_stream)
+
+    def _before_block(self, index):
+        slot = index % self.num_slots
+        if self.slot_block[slot] != index:
+            # blocks run out of order, e.g. when a forward was interrupted
+            self._load(index)
+        if self.use_streams:
+            torch.cuda.current_stream(self.device).wait_event(self.loaded_events[slot])
+        self._point_to(index, self.slots[slot])
+
+    def _after_block(self, index):
+        slot = index % self.num_slots
+        if self.use_streams:
+            self.free_events[slot] = torch.cuda.Event()
+            self.free_events[slot].record(torch.cuda.current_stream(self.device))
+        self._point_to(index, [host for _, _, _, host in self.host_tensors[index]])
+        # prefetch the block that runs next in this slot, the first one of the next forward after the last ones
+        next_index = index + self.num_slots
+        self._load(next_index if next_index < len(self.blocks) else slot)
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
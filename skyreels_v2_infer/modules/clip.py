@@ -9,7 +9,7 @@ import torch.nn.functional as F
 import torchvision.transforms as T
 from diffusers.models import ModelMixin
 
-from .attention import flash_attention
+from .attention import attention
 from .tokenizers import HuggingfaceTokenizer
 from .xlm_roberta import XLMRoberta
 
@@ -79,7 +79,7 @@ class SelfAttention(nn.Module):
 
         # compute attention
         p = self.attn_dropout if self.training else 0.0
-        x = flash_attention(q, k, v, dropout_p=p, causal=self.causal, version=2)
+        x = attention(q, k, v, dropout_p=p, causal=self.causal, fa_version=2)
         x = x.reshape(b, s, c)
 
         # output
@@ -187,7 +187,7 @@ class AttentionPool(nn.Module):
         k, v = self.to_kv(x).view(b, s, 2, n, d).unbind(2)
 
         # compute attention
-        x = flash_attention(q, k, v, version=2)
+        x = attention(q, k, v, fa_version=2)
         x = x.reshape(b, 1, c)
 
         # output
@@ -486,18 +486,23 @@ def clip_xlm_roberta_vit_h_14(pretrained=False, pretrained_name="open-clip-xlm-r
 
 
 class CLIPModel(ModelMixin):
-    def __init__(self, checkpoint_path, tokenizer_path):
+    def __init__(self, checkpoint_path, tokenizer_path, empty_weights=False):
+        """
+        With `empty_weights` the model is built on the meta device and `checkpoint_path` is not loaded, which is left
+        to `load_checkpoint`.
+        """
         self.checkpoint_path = checkpoint_path
         self.tokenizer_path = tokenizer_path
 
         super().__init__()
         # init model
         self.model, self.transforms = clip_xlm_roberta_vit_h_14(
-            pretrained=False, return_transforms=True, return_tokenizer=False
+            pretrained=False, return_transforms=True, return_tokenizer=False, device="meta" if empty_weights else "cpu"
         )
         self.model = self.model.eval().requires_grad_(False)
-        logging.info(f"loading {checkpoint_path}")
-        self.model.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
+        if not empty_weights:
+            logging.info(f"loading {checkpoint_path}")
+            self.model.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
 
         # init tokenizer
         self.tokenizer = HuggingfaceTokenizer(
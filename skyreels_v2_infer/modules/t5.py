@@ -15,6 +15,7 @@ __all__ = [
     "T5Encoder",
     "T5Decoder",
     "T5EncoderModel",
+    "pad_text_embeddings",
 ]
 
 
@@ -425,16 +426,22 @@ class T5EncoderModel(ModelMixin):
         tokenizer_path=None,
         text_len=512,
         shard_fn=None,
+        empty_weights=False,
     ):
+        """
+        With `empty_weights` the encoder is built on the meta device and `checkpoint_path` is not loaded, which is left
+        to `load_checkpoint`.
+        """
         self.text_len = text_len
         self.checkpoint_path = checkpoint_path
         self.tokenizer_path = tokenizer_path
 
         super().__init__()
         # init model
-        model = umt5_xxl(encoder_only=True, return_tokenizer=False)
-        logging.info(f"loading {checkpoint_path}")
-        model.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
+        model = umt5_xxl(encoder_only=True, return_tokenizer=False, device="meta" if empty_weights else "cpu")
+        if not empty_weights:
+            logging.info(f"loading {checkpoint_path}")
+            model.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
         self.model = model
         if shard_fn is not None:
             self.model = shard_fn(self.model, sync_module_states=False)
@@ -443,8 +450,13 @@ class T5EncoderModel(ModelMixin):
         # init tokenizer
         self.tokenizer = HuggingfaceTokenizer(name=tokenizer_path, seq_len=text_len, clean="whitespace")
 
-    def encode(self, texts):
-        ids, mask = self.tokenizer(texts, return_mask=True, add_special_tokens=True)
+    def encode(self, texts, variable_len=False):
+        """
+        Returns the embeddings of `texts` zero padded to `text_len` tokens, or with `variable_len` only to the longest
+        text of the batch, which saves encoder and cross-attention compute on short prompts.
+        """
+        padding = {"padding": "longest"} if variable_len else {}
+        ids, mask = self.tokenizer(texts, return_mask=True, add_special_tokens=True, **padding)
         ids = ids.to(self.device)
         mask = mask.to(self.device)
         # seq_lens = mask.gt(0).sum(dim=1).long()
@@ -452,3 +464,18 @@ class T5EncoderModel(ModelMixin):
         context = context * mask.unsqueeze(-1).cuda()
 
         return context
+
+
+def pad_text_embeddings(embeddings):
+    """
+    Concatenates text embeddings of shape [B, L, C] along the batch, padding them to the longest one.
+
+    Returns the batch and the number of tokens of each sample, which is None when all embeddings have the same length
+    so that all their tokens are attended as before.
+    """
+    max_len = max(u.size(1) for u in embeddings)
+    if all(u.size(1) == max_len for u in embeddings):
+        return torch.cat(embeddings), None
+    lens = torch.tensor([u.size(1) for u in embeddings for _ in range(u.size(0))], dtype=torch.int32)
+    context = torch.cat([F.pad(u, (0, 0, 0, max_len - u.size(1))) for u in embeddings])
+    return context, lens.to(context.device)
@@ -0,0 +1,121 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import torch
+from safetensors.torch import load_file
+from safetensors.torch import save_file
+
+
+class CachedTextEncoder:
+    """
+    Caches the T5 embeddings of prompts, in memory and optionally on disk.
+
+    The encoder is only loaded on the first cache miss, and only moved to the target device when something has to be
+    encoded: `to` records the device the embeddings are returned on and `cpu` offloads the encoder if it is loaded.
+    A generation whose prompts are all cached therefore never touches the encoder.
+
+    The embeddings are stored without their padding, keyed by a hash of the tokenizer, the checkpoint and the text.
+    On disk every entry is a safetensors file under `cache_dir`, sharded by the first two hex digits of its key.
+
+    Args:
+        load_fn (callable): Returns the `T5EncoderModel` on its first call
+        checkpoint_path (str): T5 checkpoint, part of the cache key
+        tokenizer_path (str): T5 tokenizer, part of the cache key
+        device: Device the embeddings are returned on until `to` is called
+        weight_dtype: Data type of the embeddings
+        cache_dir (str): Directory of the on-disk cache, disabled if None
+        max_cache_size (int): Number of embeddings kept in memory
+        text_len (int): Padded length of the embeddings, must match the encoder
+    """
+
+    def __init__(
+        self,
+        load_fn,
+        checkpoint_path,
+        tokenizer_path,
+        device="cuda",
+        weight_dtype=torch.bfloat16,
+        cache_dir=None,
+        max_cache_size=32,
+        text_len=512,
+    ):
+        self.load_fn = load_fn
+        self.device = torch.device(device)
+        self.weight_dtype = weight_dtype
+        self.cache_dir = cache_dir
+        self.max_cache_size = max_cache_size
+        self.text_len = text_len
+        self.encoder = None
+        self.cache = OrderedDict()
+
+        checkpoint_path = os.path.realpath(checkpoint_path)
+        size = os.path.getsize(checkpoint_path) if os.path.exists(checkpoint_path) else 0
+        self.key_prefix = f"{os.path.realpath(tokenizer_path)}|{checkpoint_path}|{size}|{text_len}|{weight_dtype}|"
+
+    def to(self, device):
+        self.device = torch.device(device)
+        return self
+
+    def cpu(self):
+        if self.encoder is not None:
+            self.encoder.cpu()
+        return self
+
+    def cache_key(self, text):
+        return hashlib.sha256((self.key_prefix + text).encode("utf-8")).hexdigest()
+
+    def _cache_file(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.safetensors")
+
+    def _lookup(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if self.cache_dir is not None and os.path.exists(self._cache_file(key)):
+            embedding = load_file(self._cache_file(key))["context"]
+            self._store(key, embedding, write=False)
+            return embedding
+        return None
+
+    def _store(self, key, embedding, write=True):
+        self.cache[key] = embedding
+        while len(self.cache) > self.max_cache_size:
+            self.cache.popitem(last=False)
+        if write and self.cache_dir is not None:
+            path = self._cache_file(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # several ranks may write the same entry, the rename makes it atomic
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            save_file({"context": embedding}, tmp_path)
+            os.replace(tmp_path, path)
+
+    @torch.no_grad()
+    def encode(self, texts, variable_len=False):
+        """
+        Same as `T5EncoderModel.encode`, the embeddings are returned padded with zeros to `text_len`, or to the longest
+        text with `variable_len`.
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        keys = [self.cache_key(text) for text in texts]
+        embeddings = [self._lookup(key) for key in keys]
+
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if misses:
+            if self.encoder is None:
+                self.encoder = self.load_fn()
+            self.encoder.to(self.device)
+            miss_texts = [texts[i] for i in misses]
+            context = self.encoder.encode(miss_texts, variable_len=variable_len)
+            _, mask = self.encoder.tokenizer(miss_texts, return_mask=True, add_special_tokens=True)
+            for i, row, seq_len in zip(misses, context, mask.sum(dim=1).tolist()):
+                embeddings[i] = row[:seq_len].to("cpu", self.weight_dtype).contiguous()
+                self._store(keys[i], embeddings[i])
+
+        text_len = max(len(embedding) for embedding in embeddings) if variable_len else self.text_len
+        dim = embeddings[0].shape[-1]
+        context = torch.zeros(len(texts), text_len, dim, dtype=self.weight_dtype, device=self.device)
+        for i, embedding in enumerate(embeddings):
+            context[i, : len(embedding)] = embedding.to(self.device)
+        return context
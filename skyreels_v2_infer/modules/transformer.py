@@ -1,5 +1,9 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import json
 import math
+import os
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import torch.amp as amp
@@ -8,17 +12,15 @@ from diffusers.configuration_utils import ConfigMixin
 from diffusers.configuration_utils import register_to_config
 from diffusers.loaders import PeftAdapterMixin
 from diffusers.models.modeling_utils import ModelMixin
-from torch.backends.cuda import sdp_kernel
 from torch.nn.attention.flex_attention import BlockMask
-from torch.nn.attention.flex_attention import create_block_mask
-from torch.nn.attention.flex_attention import flex_attention
-
-from .attention import flash_attention
 
+from .attention import attention
+from .block_offload import BlockOffloader
 
-flex_attention = torch.compile(flex_attention, dynamic=False, mode="max-autotune")
 
 DISABLE_COMPILE = False  # get os env
+# number of block-wise causal masks kept by a model, one per grid, frames per block and cached frames
+BLOCK_MASK_CACHE_SIZE = 8
 
 __all__ = ["WanModel"]
 
@@ -45,34 +47,207 @@ def rope_params(max_seq_len, dim, theta=10000):
     return freqs
 
 
+class WanRotaryEmbedding:
+    """
+    3D rotary position embedding over the (frame, height, width) positions of the tokens.
+
+    The cos and sin of the angles of every token of a grid are computed once per grid size, frame offset and device,
+    and shared by the self-attention of all blocks and steps, which only apply the rotation.
+
+    Args:
+        head_dim (int): Dimension of the attention heads
+        max_seq_len (int): Number of positions along each axis
+        max_tables (int): Number of tables kept, the least recently built ones are dropped
+    """
+
+    def __init__(self, head_dim, max_seq_len=1024, max_tables=8):
+        d, c = head_dim, head_dim // 2
+        self.freqs = torch.cat(
+            [
+                rope_params(max_seq_len, d - 4 * (d // 6)),
+                rope_params(max_seq_len, 2 * (d // 6)),
+                rope_params(max_seq_len, 2 * (d // 6)),
+            ],
+            dim=1,
+        )
+        self.split_sizes = [c - 2 * (c // 3), c // 3, c // 3]
+        self.max_tables = max_tables
+        self._tables = {}
+
+    @amp.autocast("cuda", enabled=False)
+    def tables(self, grid_sizes, device, frame_offset=0):
+        r"""
+        Args:
+            grid_sizes(Tensor | tuple): (F, H, W) of the grid
+            device: Device of the tables
+            frame_offset(`int`, *optional*): Position of the first frame of the grid
+
+        Returns:
+            (Tensor, Tensor): cos and sin of the angles of the tokens in float32, each of shape [F * H * W, 1, C / 2]
+        """
+        f, h, w = (int(size) for size in grid_sizes)
+        key = (f, h, w, frame_offset, torch.device(device))
+        if key not in self._tables:
+            freqs = self.freqs.split(self.split_sizes, dim=1)
+            freqs_i = torch.cat(
+                [
+                    freqs[0][frame_offset : frame_offset + f].view(f, 1, 1, -1).expand(f, h, w, -1),
+                    freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
+                    freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1),
+                ],
+                dim=-1,
+            ).reshape(f * h * w, 1, -1)
+            if len(self._tables) >= self.max_tables:
+                self._tables.pop(next(iter(self._tables)))
+            self._tables[key] = (freqs_i.real.contiguous().to(device), freqs_i.imag.contiguous().to(device))
+        return self._tables[key]
+
+
+@torch.compile(dynamic=True, disable=DISABLE_COMPILE)
+def fast_rope_rotate(x, cos, sin):
+    x = x.float().unflatten(-1, (-1, 2))
+    x_real, x_imag = x[..., 0], x[..., 1]
+    return torch.stack([x_real * cos - x_imag * sin, x_real * sin + x_imag * cos], dim=-1).flatten(-2)
+
+
 @amp.autocast("cuda", enabled=False)
-def rope_apply(x, grid_sizes, freqs):
-    n, c = x.size(2), x.size(3) // 2
-    bs = x.size(0)
+def rope_apply(x, freqs, token_index=None):
+    r"""
+    Args:
+        x(Tensor): Shape [B, L, N, C], pairs of consecutive channels are rotated
+        freqs(Tuple[Tensor, Tensor]): cos and sin tables of `WanRotaryEmbedding.tables`, shape [L, 1, C / 2]
+        token_index(Tensor, *optional*): Rows of the tables of the tokens of x, all rows if None
+    """
+    cos, sin = freqs
+    if token_index is not None:
+        # x only holds these tokens of the grid
+        cos, sin = cos[token_index], sin[token_index]
+    return fast_rope_rotate(x, cos, sin)
 
-    # split freqs
-    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
 
-    # loop over samples
-    f, h, w = grid_sizes.tolist()
-    seq_len = f * h * w
+# written next to a checkpoint by calibrate_teacache.py
+TEACACHE_COEFFICIENTS_FILE = "teacache_coefficients.json"
 
-    # precompute multipliers
 
-    x = torch.view_as_complex(x.to(torch.float32).reshape(bs, seq_len, n, -1, 2))
-    freqs_i = torch.cat(
-        [
-            freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1),
-        ],
-        dim=-1,
-    ).reshape(seq_len, 1, -1)
+def load_teacache_coefficients(ckpt_dir, use_ret_steps=False):
+    """
+    Returns the TeaCache rescale polynomial fitted for the checkpoint in `ckpt_dir`, on the time embeddings `e`, or
+    on the modulation `e0` with `use_ret_steps`, or None if it has no coefficients file.
+    """
+    path = os.path.join(ckpt_dir, TEACACHE_COEFFICIENTS_FILE) if ckpt_dir else None
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        fitted = json.load(f)
+    return fitted["ret_steps_coefficients" if use_ret_steps else "coefficients"]
 
-    # apply rotary embedding
-    x = torch.view_as_real(x * freqs_i).flatten(3)
 
-    return x
+def builtin_teacache_coefficients(ckpt_dir, use_ret_steps=False):
+    """
+    Returns the TeaCache rescale polynomial of the released model whose name `ckpt_dir` contains, or None.
+    """
+    if "I2V" in ckpt_dir:
+        if use_ret_steps:
+            if '540P' in ckpt_dir:
+                return [ 2.57151496e+05, -3.54229917e+04,  1.40286849e+03, -1.35890334e+01, 1.32517977e-01]
+            if '720P' in ckpt_dir:
+                return [ 8.10705460e+03,  2.13393892e+03, -3.72934672e+02,  1.66203073e+01, -4.17769401e-02]
+        else:
+            if '540P' in ckpt_dir:
+                return [-3.02331670e+02,  2.23948934e+02, -5.25463970e+01,  5.87348440e+00, -2.01973289e-01]
+            if '720P' in ckpt_dir:
+                return [-114.36346466,   65.26524496,  -18.82220707,    4.91518089,   -0.23412683]
+    else:
+        if use_ret_steps:
+            if '1.3B' in ckpt_dir:
+                return [-5.21862437e+04, 9.23041404e+03, -5.28275948e+02, 1.36987616e+01, -4.99875664e-02]
+            if '14B' in ckpt_dir:
+                return [-3.03318725e+05, 4.90537029e+04, -2.65530556e+03, 5.87365115e+01, -3.15583525e-01]
+        else:
+            if '1.3B' in ckpt_dir:
+                return [2.39676752e+03, -1.31110545e+03,  2.01331979e+02, -8.29855975e+00, 1.37887774e-01]
+            if '14B' in ckpt_dir:
+                return [-5784.54975374,  5449.50911966, -1811.16591783,   256.27178429, -13.02252404]
+    return None
+
+
+class TeaCache:
+    """
+    TeaCache state of one generation: the transformer calls whose modulated input barely changed since the previous
+    call of the same stream reuse the residual that the blocks added then. The conditional and unconditional calls of
+    every step alternate as the even and odd streams, or come in one call with batched classifier free guidance.
+
+    Pipelines create one with `WanModel.new_teacache` for every sampling loop and pass it to all its transformer
+    calls, so that no state is left on the model once the generation finishes.
+
+    Args:
+        num_steps (int): Number of sampling steps of the loop
+        teacache_thresh (float): Accumulated rescaled change of the modulated input above which the blocks are run
+        coefficients (list): Rescale polynomial of the relative change of the modulated input
+        use_ret_steps (bool): Compare the modulation `e0` instead of the time embeddings `e`, and run the first 5
+            steps instead of the first and last one
+        frame_block_size (int, *optional*): One decision per block of that many latent frames, see
+            `WanModel._frame_block_teacache`
+    """
+
+    def __init__(self, num_steps, teacache_thresh, coefficients, use_ret_steps=False, frame_block_size=None):
+        # the counter advances on the conditional and the unconditional call of every step
+        self.num_steps = num_steps * 2
+        self.teacache_thresh = teacache_thresh
+        self.rescale_func = np.poly1d(coefficients)
+        self.use_ret_steps = use_ret_steps
+        self.frame_block_size = frame_block_size
+        if use_ret_steps:
+            self.ret_steps = 5 * 2
+            self.cutoff_steps = num_steps * 2
+        else:
+            self.ret_steps = 1 * 2
+            self.cutoff_steps = num_steps * 2 - 2
+        self.reset()
+
+    def reset(self):
+        self.cnt = 0
+        # per stream, even -> condition, odd -> uncondition
+        self.accumulated_rel_l1_distance = [0, 0]
+        self.previous_modulated_input = [None, None]
+        self.previous_residual = [None, None]
+        # per stream, the state of each frame block: its last modulated input, accumulated distance and residual
+        self.frame_blocks = [{}, {}]
+
+    @property
+    def stream(self):
+        return self.cnt % 2
+
+    @property
+    def force_calc(self):
+        return self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps
+
+    def distance(self, modulated_inp, previous):
+        return self.rescale_func(((modulated_inp - previous).abs().mean() / previous.abs().mean()).cpu().item())
+
+    def should_calc(self, modulated_inp):
+        """
+        Returns whether the current call runs the blocks, after accumulating the change of its modulated input.
+        """
+        stream = self.stream
+        previous = self.previous_modulated_input[stream]
+        self.previous_modulated_input[stream] = modulated_inp.clone()
+        if self.force_calc or previous is None or previous.shape != modulated_inp.shape:
+            self.accumulated_rel_l1_distance[stream] = 0
+            return True
+        self.accumulated_rel_l1_distance[stream] += self.distance(modulated_inp, previous)
+        if self.accumulated_rel_l1_distance[stream] < self.teacache_thresh:
+            return False
+        self.accumulated_rel_l1_distance[stream] = 0
+        return True
+
+    def step(self, batched_cfg=False):
+        """
+        Advances to the next call, a batched classifier free guidance call counts for both streams.
+        """
+        self.cnt += 2 if batched_cfg else 1
+        if self.cnt >= self.num_steps:
+            self.reset()
 
 
 @torch.compile(dynamic=True, disable=DISABLE_COMPILE)
@@ -133,23 +308,42 @@ class WanSelfAttention(nn.Module):
         self.norm_k = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
 
         self._flag_ar_attention = False
+        self.frame_kv_cache = {}
 
     def set_ar_attention(self):
         self._flag_ar_attention = True
 
-    def forward(self, x, grid_sizes, freqs, block_mask):
+    def forward(
+        self,
+        x,
+        grid_sizes,
+        freqs,
+        block_mask,
+        kv_cache_key=None,
+        num_clean_frames=0,
+        token_index=None,
+        output_index=None,
+    ):
         r"""
         Args:
             x(Tensor): Shape [B, L, num_heads, C / num_heads]
             seq_lens(Tensor): Shape [B]
             grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
-            freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
+            freqs(Tuple[Tensor, Tensor]): Rope cos and sin tables of the grid, shape [L, 1, C / num_heads / 2]
+            kv_cache_key(Hashable, *optional*): With causal attention, key of the cached keys and values of the
+                frames before `x`, which its queries attend in addition to its own
+            num_clean_frames(`int`, *optional*): Number of leading frames, counting the cached ones, whose keys and
+                values are final and get cached
+            token_index(Tensor, *optional*): Without causal attention, positions in the grid of the tokens of `x`,
+                all tokens of the grid if None
+            output_index(Tensor, *optional*): Without causal attention, indices of the tokens of `x` whose outputs are
+                computed, their queries attend the keys and values of all tokens
         """
         b, s, n, d = *x.shape[:2], self.num_heads, self.head_dim
 
         # query, key, value function
         def qkv_fn(x):
-            q = self.norm_q(self.q(x)).view(b, s, n, d)
+            q = self.norm_q(self.q(x if output_index is None else x[:, output_index])).view(b, -1, n, d)
             k = self.norm_k(self.k(x)).view(b, s, n, d)
             v = self.v(x).view(b, s, n, d)
             return q, k, v
@@ -158,24 +352,31 @@ class WanSelfAttention(nn.Module):
         q, k, v = qkv_fn(x)
 
         if not self._flag_ar_attention:
-            q = rope_apply(q, grid_sizes, freqs)
-            k = rope_apply(k, grid_sizes, freqs)
-            x = flash_attention(q=q, k=k, v=v, window_size=self.window_size)
+            q_index = token_index
+            if output_index is not None:
+                q_index = output_index if token_index is None else token_index[output_index]
+            q = rope_apply(q, freqs, token_index=q_index)
+            k = rope_apply(k, freqs, token_index=token_index)
+            x = attention(q=q, k=k, v=v, window_size=self.window_size)
         else:
-            q = rope_apply(q, grid_sizes, freqs)
-            k = rope_apply(k, grid_sizes, freqs)
+            frame_seqlen = grid_sizes[1].item() * grid_sizes[2].item()
+            cached = self.frame_kv_cache.get(kv_cache_key) if kv_cache_key is not None else None
+            frame_offset = 0 if cached is None else cached[0].shape[1] // frame_seqlen
+            # freqs already start at the first frame after the cached ones, see WanModel.forward
+            q = rope_apply(q, freqs)
+            k = rope_apply(k, freqs)
             q = q.to(torch.bfloat16)
             k = k.to(torch.bfloat16)
             v = v.to(torch.bfloat16)
+            if cached is not None:
+                k = torch.cat([cached[0], k], dim=1)
+                v = torch.cat([cached[1], v], dim=1)
+            if kv_cache_key is not None and num_clean_frames > frame_offset:
+                # the clean frames only attend themselves and the frames before them, their keys and values are final
+                clean_length = num_clean_frames * frame_seqlen
+                self.frame_kv_cache[kv_cache_key] = (k[:, :clean_length].clone(), v[:, :clean_length].clone())
 
-            with sdp_kernel(enable_flash=True, enable_math=False, enable_mem_efficient=False):
-                x = (
-                    torch.nn.functional.scaled_dot_product_attention(
-                        q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), attn_mask=block_mask
-                    )
-                    .transpose(1, 2)
-                    .contiguous()
-                )
+            x = attention(q, k, v, block_mask=block_mask)
 
         # output
         x = x.flatten(2)
@@ -184,22 +385,39 @@ class WanSelfAttention(nn.Module):
 
 
 class WanT2VCrossAttention(WanSelfAttention):
-    def forward(self, x, context):
+    def __init__(self, dim, num_heads, window_size=(-1, -1), qk_norm=True, eps=1e-6):
+        super().__init__(dim, num_heads, window_size, qk_norm, eps)
+        self.kv_cache = {}
+
+    def context_kv(self, context, context_key=None):
+        r"""
+        Key/value projections of the context, reused across calls sharing the same `context_key`.
+        """
+        if context_key is not None and context_key in self.kv_cache:
+            return self.kv_cache[context_key]
+        b, n, d = context.size(0), self.num_heads, self.head_dim
+        k = self.norm_k(self.k(context)).view(b, -1, n, d)
+        v = self.v(context).view(b, -1, n, d)
+        if context_key is not None:
+            self.kv_cache[context_key] = (k, v)
+        return k, v
+
+    def forward(self, x, context, context_lens=None, context_key=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
             context(Tensor): Shape [B, L2, C]
-            context_lens(Tensor): Shape [B]
+            context_lens(Tensor, *optional*): Shape [B], number of valid text tokens, all of them if None
+            context_key(Hashable, *optional*): Cache key of the context, None disables the kv cache
         """
         b, n, d = x.size(0), self.num_heads, self.head_dim
 
         # compute query, key, value
         q = self.norm_q(self.q(x)).view(b, -1, n, d)
-        k = self.norm_k(self.k(context)).view(b, -1, n, d)
-        v = self.v(context).view(b, -1, n, d)
+        k, v = self.context_kv(context, context_key)
 
         # compute attention
-        x = flash_attention(q, k, v)
+        x = attention(q, k, v, k_lens=context_lens)
 
         # output
         x = x.flatten(2)
@@ -215,27 +433,41 @@ class WanI2VCrossAttention(WanSelfAttention):
         self.v_img = nn.Linear(dim, dim)
         # self.alpha = nn.Parameter(torch.zeros((1, )))
         self.norm_k_img = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
+        self.kv_cache = {}
+
+    def context_kv(self, context, context_key=None):
+        r"""
+        Key/value projections of the text and image context, reused across calls sharing the same `context_key`.
+        """
+        if context_key is not None and context_key in self.kv_cache:
+            return self.kv_cache[context_key]
+        context_img = context[:, :257]
+        context = context[:, 257:]
+        b, n, d = context.size(0), self.num_heads, self.head_dim
+        k = self.norm_k(self.k(context)).view(b, -1, n, d)
+        v = self.v(context).view(b, -1, n, d)
+        k_img = self.norm_k_img(self.k_img(context_img)).view(b, -1, n, d)
+        v_img = self.v_img(context_img).view(b, -1, n, d)
+        if context_key is not None:
+            self.kv_cache[context_key] = (k, v, k_img, v_img)
+        return k, v, k_img, v_img
 
-    def forward(self, x, context):
+    def forward(self, x, context, context_lens=None, context_key=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
             context(Tensor): Shape [B, L2, C]
-            context_lens(Tensor): Shape [B]
+            context_lens(Tensor, *optional*): Shape [B], number of valid text tokens, all of them if None
+            context_key(Hashable, *optional*): Cache key of the context, None disables the kv cache
         """
-        context_img = context[:, :257]
-        context = context[:, 257:]
         b, n, d = x.size(0), self.num_heads, self.head_dim
 
         # compute query, key, value
         q = self.norm_q(self.q(x)).view(b, -1, n, d)
-        k = self.norm_k(self.k(context)).view(b, -1, n, d)
-        v = self.v(context).view(b, -1, n, d)
-        k_img = self.norm_k_img(self.k_img(context_img)).view(b, -1, n, d)
-        v_img = self.v_img(context_img).view(b, -1, n, d)
-        img_x = flash_attention(q, k_img, v_img)
+        k, v, k_img, v_img = self.context_kv(context, context_key)
+        img_x = attention(q, k_img, v_img)
         # compute attention
-        x = flash_attention(q, k, v)
+        x = attention(q, k, v, k_lens=context_lens)
 
         # output
         x = x.flatten(2)
@@ -252,10 +484,16 @@ WAN_CROSSATTENTION_CLASSES = {
 
 
 def mul_add(x, y, z):
+    if z.dim() == 4:
+        # per-frame modulation [B, F, 1, C], broadcast over the tokens [B, L, C] of each frame
+        x, y = x.unflatten(1, (z.shape[1], -1)), y.unflatten(1, (z.shape[1], -1))
+        return (x.float() + y.float() * z.float()).flatten(1, 2)
     return x.float() + y.float() * z.float()
 
 
 def mul_add_add(x, y, z):
+    if y.dim() == 4:
+        return (x.float().unflatten(1, (y.shape[1], -1)) * (1 + y) + z).flatten(1, 2)
     return x.float() * (1 + y) + z
 
 
@@ -306,15 +544,28 @@ class WanAttentionBlock(nn.Module):
         freqs,
         context,
         block_mask,
+        context_lens=None,
+        context_key=None,
+        kv_cache_key=None,
+        num_clean_frames=0,
+        token_index=None,
+        output_index=None,
     ):
         r"""
         Args:
             x(Tensor): Shape [B, L, C]
-            e(Tensor): Shape [B, 6, C]
+            e(Tensor): Shape [B, 6, C], or [B, 6, F, C] per frame or [B, 6, L, C] per token
             seq_lens(Tensor): Shape [B], length of each sequence in batch
             grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
-            freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
+            freqs(Tuple[Tensor, Tensor]): Rope cos and sin tables of the grid, shape [L, 1, C / num_heads / 2]
+            context_lens(Tensor, *optional*): Shape [B], number of valid text tokens of each sample
+            context_key(Hashable, *optional*): Cache key for the cross-attention keys and values
+            kv_cache_key(Hashable, *optional*): Cache key for the self-attention keys and values of the clean frames
+            num_clean_frames(`int`, *optional*): Number of leading clean frames, counting the cached ones
+            token_index(Tensor, *optional*): Positions in the grid of the tokens of `x`, all tokens if None
+            output_index(Tensor, *optional*): Indices of the tokens of `x` that are returned, all tokens if None
         """
+        per_token = e.dim() == 4 and e.shape[2] == x.shape[1]
         if e.dim() == 3:
             modulation = self.modulation  # 1, 6, dim
             with amp.autocast("cuda", dtype=torch.float32):
@@ -324,17 +575,33 @@ class WanAttentionBlock(nn.Module):
             with amp.autocast("cuda", dtype=torch.float32):
                 e = (modulation + e).chunk(6, dim=1)
             e = [ei.squeeze(1) for ei in e]
+            if not per_token:
+                # B, F, 1, dim, broadcast over the tokens of each frame by the mul_add helpers
+                e = [ei.unsqueeze(2) for ei in e]
 
         # self-attention
         out = mul_add_add_compile(self.norm1(x), e[1], e[0])
-        y = self.self_attn(out, grid_sizes, freqs, block_mask)
+        attn_kwargs = {}
+        if kv_cache_key is not None:
+            attn_kwargs.update(kv_cache_key=kv_cache_key, num_clean_frames=num_clean_frames)
+        if token_index is not None or output_index is not None:
+            attn_kwargs.update(token_index=token_index, output_index=output_index)
+        y = self.self_attn(out, grid_sizes, freqs, block_mask, **attn_kwargs)
+        if output_index is not None:
+            # past the self-attention, the other tokens are not needed anymore
+            if per_token:
+                e = [ei[:, output_index] for ei in e]
+            elif e[0].dim() == 4:
+                frame_seqlen = x.shape[1] // e[0].shape[1]
+                e = [ei[:, output_index[::frame_seqlen] // frame_seqlen] for ei in e]
+            x = x[:, output_index]
         with amp.autocast("cuda", dtype=torch.float32):
             x = mul_add_compile(x, y, e[2])
 
         # cross-attention & ffn function
         def cross_attn_ffn(x, context, e):
             dtype = context.dtype
-            x = x + self.cross_attn(self.norm3(x.to(dtype)), context)
+            x = x + self.cross_attn(self.norm3(x.to(dtype)), context, context_lens, context_key)
             y = self.ffn(mul_add_add_compile(self.norm2(x), e[4], e[3]).to(dtype))
             with amp.autocast("cuda", dtype=torch.float32):
                 x = mul_add_compile(x, y, e[5])
@@ -364,7 +631,7 @@ class Head(nn.Module):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
-            e(Tensor): Shape [B, C]
+            e(Tensor): Shape [B, C], or [B, F, C] per frame or [B, L1, C] per token
         """
         with amp.autocast("cuda", dtype=torch.float32):
             if e.dim() == 2:
@@ -375,8 +642,12 @@ class Head(nn.Module):
                 modulation = self.modulation.unsqueeze(2)  # 1, 2, seq, dim
                 e = (modulation + e.unsqueeze(1)).chunk(2, dim=1)
                 e = [ei.squeeze(1) for ei in e]
+                if e[0].shape[1] != x.shape[1]:
+                    # per frame, broadcast over the tokens of each frame
+                    e = [ei.unsqueeze(2) for ei in e]
+                    x = x.unflatten(1, (e[0].shape[1], -1))
             x = self.head(self.norm(x) * (1 + e[1]) + e[0])
-        return x
+        return x.flatten(1, -2)
 
 
 class MLPProj(torch.nn.Module):
@@ -484,7 +755,14 @@ class WanModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
         self.num_frame_per_block = 1
         self.flag_causal_attention = False
         self.block_mask = None
+        self._block_mask_cache = OrderedDict()
         self.enable_teacache = False
+        self.teacache_settings = None
+        self.enable_context_cache = False
+        self._context_cache = {}
+        self.enable_causal_kv_cache = False
+        self.enable_token_subset = False
+        self.num_subset_blocks = 0
 
         # embeddings
         self.patch_embedding = nn.Conv3d(in_dim, dim, kernel_size=patch_size, stride=patch_size)
@@ -509,13 +787,9 @@ class WanModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
         # head
         self.head = Head(dim, out_dim, patch_size, eps)
 
-        # buffers (don't use register_buffer otherwise dtype will be changed in to())
+        # rope tables (not buffers, otherwise their dtype would be changed in to())
         assert (dim % num_heads) == 0 and (dim // num_heads) % 2 == 0
-        d = dim // num_heads
-        self.freqs = torch.cat(
-            [rope_params(1024, d - 4 * (d // 6)), rope_params(1024, 2 * (d // 6)), rope_params(1024, 2 * (d // 6))],
-            dim=1,
-        )
+        self.rope = WanRotaryEmbedding(dim // num_heads)
 
         if model_type == "i2v":
             self.img_emb = MLPProj(1280, dim)
@@ -523,6 +797,7 @@ class WanModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
         self.gradient_checkpointing = False
 
         self.cpu_offloading = False
+        self.block_offloader = None
 
         self.inject_sample_info = inject_sample_info
         # initialize weights
@@ -539,87 +814,228 @@ class WanModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
 
     @staticmethod
     def _prepare_blockwise_causal_attn_mask(
-        device: torch.device | str, num_frames: int = 21, frame_seqlen: int = 1560, num_frame_per_block=1
+        device: torch.device | str,
+        num_frames: int = 21,
+        frame_seqlen: int = 1560,
+        num_frame_per_block=1,
+        num_cached_frames=0,
     ) -> BlockMask:
         """
         we will divide the token sequence into the following format
         [1 latent frame] [1 latent frame] ... [1 latent frame]
         We use flexattention to construct the attention mask
+        The queries start after the `num_cached_frames` first frames, whose keys and values come from the cache
         """
         total_length = num_frames * frame_seqlen
+        block_length = frame_seqlen * num_frame_per_block
+        q_offset = num_cached_frames * frame_seqlen
+        q_length = total_length - q_offset
 
         # we do right padding to get to a multiple of 128
-        padded_length = math.ceil(total_length / 128) * 128 - total_length
+        padded_q_length = math.ceil(q_length / 128) * 128
+        padded_kv_length = math.ceil(total_length / 128) * 128
+        num_q_blocks, num_kv_blocks = padded_q_length // 128, padded_kv_length // 128
 
-        ends = torch.zeros(total_length + padded_length, device=device, dtype=torch.long)
+        ends = torch.zeros(padded_q_length, device=device, dtype=torch.long)
 
         # Block-wise causal mask will attend to all elements that are before the end of the current chunk
-        frame_indices = torch.arange(start=0, end=total_length, step=frame_seqlen * num_frame_per_block, device=device)
-
-        for tmp in frame_indices:
-            ends[tmp : tmp + frame_seqlen * num_frame_per_block] = tmp + frame_seqlen * num_frame_per_block
+        ends[:q_length] = (torch.arange(q_offset, total_length, device=device) // block_length + 1) * block_length
 
         def attention_mask(b, h, q_idx, kv_idx):
-            return (kv_idx < ends[q_idx]) | (q_idx == kv_idx)
+            return (kv_idx < ends[q_idx]) | (q_idx + q_offset == kv_idx)
             # return ((kv_idx < total_length) & (q_idx < total_length))  | (q_idx == kv_idx) # bidirectional mask
 
-        block_mask = create_block_mask(
-            attention_mask,
-            B=None,
-            H=None,
-            Q_LEN=total_length + padded_length,
-            KV_LEN=total_length + padded_length,
-            _compile=False,
-            device=device,
+        # the mask is built from the 128 x 128 tiles instead of the dense mask of all queries and keys: the tiles of
+        # each query tile up to the smallest end of its queries are fully attended, the following ones up to the
+        # largest end, or the diagonal of the padding queries, are partially attended
+        tile_ends = ends.view(num_q_blocks, 128)
+        num_full = (tile_ends.min(dim=1).values // 128).clamp(max=num_kv_blocks)
+        diagonal_end = (torch.arange(num_q_blocks, device=device) * 128 + 127 + q_offset) // 128 + 1
+        num_any = torch.maximum((tile_ends.max(dim=1).values + 127) // 128, diagonal_end).clamp(max=num_kv_blocks)
+        kv_range = torch.arange(num_kv_blocks, device=device)
+        kv_indices = (num_full[:, None] + kv_range).clamp(max=num_kv_blocks - 1)
+        block_mask = BlockMask.from_kv_blocks(
+            (num_any - num_full)[None, None].int(),
+            kv_indices[None, None].int(),
+            num_full[None, None].int(),
+            kv_range.expand(num_q_blocks, -1)[None, None].int().contiguous(),
+            BLOCK_SIZE=128,
+            mask_mod=attention_mask,
         )
 
         return block_mask
 
-    def initialize_teacache(self, enable_teacache=True, num_steps=25, teacache_thresh=0.15, use_ret_steps=False, ckpt_dir=''):
+    def get_block_mask(self, grid_sizes, device, num_cached_frames=0):
+        """
+        Return the block-wise causal mask for the given grid, built once per
+        (F, H, W, num_frame_per_block, num_cached_frames, device) and reused for later forwards. The
+        `BLOCK_MASK_CACHE_SIZE` most recently used masks are kept.
+        """
+        frame_num, height, width = grid_sizes.tolist()
+        key = (frame_num, height, width, self.num_frame_per_block, num_cached_frames, str(device))
+        if key in self._block_mask_cache:
+            self._block_mask_cache.move_to_end(key)
+            return self._block_mask_cache[key]
+        while len(self._block_mask_cache) >= BLOCK_MASK_CACHE_SIZE:
+            self._block_mask_cache.popitem(last=False)
+        self._block_mask_cache[key] = self._prepare_blockwise_causal_attn_mask(
+            device,
+            num_frames=frame_num,
+            frame_seqlen=height * width,
+            num_frame_per_block=self.num_frame_per_block,
+            num_cached_frames=num_cached_frames,
+        )
+        return self._block_mask_cache[key]
+
+    def set_context_cache(self, enable_context_cache=True):
+        """
+        Cache the projected text/image context and the per-block cross-attention keys and values.
+        The cache lives until `clear_context_cache` is called, which pipelines do for every new prompt.
+        """
+        self.enable_context_cache = enable_context_cache
+        self.clear_context_cache()
+
+    def clear_context_cache(self):
+        self._context_cache = {}
+        for block in self.blocks:
+            block.cross_attn.kv_cache = {}
+
+    def set_block_offload(self, device, num_resident_blocks=2):
+        """
+        Keep the blocks in pinned host memory and stream them to `device` while they run, with
+        `num_resident_blocks` of them on the device at a time, see `BlockOffloader`.
+        `to()` and `cpu()` then only move the other modules.
+        """
+        if self.block_offloader is not None:
+            self.block_offloader.remove()
+        self.block_offloader = BlockOffloader(self.blocks, device, num_resident_blocks)
+
+    def _apply(self, fn, recurse=True):
+        if getattr(self, "block_offloader", None) is None:
+            return super()._apply(fn, recurse)
+        # the block offloader owns the placement of the blocks, hide them from to(), cpu() and the like
+        blocks = self._modules["blocks"]
+        self._modules["blocks"] = None
+        try:
+            return super()._apply(fn, recurse)
+        finally:
+            self._modules["blocks"] = blocks
+
+    def set_causal_kv_cache(self, enable_causal_kv_cache=True):
+        """
+        With causal attention, cache the self-attention keys and values of the clean frames passed to `forward` as
+        `num_clean_frames`, so that the following forwards only run the frames after them. The cache is per context
+        and lives until `clear_causal_kv_cache` is called, which pipelines do whenever the frames shift.
+        """
+        self.enable_causal_kv_cache = enable_causal_kv_cache
+        self.clear_causal_kv_cache()
+
+    def set_token_subset(self, enable_token_subset=True, num_blocks=0):
+        """
+        Let the pipelines pass the frames they use the outputs of as `output_frames`, the head and unpatchify then only
+        run on their tokens. The last `num_blocks` blocks do too without causal attention and TeaCache: the first of
+        them still attends the keys and values of all tokens, so the outputs are unchanged with one block, while with
+        more the last ones only attend the output frames.
+        """
+        self.enable_token_subset = enable_token_subset
+        self.num_subset_blocks = num_blocks
+
+    def clear_causal_kv_cache(self):
+        for block in self.blocks:
+            block.self_attn.frame_kv_cache = {}
+
+    def num_cached_frames(self, kv_cache_key, frame_seqlen):
+        cached = self.blocks[0].self_attn.frame_kv_cache.get(kv_cache_key)
+        return 0 if cached is None else cached[0].shape[1] // frame_seqlen
+
+    @staticmethod
+    def _tensor_key(context, clip_fea=None):
+        key = (context.data_ptr(), context._version, tuple(context.shape))
+        if clip_fea is not None:
+            key += (clip_fea.data_ptr(), clip_fea._version, tuple(clip_fea.shape))
+        return key
+
+    def get_context_key(self, context, clip_fea=None):
+        if not self.enable_context_cache:
+            return None
+        return self._tensor_key(context, clip_fea)
+
+    def embed_context(self, context, clip_fea=None, context_key=None):
+        if context_key is not None and context_key in self._context_cache:
+            return self._context_cache[context_key]
+
+        context = self.text_embedding(context)
+        if clip_fea is not None:
+            context_clip = self.img_emb(clip_fea)  # bs x 257 x dim
+            context = torch.concat([context_clip, context], dim=1)
+
+        if context_key is not None:
+            self._context_cache[context_key] = context
+        return context
+
+    def initialize_teacache(
+        self,
+        enable_teacache=True,
+        teacache_thresh=0.15,
+        use_ret_steps=False,
+        ckpt_dir='',
+        coefficients=None,
+        frame_block_size=None,
+    ):
+        """
+        Enable TeaCache for the generations of the pipelines, which create a `TeaCache` state with `new_teacache` for
+        every sampling loop.
+
+        The rescale polynomial of the relative change of the modulated input is, in order: `coefficients`, the one of
+        the `TEACACHE_COEFFICIENTS_FILE` in `ckpt_dir` written by calibrate_teacache.py, the built-in one of the
+        released model that `ckpt_dir` names.
+
+        With `frame_block_size`, the per-frame timesteps of diffusion forcing get one skip decision per block of that
+        many latent frames instead of one per call, see `_frame_block_teacache`.
+        """
         self.enable_teacache = enable_teacache
+        if not enable_teacache:
+            self.teacache_settings = None
+            return
         print('using teacache')
-        self.cnt = 0
-        self.num_steps = num_steps
-        self.teacache_thresh = teacache_thresh
-        self.accumulated_rel_l1_distance_even = 0
-        self.accumulated_rel_l1_distance_odd = 0
-        self.previous_e0_even = None
-        self.previous_e0_odd = None
-        self.previous_residual_even = None
-        self.previous_residual_odd = None
-        self.use_ref_steps = use_ret_steps
-        if "I2V" in ckpt_dir:
-            if use_ret_steps:
-                if '540P' in ckpt_dir:
-                    self.coefficients = [ 2.57151496e+05, -3.54229917e+04,  1.40286849e+03, -1.35890334e+01, 1.32517977e-01]
-                if '720P' in ckpt_dir:
-                    self.coefficients = [ 8.10705460e+03,  2.13393892e+03, -3.72934672e+02,  1.66203073e+01, -4.17769401e-02]
-                self.ret_steps = 5*2
-                self.cutoff_steps = num_steps*2
-            else:
-                if '540P' in ckpt_dir:
-                    self.coefficients = [-3.02331670e+02,  2.23948934e+02, -5.25463970e+01,  5.87348440e+00, -2.01973289e-01]
-                if '720P' in ckpt_dir:
-                    self.coefficients = [-114.36346466,   65.26524496,  -18.82220707,    4.91518089,   -0.23412683]
-                self.ret_steps = 1*2
-                self.cutoff_steps = num_steps*2 - 2
-        else:
-            if use_ret_steps:
-                if '1.3B' in ckpt_dir:
-                    self.coefficients = [-5.21862437e+04, 9.23041404e+03, -5.28275948e+02, 1.36987616e+01, -4.99875664e-02]
-                if '14B' in ckpt_dir:
-                    self.coefficients = [-3.03318725e+05, 4.90537029e+04, -2.65530556e+03, 5.87365115e+01, -3.15583525e-01]
-                self.ret_steps = 5*2
-                self.cutoff_steps = num_steps*2
-            else:
-                if '1.3B' in ckpt_dir:
-                    self.coefficients = [2.39676752e+03, -1.31110545e+03,  2.01331979e+02, -8.29855975e+00, 1.37887774e-01]
-                if '14B' in ckpt_dir:
-                    self.coefficients = [-5784.54975374,  5449.50911966, -1811.16591783,   256.27178429, -13.02252404]
-                self.ret_steps = 1*2
-                self.cutoff_steps = num_steps*2 - 2
-
-    def forward(self, x, t, context, clip_fea=None, y=None, fps=None):
+        if coefficients is None:
+            coefficients = load_teacache_coefficients(ckpt_dir, use_ret_steps)
+        if coefficients is None:
+            coefficients = builtin_teacache_coefficients(ckpt_dir, use_ret_steps)
+        if coefficients is None:
+            raise ValueError(
+                f"No TeaCache coefficients for {ckpt_dir!r}, fit them with calibrate_teacache.py or pass `coefficients`"
+            )
+        self.teacache_settings = dict(
+            teacache_thresh=teacache_thresh,
+            coefficients=list(coefficients),
+            use_ret_steps=use_ret_steps,
+            frame_block_size=frame_block_size,
+        )
+
+    def new_teacache(self, num_steps):
+        """
+        Returns the `TeaCache` state of a sampling loop of `num_steps` steps, or None if TeaCache is not enabled.
+        """
+        if not self.enable_teacache:
+            return None
+        return TeaCache(num_steps, **self.teacache_settings)
+
+    def forward(
+        self,
+        x,
+        t,
+        context,
+        clip_fea=None,
+        y=None,
+        fps=None,
+        batched_cfg=False,
+        context_lens=None,
+        num_clean_frames=0,
+        output_frames=None,
+        frame_offset=0,
+        teacache=None,
+    ):
         r"""
         Forward pass through the diffusion model
 
@@ -636,6 +1052,25 @@ class WanModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
                 CLIP image features for image-to-video mode
             y (List[Tensor], *optional*):
                 Conditional video inputs for image-to-video mode, same shape as x
+            batched_cfg (`bool`, *optional*, defaults to False):
+                Whether the batch holds the conditional and unconditional halves of one guidance step,
+                so that a single call advances the teacache counter by both passes
+            context_lens (Tensor, *optional*):
+                Number of valid tokens of each text embedding, shape [B]. The cross-attention ignores the
+                padding after them, all tokens are attended if None
+            num_clean_frames (`int`, *optional*, defaults to 0):
+                Number of leading latent frames of x that are fully denoised. With causal attention and the causal
+                kv cache enabled, their self-attention keys and values are cached, and the frames already in the
+                cache are not run again: their outputs are zero
+            output_frames (Tensor, *optional*):
+                Boolean mask of the latent frames of x whose outputs are used, shape [F]. The head only runs on
+                their tokens, and the last `num_subset_blocks` blocks, see `set_token_subset`. The outputs of the
+                other frames are zero. All frames are output if None
+            frame_offset (`int`, *optional*, defaults to 0):
+                Index in the generated latents of the first frame of x. The per frame block TeaCache matches the
+                blocks of calls whose frame windows differ by it
+            teacache (`TeaCache`, *optional*):
+                TeaCache state of the generation, see `new_teacache`. The blocks always run if None
 
         Returns:
             List[Tensor]:
@@ -645,8 +1080,6 @@ class WanModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
             assert clip_fea is not None and y is not None
         # params
         device = self.patch_embedding.weight.device
-        if self.freqs.device != device:
-            self.freqs = self.freqs.to(device)
 
         if y is not None:
             x = torch.cat([x, y], dim=1)
@@ -657,17 +1090,7 @@ class WanModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
         x = x.flatten(2).transpose(1, 2)
 
         if self.flag_causal_attention:
-            frame_num = grid_sizes[0]
-            height = grid_sizes[1]
-            width = grid_sizes[2]
-            block_num = frame_num // self.num_frame_per_block
-            range_tensor = torch.arange(block_num).view(-1, 1)
-            range_tensor = range_tensor.repeat(1, self.num_frame_per_block).flatten()
-            casual_mask = range_tensor.unsqueeze(0) <= range_tensor.unsqueeze(1)  # f, f
-            casual_mask = casual_mask.view(frame_num, 1, 1, frame_num, 1, 1).to(x.device)
-            casual_mask = casual_mask.repeat(1, height, width, 1, height, width)
-            casual_mask = casual_mask.reshape(frame_num * height * width, frame_num * height * width)
-            self.block_mask = casual_mask.unsqueeze(0).unsqueeze(0)
+            self.block_mask = self.get_block_mask(grid_sizes, x.device)
 
         # time embeddings
         with amp.autocast("cuda", dtype=torch.float32):
@@ -692,88 +1115,205 @@ class WanModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
                     e0 = e0 + self.fps_projection(fps_emb).unflatten(1, (6, self.dim))
 
             if _flag_df:
-                e = e.view(b, f, 1, 1, self.dim)
-                e0 = e0.view(b, f, 1, 1, 6, self.dim)
-                e = e.repeat(1, 1, grid_sizes[1], grid_sizes[2], 1).flatten(1, 3)
-                e0 = e0.repeat(1, 1, grid_sizes[1], grid_sizes[2], 1, 1).flatten(1, 3)
-                e0 = e0.transpose(1, 2).contiguous()
+                # per frame, the blocks and the head broadcast them over the tokens of each frame
+                e = e.view(b, f, self.dim)
+                e0 = e0.view(b, f, 6, self.dim).transpose(1, 2)
 
             assert e.dtype == torch.float32 and e0.dtype == torch.float32
 
-        # context
-        context = self.text_embedding(context)
+        # the frames whose keys and values are cached are skipped, the others attend them from the cache
+        kv_cache_key = None
+        full_grid_sizes = grid_sizes
+        num_cached_frames = num_cached_tokens = 0
+        use_kv_cache = self.flag_causal_attention and self.enable_causal_kv_cache and teacache is None
+        if num_clean_frames > 0 and use_kv_cache:
+            num_clean_frames -= num_clean_frames % self.num_frame_per_block
+            kv_cache_key = self._tensor_key(context, clip_fea)
+            frame_seqlen = grid_sizes[1].item() * grid_sizes[2].item()
+            num_cached_frames = self.num_cached_frames(kv_cache_key, frame_seqlen)
+            if num_cached_frames > num_clean_frames:
+                # the frames shifted since the cache was filled
+                for block in self.blocks:
+                    block.self_attn.frame_kv_cache.pop(kv_cache_key, None)
+                num_cached_frames = 0
+            num_cached_tokens = num_cached_frames * frame_seqlen
+            x = x[:, num_cached_tokens:]
+            if _flag_df:
+                e = e[:, num_cached_frames:]
+                e0 = e0[:, :, num_cached_frames:]
+            grid_sizes = torch.tensor([grid_sizes[0] - num_cached_frames, grid_sizes[1], grid_sizes[2]])
+            self.block_mask = self.get_block_mask(full_grid_sizes, x.device, num_cached_frames)
 
-        if clip_fea is not None:
-            context_clip = self.img_emb(clip_fea)  # bs x 257 x dim
-            context = torch.concat([context_clip, context], dim=1)
+        # context
+        context_key = self.get_context_key(context, clip_fea)
+        context = self.embed_context(context, clip_fea, context_key)
 
         # arguments
-        kwargs = dict(e=e0, grid_sizes=grid_sizes, freqs=self.freqs, context=context, block_mask=self.block_mask)
-        if self.enable_teacache:
-            modulated_inp = e0 if self.use_ref_steps else e
-            # teacache
-            if self.cnt%2==0: # even -> conditon
-                self.is_even = True
-                if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                    should_calc_even = True
-                    self.accumulated_rel_l1_distance_even = 0
-                else:
-                    rescale_func = np.poly1d(self.coefficients)
-                    self.accumulated_rel_l1_distance_even += rescale_func(((modulated_inp-self.previous_e0_even).abs().mean() / self.previous_e0_even.abs().mean()).cpu().item())
-                    if self.accumulated_rel_l1_distance_even < self.teacache_thresh:
-                        should_calc_even = False
-                    else:
-                        should_calc_even = True
-                        self.accumulated_rel_l1_distance_even = 0
-                self.previous_e0_even = modulated_inp.clone()
-
-            else: # odd -> unconditon
-                self.is_even = False
-                if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
-                    should_calc_odd = True
-                    self.accumulated_rel_l1_distance_odd = 0
-                else: 
-                    rescale_func = np.poly1d(self.coefficients)
-                    self.accumulated_rel_l1_distance_odd += rescale_func(((modulated_inp-self.previous_e0_odd).abs().mean() / self.previous_e0_odd.abs().mean()).cpu().item())
-                    if self.accumulated_rel_l1_distance_odd < self.teacache_thresh:
-                        should_calc_odd = False
-                    else:
-                        should_calc_odd = True
-                        self.accumulated_rel_l1_distance_odd = 0
-                self.previous_e0_odd = modulated_inp.clone()
-
-        if self.enable_teacache: 
-            if self.is_even:
-                if not should_calc_even:
-                    x += self.previous_residual_even
-                else:
-                    ori_x = x.clone()
-                    for block in self.blocks:
-                        x = block(x, **kwargs)
-                    self.previous_residual_even = x - ori_x
+        kwargs = dict(
+            e=e0,
+            grid_sizes=grid_sizes,
+            # the rope tables of the uncached frames start at the first frame after the cached ones
+            freqs=self.rope.tables(grid_sizes, device, num_cached_frames),
+            context=context,
+            block_mask=self.block_mask,
+            context_lens=context_lens,
+            context_key=context_key,
+        )
+        if kv_cache_key is not None:
+            kwargs.update(kv_cache_key=kv_cache_key, num_clean_frames=num_clean_frames)
+
+        # tokens of the frames whose outputs are used
+        output_index = None
+        if output_frames is not None:
+            output_frames = output_frames[num_cached_frames:]
+        if output_frames is not None and output_frames.any() and not output_frames.all():
+            frame_seqlen = grid_sizes[1].item() * grid_sizes[2].item()
+            output_frames = output_frames.nonzero()[:, 0].to(device)
+            output_index = (output_frames[:, None] * frame_seqlen + torch.arange(frame_seqlen, device=device)).flatten()
+        num_subset_blocks = 0
+        if output_index is not None and not self.flag_causal_attention and teacache is None:
+            num_subset_blocks = min(self.num_subset_blocks, len(self.blocks))
+
+        if teacache is not None and teacache.frame_block_size:
+            x = self._frame_block_teacache(teacache, x, kwargs, e, e0, grid_sizes, frame_offset)
+            teacache.step(batched_cfg)
+        elif teacache is not None:
+            stream = teacache.stream
+            if teacache.should_calc(e0 if teacache.use_ret_steps else e):
+                ori_x = x.clone()
+                for block in self.blocks:
+                    x = block(x, **kwargs)
+                teacache.previous_residual[stream] = x - ori_x
             else:
-                if not should_calc_odd:
-                    x += self.previous_residual_odd
-                else:
-                    ori_x = x.clone()
-                    for block in self.blocks:
-                        x = block(x, **kwargs)
-                    self.previous_residual_odd = x - ori_x
-
-            self.cnt += 1
-            if self.cnt >= self.num_steps:
-                self.cnt = 0
+                x += teacache.previous_residual[stream]
+            teacache.step(batched_cfg)
         else:
-            for block in self.blocks:
+            num_full_blocks = len(self.blocks) - num_subset_blocks
+            for block in self.blocks[:num_full_blocks]:
                 x = block(x, **kwargs)
+            if num_subset_blocks > 0:
+                x = self.blocks[num_full_blocks](x, **kwargs, output_index=output_index)
+                if _flag_df:
+                    kwargs["e"] = e0[:, :, output_frames]
+                for block in self.blocks[num_full_blocks + 1 :]:
+                    x = block(x, **kwargs, token_index=output_index)
 
+        if output_index is not None:
+            if num_subset_blocks == 0:
+                x = x[:, output_index]
+            if _flag_df:
+                e = e[:, output_frames]
         x = self.head(x, e)
+        if output_index is not None:
+            output = x.new_zeros(x.shape[0], full_grid_sizes.prod().item(), x.shape[2])
+            output[:, num_cached_tokens + output_index] = x
+            x = output
+        elif num_cached_tokens > 0:
+            x = torch.cat([x.new_zeros(x.shape[0], num_cached_tokens, x.shape[2]), x], dim=1)
 
         # unpatchify
-        x = self.unpatchify(x, grid_sizes)
+        x = self.unpatchify(x, full_grid_sizes)
 
         return x.float()
 
+    def _frame_block_teacache(self, teacache, x, kwargs, e, e0, grid_sizes, frame_offset):
+        r"""
+        TeaCache with one skip decision per block of `teacache.frame_block_size` latent frames. The frames of a
+        diffusion forcing step sit at different noise levels: the blocks whose modulated input barely moved since the
+        previous call of the same stream add their cached residual, the others are run through the blocks.
+
+        With causal attention, the frames up to the last block that is run are run, which is exact since no frame
+        attends the ones after it. Otherwise only the tokens of the blocks that are run go through the transformer
+        blocks: they attend the tokens of all frames in the first block, and only each other in the later ones.
+
+        Returns:
+            Tensor: Output of the transformer blocks for all tokens of x
+        """
+        assert e.ndim == 3, "per frame block TeaCache needs the per-frame timesteps of diffusion forcing"
+        states = teacache.frame_blocks[teacache.stream]
+        num_frames, frame_seqlen = grid_sizes[0].item(), grid_sizes[1].item() * grid_sizes[2].item()
+        block_size = teacache.frame_block_size
+
+        # (block, first frame, end frame) of the frame blocks of x, numbered from the first generated frame
+        blocks = []
+        frame = 0
+        while frame < num_frames:
+            index = (frame_offset + frame) // block_size
+            end = min(num_frames, (index + 1) * block_size - frame_offset)
+            blocks.append((index, frame, end))
+            frame = end
+
+        compute = []
+        for index, start, end in blocks:
+            modulated_inp = e0[:, :, start:end] if teacache.use_ret_steps else e[:, start:end]
+            state = states.get(index)
+            should_calc = teacache.force_calc or state is None or state["input"].shape != modulated_inp.shape
+            if not should_calc:
+                state["distance"] += teacache.distance(modulated_inp, state["input"])
+                should_calc = state["distance"] >= teacache.teacache_thresh
+            if should_calc:
+                state = states[index] = dict(distance=0, residual=None)
+            state["input"] = modulated_inp.clone()
+            compute.append(should_calc)
+
+        if all(compute):
+            ori_x = x.clone()
+            for block in self.blocks:
+                x = block(x, **kwargs)
+            residual = x - ori_x
+        elif any(compute):
+            if self.flag_causal_attention:
+                # the frames up to the end of the causal block of the last frame to compute
+                end_frame = max(end for (_, _, end), calc in zip(blocks, compute) if calc)
+                end_frame = min(num_frames, math.ceil(end_frame / self.num_frame_per_block) * self.num_frame_per_block)
+                compute = [calc or end <= end_frame for (_, _, end), calc in zip(blocks, compute)]
+                num_tokens = end_frame * frame_seqlen
+                prefix_grid_sizes = torch.tensor([end_frame, grid_sizes[1], grid_sizes[2]])
+                cos, sin = kwargs["freqs"]
+                prefix_kwargs = dict(
+                    kwargs,
+                    e=e0[:, :, :end_frame],
+                    grid_sizes=prefix_grid_sizes,
+                    freqs=(cos[:num_tokens], sin[:num_tokens]),
+                    block_mask=self.get_block_mask(prefix_grid_sizes, x.device),
+                )
+                computed = x[:, :num_tokens]
+                for block in self.blocks:
+                    computed = block(computed, **prefix_kwargs)
+                computed_residual = computed - x[:, :num_tokens]
+            else:
+                frames = torch.cat(
+                    [torch.arange(start, end) for (_, start, end), calc in zip(blocks, compute) if calc]
+                ).to(x.device)
+                output_index = (frames[:, None] * frame_seqlen + torch.arange(frame_seqlen, device=x.device)).flatten()
+                computed = self.blocks[0](x, **kwargs, output_index=output_index)
+                subset_kwargs = dict(kwargs, e=e0[:, :, frames])
+                for block in self.blocks[1:]:
+                    computed = block(computed, **subset_kwargs, token_index=output_index)
+                computed_residual = computed - x[:, output_index]
+
+            # the residual of every block, the computed ones in order from computed_residual
+            residuals = []
+            offset = 0
+            for (index, start, end), calc in zip(blocks, compute):
+                length = (end - start) * frame_seqlen
+                if calc:
+                    residuals.append(computed_residual[:, offset : offset + length])
+                    offset += length
+                else:
+                    residuals.append(states[index]["residual"])
+            residual = torch.cat(residuals, dim=1)
+            # in the dtype of the output of the blocks, so that the computed frames match a full run
+            x = (x + residual).to(torch.bfloat16)
+        else:
+            residual = torch.cat([states[index]["residual"] for index, _, _ in blocks], dim=1)
+            x = (x + residual).to(torch.bfloat16)
+
+        for (index, start, end), calc in zip(blocks, compute):
+            if calc:
+                states[index]["residual"] = residual[:, start * frame_seqlen : end * frame_seqlen]
+        return x
+
     def unpatchify(self, x, grid_sizes):
         r"""
         Reconstruct video tensors from patch embeddings.
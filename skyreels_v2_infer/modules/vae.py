@@ -35,6 +35,33 @@ class CausalConv3d(nn.Conv3d):
         return super().forward(x)
 
 
+def push_frames(cache, x):
+    """
+    Shifts the last frames of `x` into the fixed-size frame buffer `cache` in place.
+    """
+    n, t = cache.shape[2], min(x.shape[2], cache.shape[2])
+    for i in range(n - t):
+        cache[:, :, i].copy_(cache[:, :, i + t])
+    cache[:, :, n - t :].copy_(x[:, :, -t:])
+
+
+def causal_conv(layer, x, feat_cache, feat_idx):
+    """
+    Applies the causal conv `layer` to a temporal chunk, continuing from the last CACHE_T input frames of the previous
+    chunks. They are kept in a per-layer buffer of fixed size that starts with zeros, which matches the zero padding
+    in front of the first chunk.
+    """
+    idx = feat_idx[0]
+    feat_idx[0] += 1
+    if layer._padding[4] == 0:
+        return layer(x)
+    if feat_cache[idx] is None:
+        feat_cache[idx] = x.new_zeros(*x.shape[:2], CACHE_T, *x.shape[3:])
+    out = layer(x, feat_cache[idx])
+    push_frames(feat_cache[idx], x)
+    return out
+
+
 class RMS_norm(nn.Module):
     def __init__(self, dim, channel_first=True, images=True, bias=False):
         super().__init__()
@@ -91,24 +118,11 @@ class Resample(nn.Module):
             if feat_cache is not None:
                 idx = feat_idx[0]
                 if feat_cache[idx] is None:
-                    feat_cache[idx] = "Rep"
+                    # the first frame is not upsampled in time and the following chunks see zeros in front of them
+                    feat_cache[idx] = x.new_zeros(b, c, CACHE_T, h, w)
                     feat_idx[0] += 1
                 else:
-
-                    cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                    if cache_x.shape[2] < 2 and feat_cache[idx] is not None and feat_cache[idx] != "Rep":
-                        # cache last frame of last two chunk
-                        cache_x = torch.cat(
-                            [feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2
-                        )
-                    if cache_x.shape[2] < 2 and feat_cache[idx] is not None and feat_cache[idx] == "Rep":
-                        cache_x = torch.cat([torch.zeros_like(cache_x).to(cache_x.device), cache_x], dim=2)
-                    if feat_cache[idx] == "Rep":
-                        x = self.time_conv(x)
-                    else:
-                        x = self.time_conv(x, feat_cache[idx])
-                    feat_cache[idx] = cache_x
-                    feat_idx[0] += 1
+                    x = causal_conv(self.time_conv, x, feat_cache, feat_idx)
 
                     x = x.reshape(b, 2, c, t, h, w)
                     x = torch.stack((x[:, 0, :, :, :, :], x[:, 1, :, :, :, :]), 3)
@@ -122,17 +136,12 @@ class Resample(nn.Module):
             if feat_cache is not None:
                 idx = feat_idx[0]
                 if feat_cache[idx] is None:
-                    feat_cache[idx] = x.clone()
+                    feat_cache[idx] = x[:, :, -1:].clone()
                     feat_idx[0] += 1
                 else:
-
-                    cache_x = x[:, :, -1:, :, :].clone()
-                    # if cache_x.shape[2] < 2 and feat_cache[idx] is not None and feat_cache[idx]!='Rep':
-                    #     # cache last frame of last two chunk
-                    #     cache_x = torch.cat([feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2)
-
-                    x = self.time_conv(torch.cat([feat_cache[idx][:, :, -1:, :, :], x], 2))
-                    feat_cache[idx] = cache_x
+                    x_in = torch.cat([feat_cache[idx], x], 2)
+                    push_frames(feat_cache[idx], x)
+                    x = self.time_conv(x_in)
                     feat_idx[0] += 1
         return x
 
@@ -182,16 +191,7 @@ class ResidualBlock(nn.Module):
         h = self.shortcut(x)
         for layer in self.residual:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat(
-                        [feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2
-                    )
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
-                feat_idx[0] += 1
+                x = causal_conv(layer, x, feat_cache, feat_idx)
             else:
                 x = layer(x)
         return x + h
@@ -291,14 +291,7 @@ class Encoder3d(nn.Module):
 
     def forward(self, x, feat_cache=None, feat_idx=[0]):
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2)
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
-            feat_idx[0] += 1
+            x = causal_conv(self.conv1, x, feat_cache, feat_idx)
         else:
             x = self.conv1(x)
 
@@ -319,16 +312,7 @@ class Encoder3d(nn.Module):
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat(
-                        [feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2
-                    )
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
-                feat_idx[0] += 1
+                x = causal_conv(layer, x, feat_cache, feat_idx)
             else:
                 x = layer(x)
         return x
@@ -390,14 +374,7 @@ class Decoder3d(nn.Module):
     def forward(self, x, feat_cache=None, feat_idx=[0]):
         ## conv1
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2)
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
-            feat_idx[0] += 1
+            x = causal_conv(self.conv1, x, feat_cache, feat_idx)
         else:
             x = self.conv1(x)
 
@@ -418,16 +395,7 @@ class Decoder3d(nn.Module):
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat(
-                        [feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2
-                    )
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
-                feat_idx[0] += 1
+                x = causal_conv(layer, x, feat_cache, feat_idx)
             else:
                 x = layer(x)
         return x
@@ -441,6 +409,32 @@ def count_conv3d(model):
     return count
 
 
+def _tile_starts(size, tile, overlap):
+    """
+    Start offsets of the tiles covering `size`, the last tile is aligned to the end.
+    """
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, tile - overlap))
+    return starts + [size - tile]
+
+
+def _blend_weight(shape, start, size, overlap, device):
+    """
+    Blending weight of a tile: linear ramps of `overlap` pixels on the sides shared with neighbouring tiles.
+    """
+    weights = []
+    for length, offset, total in zip(shape, start, size):
+        weight = torch.ones(length, device=device)
+        ramp = torch.arange(1, overlap + 1, device=device) / (overlap + 1)
+        if overlap > 0 and offset > 0:
+            weight[:overlap] = ramp
+        if overlap > 0 and offset + length < total:
+            weight[-overlap:] = ramp.flip(0)
+        weights.append(weight)
+    return (weights[0][:, None] * weights[1][None, :]).view(1, 1, 1, *shape)
+
+
 class WanVAE_(nn.Module):
     def __init__(
         self,
@@ -484,14 +478,16 @@ class WanVAE_(nn.Module):
         for i in range(iter_):
             self._enc_conv_idx = [0]
             if i == 0:
-                out = self.encoder(x[:, :, :1, :, :], feat_cache=self._enc_feat_map, feat_idx=self._enc_conv_idx)
+                out_ = self.encoder(x[:, :, :1, :, :], feat_cache=self._enc_feat_map, feat_idx=self._enc_conv_idx)
+                # every chunk encodes to the same number of latent frames, write them into one preallocated tensor
+                out = out_.new_empty(*out_.shape[:2], iter_ * out_.shape[2], *out_.shape[3:])
             else:
                 out_ = self.encoder(
                     x[:, :, 1 + 4 * (i - 1) : 1 + 4 * i, :, :],
                     feat_cache=self._enc_feat_map,
                     feat_idx=self._enc_conv_idx,
                 )
-                out = torch.cat([out, out_], 2)
+            out[:, :, i * out_.shape[2] : (i + 1) * out_.shape[2]] = out_
         mu, log_var = self.conv1(out).chunk(2, dim=1)
         if isinstance(scale[0], torch.Tensor):
             mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(1, self.z_dim, 1, 1, 1)
@@ -500,8 +496,17 @@ class WanVAE_(nn.Module):
         self.clear_cache()
         return mu
 
-    def decode(self, z, scale):
-        self.clear_cache()
+    def decode(self, z, scale, first_chunk=True, last_chunk=True):
+        # decoding a video chunk by chunk gives the same frames as a single call as long as the causal cache is kept
+        # in between: only the first chunk starts from an empty cache and only the last one releases it
+        if first_chunk:
+            self.clear_cache()
+        out = self._decode(z, scale)
+        if last_chunk:
+            self.clear_cache()
+        return out
+
+    def _decode(self, z, scale):
         # z: [b,c,t,h,w]
         if isinstance(scale[0], torch.Tensor):
             z = z / scale[1].view(1, self.z_dim, 1, 1, 1) + scale[0].view(1, self.z_dim, 1, 1, 1)
@@ -511,14 +516,64 @@ class WanVAE_(nn.Module):
         x = self.conv2(z)
         for i in range(iter_):
             self._conv_idx = [0]
+            out_ = self.decoder(x[:, :, i : i + 1, :, :], feat_cache=self._feat_map, feat_idx=self._conv_idx)
             if i == 0:
-                out = self.decoder(x[:, :, i : i + 1, :, :], feat_cache=self._feat_map, feat_idx=self._conv_idx)
-            else:
-                out_ = self.decoder(x[:, :, i : i + 1, :, :], feat_cache=self._feat_map, feat_idx=self._conv_idx)
-                out = torch.cat([out, out_], 2)
-        self.clear_cache()
+                # only the first frame of a video decodes to a single frame, preallocate the output for the rest
+                scale_t = 2 ** sum(self.temperal_upsample)
+                out = out_.new_empty(*out_.shape[:2], out_.shape[2] + (iter_ - 1) * scale_t, *out_.shape[3:])
+                start = 0
+            out[:, :, start : start + out_.shape[2]] = out_
+            start += out_.shape[2]
         return out
 
+    def tiled_encode(self, x, scale, tile_size, tile_overlap):
+        """
+        Encodes `x` in spatial tiles of `tile_size` pixels overlapping by `tile_overlap` pixels, so that the peak
+        activation memory depends on the tile size instead of the frame size. Every tile runs its own causal cache and
+        the latents are blended linearly over the overlaps.
+        """
+        b, _, t, h, w = x.shape
+        tile, overlap = tile_size // 8, tile_overlap // 8
+        out, weight = None, None
+        for y in _tile_starts(h // 8, tile, overlap):
+            for x0 in _tile_starts(w // 8, tile, overlap):
+                mu = self.encode(x[:, :, :, y * 8 : (y + tile) * 8, x0 * 8 : (x0 + tile) * 8], scale)
+                if out is None:
+                    out = mu.new_zeros(b, mu.shape[1], mu.shape[2], h // 8, w // 8)
+                    weight = mu.new_zeros(1, 1, 1, h // 8, w // 8)
+                tile_weight = _blend_weight(mu.shape[3:], (y, x0), (h // 8, w // 8), overlap, mu.device)
+                out[:, :, :, y : y + tile, x0 : x0 + tile] += mu * tile_weight
+                weight[:, :, :, y : y + tile, x0 : x0 + tile] += tile_weight
+        return out / weight
+
+    def tiled_decode(self, z, scale, tile_size, tile_overlap, first_chunk=True, last_chunk=True):
+        """
+        Decodes `z` in spatial tiles of `tile_size` pixels overlapping by `tile_overlap` pixels and blends the frames
+        linearly over the overlaps. Every tile keeps its own causal cache, also across chunks decoded with
+        `first_chunk`/`last_chunk` set to False.
+        """
+        if first_chunk:
+            self.clear_cache()
+            self._tile_feat_maps = {}
+        b, _, t, h, w = z.shape
+        tile, overlap = tile_size // 8, tile_overlap // 8
+        out, weight = None, None
+        for y in _tile_starts(h, tile, overlap):
+            for x0 in _tile_starts(w, tile, overlap):
+                self._feat_map = self._tile_feat_maps.get((y, x0), [None] * self._conv_num)
+                frames = self._decode(z[:, :, :, y : y + tile, x0 : x0 + tile], scale)
+                self._tile_feat_maps[(y, x0)] = self._feat_map
+                if out is None:
+                    out = frames.new_zeros(b, frames.shape[1], frames.shape[2], h * 8, w * 8)
+                    weight = frames.new_zeros(1, 1, 1, h * 8, w * 8)
+                tile_weight = _blend_weight(frames.shape[3:], (y * 8, x0 * 8), (h * 8, w * 8), overlap * 8, z.device)
+                out[:, :, :, y * 8 : (y + tile) * 8, x0 * 8 : (x0 + tile) * 8] += frames * tile_weight
+                weight[:, :, :, y * 8 : (y + tile) * 8, x0 * 8 : (x0 + tile) * 8] += tile_weight
+        if last_chunk:
+            self._tile_feat_maps = {}
+            self.clear_cache()
+        return out / weight
+
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
         eps = torch.randn_like(std)
@@ -561,15 +616,20 @@ def _video_vae(pretrained_path=None, z_dim=None, device="cpu", **kwargs):
     with torch.device("meta"):
         model = WanVAE_(**cfg)
 
-    # load checkpoint
-    logging.info(f"loading {pretrained_path}")
-    model.load_state_dict(torch.load(pretrained_path, map_location=device), assign=True)
+    # load checkpoint, the model stays on the meta device without one
+    if pretrained_path is not None:
+        logging.info(f"loading {pretrained_path}")
+        model.load_state_dict(torch.load(pretrained_path, map_location=device), assign=True)
 
     return model
 
 
 class WanVAE:
-    def __init__(self, vae_pth="cache/vae_step_411000.pth", z_dim=16):
+    def __init__(self, vae_pth="cache/vae_step_411000.pth", z_dim=16, empty_weights=False):
+        """
+        With `empty_weights` the model is built on the meta device and `vae_pth` is not loaded, which is left to
+        `load_checkpoint`.
+        """
 
         mean = [
             -0.7571,
@@ -615,17 +675,39 @@ class WanVAE:
         # init model
         self.vae = (
             _video_vae(
-                pretrained_path=vae_pth,
+                pretrained_path=None if empty_weights else vae_pth,
                 z_dim=z_dim,
             )
             .eval()
             .requires_grad_(False)
         )
+        self.tile_size = None
+        self.tile_overlap = None
+
+    def enable_tiling(self, tile_size=256, tile_overlap=64):
+        """
+        Encode and decode in spatial tiles of `tile_size` pixels overlapping by `tile_overlap` pixels, which bounds the
+        peak memory of the VAE at the cost of small differences along the tile seams.
+        """
+        assert tile_size % 8 == 0 and tile_overlap % 8 == 0, "tile size and overlap must be multiples of 8"
+        assert 0 <= tile_overlap < tile_size, "tile overlap must be smaller than the tile size"
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+
+    def disable_tiling(self):
+        self.tile_size = None
+        self.tile_overlap = None
+
+    def _use_tiling(self, height, width):
+        return self.tile_size is not None and max(height, width) > self.tile_size
 
     def encode(self, video):
         """
         videos: A list of videos each with shape [C, T, H, W].
         """
+        if self._use_tiling(*video.shape[-2:]):
+            video = video if video.dim() == 5 else video.unsqueeze(0)
+            return self.vae.tiled_encode(video, self.scale, self.tile_size, self.tile_overlap).float()
         return self.vae.encode(video, self.scale).float()
 
     def to(self, *args, **kwargs):
@@ -635,5 +717,14 @@ class WanVAE:
         self.vae = self.vae.to(*args, **kwargs)
         return self
 
-    def decode(self, z):
-        return self.vae.decode(z, self.scale).float().clamp_(-1, 1)
+    def decode(self, z, first_chunk=True, last_chunk=True):
+        """
+        z: Latents with shape [B, C, T, H, W]. Set `first_chunk`/`last_chunk` to False to decode consecutive chunks
+        of one video with separate calls.
+        """
+        if self._use_tiling(z.shape[-2] * 8, z.shape[-1] * 8):
+            z = z if z.dim() == 5 else z.unsqueeze(0)
+            out = self.vae.tiled_decode(z, self.scale, self.tile_size, self.tile_overlap, first_chunk, last_chunk)
+        else:
+            out = self.vae.decode(z, self.scale, first_chunk, last_chunk)
+        return out.float().clamp_(-1, 1)
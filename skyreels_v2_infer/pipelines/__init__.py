@@ -3,3 +3,4 @@ from .image2video_pipeline import Image2VideoPipeline
 from .image2video_pipeline import resizecrop
 from .prompt_enhancer import PromptEnhancer
 from .text2video_pipeline import Text2VideoPipeline
+from .video_writer import StreamingVideoWriter
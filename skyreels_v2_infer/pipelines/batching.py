@@ -0,0 +1,60 @@
+import torch
+
+from ..modules.t5 import pad_text_embeddings
+
+
+def get_batch_size(*inputs):
+    """
+    Returns the number of videos of a pipeline call: the length of the inputs given as lists, e.g. prompts or
+    generators. An input that is not a list is shared by all videos.
+    """
+    sizes = {len(x) for x in inputs if isinstance(x, (list, tuple))}
+    if len(sizes) > 1:
+        raise ValueError(f"The batched inputs of a call have different lengths: {sorted(sizes)}")
+    return sizes.pop() if sizes else 1
+
+
+def encode_prompts(text_encoder, prompt, batch_size, variable_len=False):
+    """
+    Returns the text embeddings of the `batch_size` videos of a call, one [1, L, C] tensor per video, to be batched
+    with `batch_text_embeddings`. A single prompt is encoded once and shared, a list of prompts in one batch.
+
+    With `variable_len`, every embedding is cut to the tokens of its prompt, so that it does not attend the padding up
+    to the longest prompt of the batch and gets the same result as alone.
+    """
+    if isinstance(prompt, str):
+        return [text_encoder.encode(prompt, variable_len=variable_len)] * batch_size
+    context = text_encoder.encode(list(prompt), variable_len=variable_len)
+    if not variable_len:
+        return list(context.split(1))
+    # the embeddings are zero past the tokens of their prompt
+    lens = context.shape[1] - (context != 0).any(dim=-1).flip(1).int().argmax(dim=1)
+    return [u[None, :n] for u, n in zip(context, lens.tolist())]
+
+
+def batch_text_embeddings(embeddings, device, dtype):
+    """
+    Returns the batch of `embeddings` and the number of tokens of each of them, None when they all have the same
+    length, see `pad_text_embeddings`.
+    """
+    context, context_lens = pad_text_embeddings(embeddings)
+    context = context.to(device, dtype)
+    return context, None if context_lens is None else context_lens.to(device)
+
+
+def expand_batch(x, batch_size):
+    """
+    Repeats a batch of one conditioning tensor, e.g. the encoded input image, for all videos of the call.
+    """
+    if x.shape[0] == batch_size:
+        return x
+    assert x.shape[0] == 1, f"a batch of {x.shape[0]} does not match the {batch_size} videos of the call"
+    return x.expand(batch_size, *x.shape[1:])
+
+
+def unbatch_videos(videos):
+    """
+    Converts decoded videos in [B, C, T, H, W] format with values in [-1, 1] to a list of uint8 [T, H, W, C] arrays.
+    """
+    videos = ((videos / 2 + 0.5).clamp(0, 1).permute(0, 2, 3, 4, 1) * 255).to(torch.uint8)
+    return list(videos.cpu().numpy())
@@ -14,12 +14,18 @@ from tqdm import tqdm
 import decord
 from decord import VideoReader
 
-from ..modules import get_text_encoder
+from ..modules import get_cached_text_encoder
 from ..modules import get_transformer
+from ..modules.t5 import pad_text_embeddings
 from ..modules import get_vae
+from ..scheduler.fm_solvers_unipc import FlowUniPCMultiFrameScheduler
 from ..scheduler.fm_solvers_unipc import FlowUniPCMultistepScheduler
-
-
+from .batching import batch_text_embeddings
+from .batching import encode_prompts
+from .batching import expand_batch
+from .batching import get_batch_size
+from .batching import unbatch_videos
+from .video_writer import StreamingVideoWriter
 
 
 class DiffusionForcingPipeline:
@@ -45,6 +51,9 @@ class DiffusionForcingPipeline:
         weight_dtype=torch.bfloat16,
         use_usp=False,
         offload=False,
+        text_encoder=None,
+        vae=None,
+        prompt_cache_dir=None,
     ):
         """
         Initialize the diffusion forcing pipeline class
@@ -54,12 +63,19 @@ class DiffusionForcingPipeline:
             dit_path (str): Path to the DIT model, containing model configuration file (config.json) and weight file (*.safetensor)
             device (str): Device to run on, defaults to 'cuda'
             weight_dtype: Weight data type, defaults to torch.bfloat16
+            text_encoder: Already loaded T5 encoder to share with other pipelines, loaded from model_path if None
+            vae: Already loaded VAE to share with other pipelines, loaded from model_path if None
+            prompt_cache_dir (str): Directory where the prompt embeddings are cached across runs, memory only if None
         """
         load_device = "cpu" if offload else device
         self.transformer = get_transformer(dit_path, load_device, weight_dtype)
-        vae_model_path = os.path.join(model_path, "Wan2.1_VAE.pth")
-        self.vae = get_vae(vae_model_path, device, weight_dtype=torch.float32)
-        self.text_encoder = get_text_encoder(model_path, load_device, weight_dtype)
+        if vae is None:
+            vae_model_path = os.path.join(model_path, "Wan2.1_VAE.pth")
+            vae = get_vae(vae_model_path, device, weight_dtype=torch.float32)
+        self.vae = vae
+        if text_encoder is None:
+            text_encoder = get_cached_text_encoder(model_path, load_device, weight_dtype, cache_dir=prompt_cache_dir)
+        self.text_encoder = text_encoder
         self.video_processor = VideoProcessor(vae_scale_factor=16)
         self.device = device
         self.offload = offload
@@ -75,6 +91,8 @@ class DiffusionForcingPipeline:
                 self.sp_size = get_sequence_parallel_world_size()
 
         self.scheduler = FlowUniPCMultistepScheduler()
+        self._timestep_matrix_cache = {}
+        self._kv_cache_interval_start = None
 
     @property
     def do_classifier_free_guidance(self) -> bool:
@@ -108,6 +126,28 @@ class DiffusionForcingPipeline:
     ) -> torch.Tensor:
         return randn_tensor(shape, generator, device=device, dtype=dtype)
 
+    def step_kwargs(self, update_mask, valid_interval_start, teacache=None):
+        """
+        Returns the transformer arguments telling it which frames of the valid interval are updated by the step: the
+        number of leading clean frames for the causal kv cache, which is cleared whenever the interval starts at
+        another frame, the frames whose outputs are used for the token subset, and the TeaCache state of the sampling
+        loop with the first frame of the interval for the per frame block TeaCache.
+        """
+        kwargs = {}
+        if self.transformer.enable_causal_kv_cache:
+            if valid_interval_start != self._kv_cache_interval_start:
+                self.transformer.clear_causal_kv_cache()
+                self._kv_cache_interval_start = valid_interval_start
+            updated = update_mask.nonzero()
+            kwargs["num_clean_frames"] = updated[0].item() if len(updated) else 0
+        if self.transformer.enable_token_subset:
+            kwargs["output_frames"] = update_mask
+        if teacache is not None:
+            kwargs["teacache"] = teacache
+            if teacache.frame_block_size:
+                kwargs["frame_offset"] = valid_interval_start
+        return kwargs
+
     def generate_timestep_matrix(
         self,
         num_frames,
@@ -118,8 +158,6 @@ class DiffusionForcingPipeline:
         casual_block_size=1,
         shrink_interval_with_mask=False,
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, list[tuple]]:
-        step_matrix, step_index = [], []
-        update_mask, valid_interval = [], []
         num_iterations = len(step_template) + 1
         num_frames_block = num_frames // casual_block_size
         base_num_frames_block = base_num_frames // casual_block_size
@@ -128,7 +166,27 @@ class DiffusionForcingPipeline:
             gen_block = base_num_frames_block
             min_ar_step = infer_step_num / gen_block
             assert ar_step >= min_ar_step, f"ar_step should be at least {math.ceil(min_ar_step)} in your setting"
-        # print(num_frames, step_template, base_num_frames, ar_step, num_pre_ready, casual_block_size, num_frames_block, base_num_frames_block)
+        key = (
+            num_frames,
+            len(step_template),
+            base_num_frames,
+            ar_step,
+            num_pre_ready,
+            casual_block_size,
+            shrink_interval_with_mask,
+        )
+        if key not in self._timestep_matrix_cache:
+            self._timestep_matrix_cache[key] = self._build_timestep_index_matrix(
+                num_frames_block,
+                num_iterations,
+                base_num_frames_block,
+                ar_step,
+                num_pre_ready // casual_block_size,
+                casual_block_size,
+                shrink_interval_with_mask,
+            )
+        step_index, step_update_mask, valid_interval = self._timestep_matrix_cache[key]
+
         step_template = torch.cat(
             [
                 torch.tensor([999], dtype=torch.int64, device=step_template.device),
@@ -136,53 +194,58 @@ class DiffusionForcingPipeline:
                 torch.tensor([0], dtype=torch.int64, device=step_template.device),
             ]
         )  # to handle the counter in row works starting from 1
-        pre_row = torch.zeros(num_frames_block, dtype=torch.long)
-        if num_pre_ready > 0:
-            pre_row[: num_pre_ready // casual_block_size] = num_iterations
-
-        while torch.all(pre_row >= (num_iterations - 1)) == False:
-            new_row = torch.zeros(num_frames_block, dtype=torch.long)
-            for i in range(num_frames_block):
-                if i == 0 or pre_row[i - 1] >= (
-                    num_iterations - 1
-                ):  # the first frame or the last frame is completely denoised
-                    new_row[i] = pre_row[i] + 1
-                else:
-                    new_row[i] = new_row[i - 1] - ar_step
-            new_row = new_row.clamp(0, num_iterations)
-
-            update_mask.append(
-                (new_row != pre_row) & (new_row != num_iterations)
-            )  # False: no need to update， True: need to update
-            step_index.append(new_row)
-            step_matrix.append(step_template[new_row])
-            pre_row = new_row
+        step_matrix = step_template[step_index]
+
+        # the callers edit the returned matrices in place, so hand out copies of the cached ones
+        return step_matrix, step_index.clone(), step_update_mask.clone(), list(valid_interval)
+
+    @staticmethod
+    def _build_timestep_index_matrix(
+        num_frames_block,
+        num_iterations,
+        base_num_frames_block,
+        ar_step,
+        num_pre_ready_block,
+        casual_block_size,
+        shrink_interval_with_mask,
+    ):
+        """
+        Closed form of the row-by-row schedule of diffusion forcing. Starting from row 1, the first frame block that
+        is not ready advances by one step per row and every following block lags `ar_step` steps behind its
+        predecessor. A block whose predecessor finishes denoising starts advancing on its own, so the lag is at most
+        `num_iterations - 1`. Rows are generated until every block is (almost) fully denoised.
+        """
+        lag_step = min(ar_step, num_iterations - 1)
+        lag = (torch.arange(num_frames_block) - num_pre_ready_block).clamp(min=0) * lag_step
+        num_rows = max(num_frames_block - 1 - num_pre_ready_block, 0) * lag_step + num_iterations - 1
+        rows = torch.arange(1, num_rows + 1)
+        step_index = (rows[:, None] - lag[None, :]).clamp(0, num_iterations)
+        step_index[:, :num_pre_ready_block] = num_iterations
+        # False: no need to update， True: need to update
+        step_update_mask = (step_index > 0) & (step_index < num_iterations)
+        step_update_mask[:, :num_pre_ready_block] = False
 
         # for long video we split into several sequences, base_num_frames is set to the model max length (for training)
         terminal_flag = base_num_frames_block
         if shrink_interval_with_mask:
-            idx_sequence = torch.arange(num_frames_block, dtype=torch.int64)
-            update_mask = update_mask[0]
-            update_mask_idx = idx_sequence[update_mask]
-            last_update_idx = update_mask_idx[-1].item()
-            terminal_flag = last_update_idx + 1
-        # for i in range(0, len(update_mask)):
-        for curr_mask in update_mask:
-            if terminal_flag < num_frames_block and curr_mask[terminal_flag]:
+            terminal_flag = step_update_mask[0].nonzero()[-1].item() + 1
+        valid_interval = []
+        lag = lag.tolist()
+        for row in rows.tolist():
+            # step_update_mask[row - 1, terminal_flag] without reading the tensor, the prefix blocks are never updated
+            if (
+                num_pre_ready_block <= terminal_flag < num_frames_block
+                and lag[terminal_flag] < row < lag[terminal_flag] + num_iterations
+            ):
                 terminal_flag += 1
             valid_interval.append((max(terminal_flag - base_num_frames_block, 0), terminal_flag))
 
-        step_update_mask = torch.stack(update_mask, dim=0)
-        step_index = torch.stack(step_index, dim=0)
-        step_matrix = torch.stack(step_matrix, dim=0)
-
         if casual_block_size > 1:
-            step_update_mask = step_update_mask.unsqueeze(-1).repeat(1, 1, casual_block_size).flatten(1).contiguous()
-            step_index = step_index.unsqueeze(-1).repeat(1, 1, casual_block_size).flatten(1).contiguous()
-            step_matrix = step_matrix.unsqueeze(-1).repeat(1, 1, casual_block_size).flatten(1).contiguous()
+            step_update_mask = step_update_mask.repeat_interleave(casual_block_size, dim=1)
+            step_index = step_index.repeat_interleave(casual_block_size, dim=1)
             valid_interval = [(s * casual_block_size, e * casual_block_size) for s, e in valid_interval]
 
-        return step_matrix, step_index, step_update_mask, valid_interval
+        return step_index, step_update_mask, valid_interval
 
     def get_video_as_tensor(self, video_path, width, height):
         """
@@ -192,22 +255,48 @@ class DiffusionForcingPipeline:
         Returns:
             torch.Tensor: Video tensor in [C, T, H, W] format (channels first)
         """
-        
+
         # Set Decord to use CPU for video decoding
-        decord.bridge.set_bridge('torch')
-        
+        decord.bridge.set_bridge("torch")
+
         # Load video
         vr = VideoReader(video_path, width=width, height=height)
         total_frames = len(vr)
-        
+
         # Read all frames
         video_frames = vr.get_batch(list(range(total_frames)))
-        
+
         # Convert from [T, H, W, C] to [C, T, H, W] format
         video_tensor = video_frames.permute(0, 3, 1, 2).float()
-        
+
         return video_tensor
 
+    def output_frames(self, video, output_chunks, video_writer=None):
+        """
+        Converts newly finished frames to uint8 and streams them to `video_writer`, or appends them to
+        `output_chunks` to be concatenated once at the end.
+        Args:
+            video (torch.Tensor): Frames in [C, T, H, W] format with values in [-1, 1]
+        """
+        video = ((video / 2 + 0.5).clamp(0, 1).permute(1, 2, 3, 0) * 255).to(torch.uint8)
+        video = video.cpu().numpy()
+        if video_writer is not None:
+            video_writer.write(video)
+        else:
+            output_chunks.append(video)
+
+    def get_overlap_latents(self, latents, overlap_history_frames, causal_block_size):
+        """
+        Takes the clean latents of the overlap region at the end of the previous chunk as the prefix of the next one,
+        so they don't have to be decoded and encoded again.
+        Args:
+            latents (torch.Tensor): Final latents of the previous chunk in [C, T, H, W] format
+        Returns:
+            List[torch.Tensor]: The prefix latents, truncated at the front to a multiple of causal_block_size
+        """
+        prefix_length = overlap_history_frames - overlap_history_frames % causal_block_size
+        return [latents[:, latents.shape[1] - prefix_length :]]
+
     @torch.no_grad()
     def extend_video(
         self,
@@ -227,24 +316,38 @@ class DiffusionForcingPipeline:
         ar_step: int = 5,
         causal_block_size: int = None,
         fps: int = 24,
+        batched_cfg: bool = False,
+        latent_overlap: bool = False,
+        variable_text_len: bool = False,
+        video_writer: Optional[StreamingVideoWriter] = None,
     ):
         latent_height = height // 8
         latent_width = width // 8
         latent_length = (num_frames - 1) // 4 + 1
 
         self._guidance_scale = guidance_scale
+        # the conditioning frames are noised again at every step, their cached keys and values would keep stale noise
+        assert not (
+            self.transformer.enable_causal_kv_cache and addnoise_condition > 0
+        ), "the causal kv cache is not supported with addnoise_condition"
 
         i2v_extra_kwrags = {}
         prefix_video = None
         predix_video_latent_length = 0
 
         self.text_encoder.to(self.device)
-        prompt_embeds = self.text_encoder.encode(prompt).to(self.transformer.dtype)
+        prompt_embeds = self.text_encoder.encode(prompt, variable_len=variable_text_len).to(self.transformer.dtype)
         if self.do_classifier_free_guidance:
-            negative_prompt_embeds = self.text_encoder.encode(negative_prompt).to(self.transformer.dtype)
+            negative_prompt_embeds = self.text_encoder.encode(negative_prompt, variable_len=variable_text_len).to(
+                self.transformer.dtype
+            )
+            if batched_cfg:
+                cfg_prompt_embeds, cfg_prompt_lens = pad_text_embeddings([prompt_embeds, negative_prompt_embeds])
         if self.offload:
             self.text_encoder.cpu()
             torch.cuda.empty_cache()
+        self.transformer.clear_context_cache()
+        self.transformer.clear_causal_kv_cache()
 
         self.scheduler.set_timesteps(num_inference_steps, device=prompt_embeds.device, shift=shift)
         init_timesteps = self.scheduler.timesteps
@@ -265,21 +368,23 @@ class DiffusionForcingPipeline:
         overlap_history_frames = (overlap_history - 1) // 4 + 1
         n_iter = 1 + (latent_length - base_num_frames - 1) // (base_num_frames - overlap_history_frames) + 1
         print(f"n_iter:{n_iter}")
-        output_video = start_video.cpu()
+        output_video = []
+        self.output_frames(start_video, output_video, video_writer)
+        history_video = start_video[:, -overlap_history:].cpu()
         for i in range(n_iter):
-            prefix_video = output_video[:, -overlap_history:].to(prompt_embeds.device)
-            prefix_video = [self.vae.encode(prefix_video.unsqueeze(0))[0]]  # [(c, f, h, w)]
-            if prefix_video[0].shape[1] % causal_block_size != 0:
-                truncate_len = prefix_video[0].shape[1] % causal_block_size
-                print("the length of prefix video is truncated for the casual block size alignment.")
-                prefix_video[0] = prefix_video[0][:, : prefix_video[0].shape[1] - truncate_len]
+            if latent_overlap and i > 0:
+                prefix_video = self.get_overlap_latents(latents[0], overlap_history_frames, causal_block_size)
+            else:
+                prefix_video = history_video.to(prompt_embeds.device)
+                prefix_video = [self.vae.encode(prefix_video.unsqueeze(0))[0]]  # [(c, f, h, w)]
+                if prefix_video[0].shape[1] % causal_block_size != 0:
+                    truncate_len = prefix_video[0].shape[1] % causal_block_size
+                    print("the length of prefix video is truncated for the casual block size alignment.")
+                    prefix_video[0] = prefix_video[0][:, : prefix_video[0].shape[1] - truncate_len]
             predix_video_latent_length = prefix_video[0].shape[1]
             finished_frame_num = i * (base_num_frames - overlap_history_frames) + overlap_history_frames
             left_frame_num = latent_length - finished_frame_num
             base_num_frames_iter = min(left_frame_num + overlap_history_frames, base_num_frames)
-            if ar_step > 0 and self.transformer.enable_teacache:
-                num_steps = num_inference_steps + ((base_num_frames_iter - overlap_history_frames) // causal_block_size - 1) * ar_step
-                self.transformer.num_steps = num_steps
 
             latent_shape = [16, base_num_frames_iter, latent_height, latent_width]
             latents = self.prepare_latents(
@@ -296,30 +401,30 @@ class DiffusionForcingPipeline:
                 predix_video_latent_length,
                 causal_block_size,
             )
-            sample_schedulers = []
-            for _ in range(base_num_frames_iter):
-                sample_scheduler = FlowUniPCMultistepScheduler(
-                    num_train_timesteps=1000, shift=1, use_dynamic_shifting=False
-                )
-                sample_scheduler.set_timesteps(num_inference_steps, device=prompt_embeds.device, shift=shift)
-                sample_schedulers.append(sample_scheduler)
-            sample_schedulers_counter = [0] * base_num_frames_iter
+            sample_scheduler = FlowUniPCMultiFrameScheduler(
+                num_train_timesteps=1000, shift=1, use_dynamic_shifting=False
+            )
+            sample_scheduler.set_timesteps(
+                num_inference_steps, device=prompt_embeds.device, shift=shift, num_frames=base_num_frames_iter
+            )
             self.transformer.to(self.device)
-            for i, timestep_i in enumerate(tqdm(step_matrix)):
-                update_mask_i = step_update_mask[i]
-                valid_interval_i = valid_interval[i]
+            self._kv_cache_interval_start = None
+            teacache = self.transformer.new_teacache(len(step_matrix))
+            for step_i, timestep_i in enumerate(tqdm(step_matrix)):
+                update_mask_i = step_update_mask[step_i]
+                valid_interval_i = valid_interval[step_i]
                 valid_interval_start, valid_interval_end = valid_interval_i
+                step_kwargs = self.step_kwargs(
+                    update_mask_i[valid_interval_start:valid_interval_end], valid_interval_start, teacache
+                )
                 timestep = timestep_i[None, valid_interval_start:valid_interval_end].clone()
                 latent_model_input = [latents[0][:, valid_interval_start:valid_interval_end, :, :].clone()]
                 if addnoise_condition > 0 and valid_interval_start < predix_video_latent_length:
                     noise_factor = 0.001 * addnoise_condition
                     timestep_for_noised_condition = addnoise_condition
                     latent_model_input[0][:, valid_interval_start:predix_video_latent_length] = (
-                        latent_model_input[0][:, valid_interval_start:predix_video_latent_length]
-                        * (1.0 - noise_factor)
-                        + torch.randn_like(
-                            latent_model_input[0][:, valid_interval_start:predix_video_latent_length]
-                        )
+                        latent_model_input[0][:, valid_interval_start:predix_video_latent_length] * (1.0 - noise_factor)
+                        + torch.randn_like(latent_model_input[0][:, valid_interval_start:predix_video_latent_length])
                         * noise_factor
                     )
                     timestep[:, valid_interval_start:predix_video_latent_length] = timestep_for_noised_condition
@@ -330,7 +435,20 @@ class DiffusionForcingPipeline:
                         context=prompt_embeds,
                         fps=fps_embeds,
                         **i2v_extra_kwrags,
+                        **step_kwargs,
                     )[0]
+                elif batched_cfg:
+                    noise_pred_cond, noise_pred_uncond = self.transformer(
+                        torch.stack([latent_model_input[0]] * 2),
+                        t=timestep,
+                        context=cfg_prompt_embeds,
+                        context_lens=cfg_prompt_lens,
+                        fps=fps_embeds,
+                        batched_cfg=True,
+                        **i2v_extra_kwrags,
+                        **step_kwargs,
+                    )
+                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_cond - noise_pred_uncond)
                 else:
                     noise_pred_cond = self.transformer(
                         torch.stack([latent_model_input[0]]),
@@ -338,6 +456,7 @@ class DiffusionForcingPipeline:
                         context=prompt_embeds,
                         fps=fps_embeds,
                         **i2v_extra_kwrags,
+                        **step_kwargs,
                     )[0]
                     noise_pred_uncond = self.transformer(
                         torch.stack([latent_model_input[0]]),
@@ -345,36 +464,37 @@ class DiffusionForcingPipeline:
                         context=negative_prompt_embeds,
                         fps=fps_embeds,
                         **i2v_extra_kwrags,
+                        **step_kwargs,
                     )[0]
                     noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_cond - noise_pred_uncond)
-                for idx in range(valid_interval_start, valid_interval_end):
-                    if update_mask_i[idx].item():
-                        latents[0][:, idx] = sample_schedulers[idx].step(
-                            noise_pred[:, idx - valid_interval_start],
-                            timestep_i[idx],
-                            latents[0][:, idx],
-                            return_dict=False,
-                            generator=generator,
-                        )[0]
-                        sample_schedulers_counter[idx] += 1
+                latents[0][:, valid_interval_start:valid_interval_end] = sample_scheduler.step(
+                    noise_pred,
+                    timestep_i[valid_interval_start:valid_interval_end],
+                    latents[0][:, valid_interval_start:valid_interval_end],
+                    update_mask=update_mask_i[valid_interval_start:valid_interval_end],
+                    frame_offset=valid_interval_start,
+                    return_dict=False,
+                    generator=generator,
+                )[0]
             if self.offload:
                 self.transformer.cpu()
                 torch.cuda.empty_cache()
             x0 = latents[0].unsqueeze(0)
-            videos = [self.vae.decode(x0)[0]]
-            if output_video is None:
-                output_video = videos[0].clamp(-1, 1).cpu()  # c, f, h, w
+            if latent_overlap and i > 0:
+                # only the new latents are decoded, continuing the causal cache of the previous chunk
+                videos = [self.vae.decode(x0[:, :, predix_video_latent_length:], False, i == n_iter - 1)[0]]
+                new_video = videos[0]  # c, f, h, w
             else:
-                output_video = torch.cat(
-                    [output_video, videos[0][:, overlap_history:].clamp(-1, 1).cpu()], 1
-                )  # c, f, h, w
-        output_video = [(output_video / 2 + 0.5).clamp(0, 1)]
-        output_video = [video for video in output_video]
-        output_video = [video.permute(1, 2, 3, 0) * 255 for video in output_video]
-        output_video = [video.cpu().numpy().astype(np.uint8) for video in output_video]
-    
-        return output_video
-    
+                videos = [self.vae.decode(x0, True, not latent_overlap or i == n_iter - 1)[0]]
+                new_video = videos[0][:, overlap_history:].clamp(-1, 1)  # c, f, h, w
+            self.output_frames(new_video, output_video, video_writer)
+            if not latent_overlap:
+                history_video = torch.cat([history_video, new_video.cpu()], 1)[:, -overlap_history:]
+        self.transformer.clear_context_cache()
+        self.transformer.clear_causal_kv_cache()
+        if video_writer is not None:
+            return []
+        return [np.concatenate(output_video)]
 
     @torch.no_grad()
     def __call__(
@@ -396,12 +516,31 @@ class DiffusionForcingPipeline:
         ar_step: int = 5,
         causal_block_size: int = None,
         fps: int = 24,
+        batched_cfg: bool = False,
+        latent_overlap: bool = False,
+        variable_text_len: bool = False,
+        video_writer: Optional[StreamingVideoWriter] = None,
     ):
+        """
+        Generates one video per prompt and/or per generator. Short videos, of at most `base_num_frames` frames or
+        without `overlap_history`, are all denoised in one batch, long videos one at a time. A single prompt, negative
+        prompt or generator is shared by all videos, the latents of all videos are drawn from a single one.
+
+        Returns:
+            List[np.ndarray]: The uint8 frames of each video in [T, H, W, C] format, none with a `video_writer`
+        """
         latent_height = height // 8
         latent_width = width // 8
         latent_length = (num_frames - 1) // 4 + 1
+        batch_size = get_batch_size(prompt, negative_prompt, generator)
+        short_video = overlap_history is None or base_num_frames is None or num_frames <= base_num_frames
+        assert batch_size == 1 or (short_video and video_writer is None), "only short videos are batched, unstreamed"
 
         self._guidance_scale = guidance_scale
+        # the conditioning frames are noised again at every step, their cached keys and values would keep stale noise
+        assert not (
+            self.transformer.enable_causal_kv_cache and addnoise_condition > 0
+        ), "the causal kv cache is not supported with addnoise_condition"
 
         i2v_extra_kwrags = {}
         prefix_video = None
@@ -411,38 +550,48 @@ class DiffusionForcingPipeline:
 
         if image:
             prefix_video, predix_video_latent_length = self.encode_image(image, height, width, num_frames)
-        
+
         if end_image:
             end_video, end_video_latent_length = self.encode_image(end_image, height, width, num_frames)
 
         self.text_encoder.to(self.device)
-        prompt_embeds = self.text_encoder.encode(prompt).to(self.transformer.dtype)
+        embeddings = encode_prompts(self.text_encoder, prompt, batch_size, variable_text_len)
+        prompt_embeds, prompt_lens = batch_text_embeddings(embeddings, self.device, self.transformer.dtype)
         if self.do_classifier_free_guidance:
-            negative_prompt_embeds = self.text_encoder.encode(negative_prompt).to(self.transformer.dtype)
+            negative_embeddings = encode_prompts(self.text_encoder, negative_prompt, batch_size, variable_text_len)
+            negative_prompt_embeds, negative_prompt_lens = batch_text_embeddings(
+                negative_embeddings, self.device, self.transformer.dtype
+            )
+            if batched_cfg:
+                cfg_prompt_embeds, cfg_prompt_lens = batch_text_embeddings(
+                    embeddings + negative_embeddings, self.device, self.transformer.dtype
+                )
         if self.offload:
             self.text_encoder.cpu()
             torch.cuda.empty_cache()
+        self.transformer.clear_context_cache()
+        self.transformer.clear_causal_kv_cache()
 
         self.scheduler.set_timesteps(num_inference_steps, device=prompt_embeds.device, shift=shift)
         init_timesteps = self.scheduler.timesteps
         if causal_block_size is None:
             causal_block_size = self.transformer.num_frame_per_block
-        fps_embeds = [fps] * prompt_embeds.shape[0]
-        fps_embeds = [0 if i == 16 else 1 for i in fps_embeds]
+        # one for the whole batch, like the timesteps
+        fps_embeds = [0 if fps == 16 else 1]
         transformer_dtype = self.transformer.dtype
         # with torch.cuda.amp.autocast(dtype=self.transformer.dtype), torch.no_grad():
-        if overlap_history is None or base_num_frames is None or num_frames <= base_num_frames:
-            # short video generation
-            latent_shape = [16, latent_length, latent_height, latent_width]
+        if short_video:
+            # short video generation, the latents of all videos are denoised as one batch
+            latent_shape = [batch_size, 16, latent_length, latent_height, latent_width]
             latents = self.prepare_latents(
                 latent_shape, dtype=transformer_dtype, device=prompt_embeds.device, generator=generator
             )
-            latents = [latents]
             if prefix_video is not None:
-                latents[0][:, :predix_video_latent_length] = prefix_video[0].to(transformer_dtype)
+                latents[:, :, :predix_video_latent_length] = prefix_video[0].to(transformer_dtype)
 
             if end_video is not None:
-                latents[0] = torch.cat([latents[0], end_video[0].to(transformer_dtype)], dim=1)
+                end_latents = expand_batch(end_video[0][None].to(transformer_dtype), batch_size)
+                latents = torch.cat([latents, end_latents], dim=2)
 
             base_num_frames = num_frames
             base_num_frames = (base_num_frames - 1) // 4 + 1 if base_num_frames is not None else latent_length
@@ -450,7 +599,6 @@ class DiffusionForcingPipeline:
                 base_num_frames += end_video_latent_length
                 latent_length += end_video_latent_length
 
-
             step_matrix, _, step_update_mask, valid_interval = self.generate_timestep_matrix(
                 latent_length, init_timesteps, base_num_frames, ar_step, predix_video_latent_length, causal_block_size
             )
@@ -458,106 +606,129 @@ class DiffusionForcingPipeline:
                 step_matrix[:, -end_video_latent_length:] = 0
                 step_update_mask[:, -end_video_latent_length:] = False
 
-            sample_schedulers = []
-            for _ in range(latent_length):
-                sample_scheduler = FlowUniPCMultistepScheduler(
-                    num_train_timesteps=1000, shift=1, use_dynamic_shifting=False
-                )
-                sample_scheduler.set_timesteps(num_inference_steps, device=prompt_embeds.device, shift=shift)
-                sample_schedulers.append(sample_scheduler)
-            sample_schedulers_counter = [0] * latent_length
+            sample_scheduler = FlowUniPCMultiFrameScheduler(
+                num_train_timesteps=1000, shift=1, use_dynamic_shifting=False
+            )
+            sample_scheduler.set_timesteps(
+                num_inference_steps, device=prompt_embeds.device, shift=shift, num_frames=latent_length
+            )
             self.transformer.to(self.device)
+            self._kv_cache_interval_start = None
+            teacache = self.transformer.new_teacache(len(step_matrix))
             for i, timestep_i in enumerate(tqdm(step_matrix)):
                 update_mask_i = step_update_mask[i]
                 valid_interval_i = valid_interval[i]
                 valid_interval_start, valid_interval_end = valid_interval_i
+                step_kwargs = self.step_kwargs(
+                    update_mask_i[valid_interval_start:valid_interval_end], valid_interval_start, teacache
+                )
                 timestep = timestep_i[None, valid_interval_start:valid_interval_end].clone()
-                latent_model_input = [latents[0][:, valid_interval_start:valid_interval_end, :, :].clone()]
+                latent_model_input = latents[:, :, valid_interval_start:valid_interval_end].clone()
                 if addnoise_condition > 0 and valid_interval_start < predix_video_latent_length:
                     noise_factor = 0.001 * addnoise_condition
                     timestep_for_noised_condition = addnoise_condition
-                    latent_model_input[0][:, valid_interval_start:predix_video_latent_length] = (
-                        latent_model_input[0][:, valid_interval_start:predix_video_latent_length] * (1.0 - noise_factor)
-                        + torch.randn_like(latent_model_input[0][:, valid_interval_start:predix_video_latent_length])
+                    latent_model_input[:, :, valid_interval_start:predix_video_latent_length] = (
+                        latent_model_input[:, :, valid_interval_start:predix_video_latent_length] * (1.0 - noise_factor)
+                        + torch.randn_like(latent_model_input[:, :, valid_interval_start:predix_video_latent_length])
                         * noise_factor
                     )
                     timestep[:, valid_interval_start:predix_video_latent_length] = timestep_for_noised_condition
                 if not self.do_classifier_free_guidance:
                     noise_pred = self.transformer(
-                        torch.stack([latent_model_input[0]]),
+                        latent_model_input,
                         t=timestep,
                         context=prompt_embeds,
+                        context_lens=prompt_lens,
                         fps=fps_embeds,
                         **i2v_extra_kwrags,
-                    )[0]
+                        **step_kwargs,
+                    )
+                elif batched_cfg:
+                    noise_pred_cond, noise_pred_uncond = self.transformer(
+                        latent_model_input.repeat(2, 1, 1, 1, 1),
+                        t=timestep,
+                        context=cfg_prompt_embeds,
+                        context_lens=cfg_prompt_lens,
+                        fps=fps_embeds,
+                        batched_cfg=True,
+                        **i2v_extra_kwrags,
+                        **step_kwargs,
+                    ).chunk(2)
+                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_cond - noise_pred_uncond)
                 else:
                     noise_pred_cond = self.transformer(
-                        torch.stack([latent_model_input[0]]),
+                        latent_model_input,
                         t=timestep,
                         context=prompt_embeds,
+                        context_lens=prompt_lens,
                         fps=fps_embeds,
                         **i2v_extra_kwrags,
-                    )[0]
+                        **step_kwargs,
+                    )
                     noise_pred_uncond = self.transformer(
-                        torch.stack([latent_model_input[0]]),
+                        latent_model_input,
                         t=timestep,
                         context=negative_prompt_embeds,
+                        context_lens=negative_prompt_lens,
                         fps=fps_embeds,
                         **i2v_extra_kwrags,
-                    )[0]
+                        **step_kwargs,
+                    )
                     noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_cond - noise_pred_uncond)
-                for idx in range(valid_interval_start, valid_interval_end):
-                    if update_mask_i[idx].item():
-                        latents[0][:, idx] = sample_schedulers[idx].step(
-                            noise_pred[:, idx - valid_interval_start],
-                            timestep_i[idx],
-                            latents[0][:, idx],
-                            return_dict=False,
-                            generator=generator,
-                        )[0]
-                        sample_schedulers_counter[idx] += 1
+                # the videos share the timesteps of every frame, the scheduler steps their channels together
+                latents[:, :, valid_interval_start:valid_interval_end] = sample_scheduler.step(
+                    noise_pred.flatten(0, 1),
+                    timestep_i[valid_interval_start:valid_interval_end],
+                    latents[:, :, valid_interval_start:valid_interval_end].flatten(0, 1),
+                    update_mask=update_mask_i[valid_interval_start:valid_interval_end],
+                    frame_offset=valid_interval_start,
+                    return_dict=False,
+                    generator=generator,
+                )[0].unflatten(0, latents.shape[:2])
             if self.offload:
                 self.transformer.cpu()
                 torch.cuda.empty_cache()
-            x0 = latents[0].unsqueeze(0)
+            self.transformer.clear_context_cache()
+            self.transformer.clear_causal_kv_cache()
+            x0 = latents
             if end_video is not None:
-                x0 = latents[0][:, :-end_video_latent_length].unsqueeze(0)
-            
+                x0 = latents[:, :, :-end_video_latent_length]
+
             videos = self.vae.decode(x0)
-            videos = (videos / 2 + 0.5).clamp(0, 1)
-            videos = [video for video in videos]
-            videos = [video.permute(1, 2, 3, 0) * 255 for video in videos]
-            videos = [video.cpu().numpy().astype(np.uint8) for video in videos]
-            return videos
+            if video_writer is not None:
+                self.output_frames(videos[0], [], video_writer)
+                return []
+            return unbatch_videos(videos)
         else:
             # long video generation
             base_num_frames = (base_num_frames - 1) // 4 + 1 if base_num_frames is not None else latent_length
             overlap_history_frames = (overlap_history - 1) // 4 + 1
             n_iter = 1 + (latent_length - base_num_frames - 1) // (base_num_frames - overlap_history_frames) + 1
             print(f"n_iter:{n_iter}")
-            output_video = None
+            output_video = []
+            history_video = None
             for i in range(n_iter):
-                if output_video is not None:  # i !=0
-                    prefix_video = output_video[:, -overlap_history:].to(prompt_embeds.device)
-                    prefix_video = [self.vae.encode(prefix_video.unsqueeze(0))[0]]  # [(c, f, h, w)]
-                    if prefix_video[0].shape[1] % causal_block_size != 0:
-                        truncate_len = prefix_video[0].shape[1] % causal_block_size
-                        print("the length of prefix video is truncated for the casual block size alignment.")
-                        prefix_video[0] = prefix_video[0][:, : prefix_video[0].shape[1] - truncate_len]
+                if i > 0:
+                    if latent_overlap:
+                        prefix_video = self.get_overlap_latents(latents[0], overlap_history_frames, causal_block_size)
+                    else:
+                        prefix_video = history_video.to(prompt_embeds.device)
+                        prefix_video = [self.vae.encode(prefix_video.unsqueeze(0))[0]]  # [(c, f, h, w)]
+                        if prefix_video[0].shape[1] % causal_block_size != 0:
+                            truncate_len = prefix_video[0].shape[1] % causal_block_size
+                            print("the length of prefix video is truncated for the casual block size alignment.")
+                            prefix_video[0] = prefix_video[0][:, : prefix_video[0].shape[1] - truncate_len]
                     predix_video_latent_length = prefix_video[0].shape[1]
                     finished_frame_num = i * (base_num_frames - overlap_history_frames) + overlap_history_frames
                     left_frame_num = latent_length - finished_frame_num
                     base_num_frames_iter = min(left_frame_num + overlap_history_frames, base_num_frames)
-                    if ar_step > 0 and self.transformer.enable_teacache:
-                        num_steps = num_inference_steps + ((base_num_frames_iter - overlap_history_frames) // causal_block_size - 1) * ar_step
-                        self.transformer.num_steps = num_steps
                 else:  # i == 0
                     base_num_frames_iter = base_num_frames
-                latent_shape = [16, base_num_frames_iter, latent_height, latent_width]
+                latent_shape = [1, 16, base_num_frames_iter, latent_height, latent_width]
                 latents = self.prepare_latents(
                     latent_shape, dtype=transformer_dtype, device=prompt_embeds.device, generator=generator
                 )
-                latents = [latents]
+                latents = [latents[0]]
                 if prefix_video is not None:
                     latents[0][:, :predix_video_latent_length] = prefix_video[0].to(transformer_dtype)
 
@@ -577,19 +748,22 @@ class DiffusionForcingPipeline:
                     step_matrix[:, -end_video_latent_length:] = 0
                     step_update_mask[:, -end_video_latent_length:] = False
 
-                sample_schedulers = []
-                for _ in range(base_num_frames_iter):
-                    sample_scheduler = FlowUniPCMultistepScheduler(
-                        num_train_timesteps=1000, shift=1, use_dynamic_shifting=False
-                    )
-                    sample_scheduler.set_timesteps(num_inference_steps, device=prompt_embeds.device, shift=shift)
-                    sample_schedulers.append(sample_scheduler)
-                sample_schedulers_counter = [0] * base_num_frames_iter
+                sample_scheduler = FlowUniPCMultiFrameScheduler(
+                    num_train_timesteps=1000, shift=1, use_dynamic_shifting=False
+                )
+                sample_scheduler.set_timesteps(
+                    num_inference_steps, device=prompt_embeds.device, shift=shift, num_frames=base_num_frames_iter
+                )
                 self.transformer.to(self.device)
-                for i, timestep_i in enumerate(tqdm(step_matrix)):
-                    update_mask_i = step_update_mask[i]
-                    valid_interval_i = valid_interval[i]
+                self._kv_cache_interval_start = None
+                teacache = self.transformer.new_teacache(len(step_matrix))
+                for step_i, timestep_i in enumerate(tqdm(step_matrix)):
+                    update_mask_i = step_update_mask[step_i]
+                    valid_interval_i = valid_interval[step_i]
                     valid_interval_start, valid_interval_end = valid_interval_i
+                    step_kwargs = self.step_kwargs(
+                        update_mask_i[valid_interval_start:valid_interval_end], valid_interval_start, teacache
+                    )
                     timestep = timestep_i[None, valid_interval_start:valid_interval_end].clone()
                     latent_model_input = [latents[0][:, valid_interval_start:valid_interval_end, :, :].clone()]
                     if addnoise_condition > 0 and valid_interval_start < predix_video_latent_length:
@@ -611,7 +785,20 @@ class DiffusionForcingPipeline:
                             context=prompt_embeds,
                             fps=fps_embeds,
                             **i2v_extra_kwrags,
+                            **step_kwargs,
                         )[0]
+                    elif batched_cfg:
+                        noise_pred_cond, noise_pred_uncond = self.transformer(
+                            torch.stack([latent_model_input[0]] * 2),
+                            t=timestep,
+                            context=cfg_prompt_embeds,
+                            context_lens=cfg_prompt_lens,
+                            fps=fps_embeds,
+                            batched_cfg=True,
+                            **i2v_extra_kwrags,
+                            **step_kwargs,
+                        )
+                        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_cond - noise_pred_uncond)
                     else:
                         noise_pred_cond = self.transformer(
                             torch.stack([latent_model_input[0]]),
@@ -619,6 +806,7 @@ class DiffusionForcingPipeline:
                             context=prompt_embeds,
                             fps=fps_embeds,
                             **i2v_extra_kwrags,
+                            **step_kwargs,
                         )[0]
                         noise_pred_uncond = self.transformer(
                             torch.stack([latent_model_input[0]]),
@@ -626,34 +814,45 @@ class DiffusionForcingPipeline:
                             context=negative_prompt_embeds,
                             fps=fps_embeds,
                             **i2v_extra_kwrags,
+                            **step_kwargs,
                         )[0]
                         noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_cond - noise_pred_uncond)
-                    for idx in range(valid_interval_start, valid_interval_end):
-                        if update_mask_i[idx].item():
-                            latents[0][:, idx] = sample_schedulers[idx].step(
-                                noise_pred[:, idx - valid_interval_start],
-                                timestep_i[idx],
-                                latents[0][:, idx],
-                                return_dict=False,
-                                generator=generator,
-                            )[0]
-                            sample_schedulers_counter[idx] += 1
+                    latents[0][:, valid_interval_start:valid_interval_end] = sample_scheduler.step(
+                        noise_pred,
+                        timestep_i[valid_interval_start:valid_interval_end],
+                        latents[0][:, valid_interval_start:valid_interval_end],
+                        update_mask=update_mask_i[valid_interval_start:valid_interval_end],
+                        frame_offset=valid_interval_start,
+                        return_dict=False,
+                        generator=generator,
+                    )[0]
                 if self.offload:
                     self.transformer.cpu()
                     torch.cuda.empty_cache()
                 x0 = latents[0].unsqueeze(0)
                 if end_video is not None and i == n_iter - 1:
-                    x0 = latents[0][:, :-end_video_latent_length].unsqueeze(0)  
-
-                videos = [self.vae.decode(x0)[0]]
-                if output_video is None:
-                    output_video = videos[0].clamp(-1, 1).cpu()  # c, f, h, w
+                    x0 = latents[0][:, :-end_video_latent_length].unsqueeze(0)
+
+                if i == 0:
+                    videos = [self.vae.decode(x0, True, not latent_overlap)[0]]
+                    new_video = videos[0].clamp(-1, 1)  # c, f, h, w
+                elif latent_overlap:
+                    # only the new latents are decoded, continuing the causal cache of the previous chunk
+                    videos = [self.vae.decode(x0[:, :, predix_video_latent_length:], False, i == n_iter - 1)[0]]
+                    new_video = videos[0]  # c, f, h, w
                 else:
-                    output_video = torch.cat(
-                        [output_video, videos[0][:, overlap_history:].clamp(-1, 1).cpu()], 1
-                    )  # c, f, h, w
-            output_video = [(output_video / 2 + 0.5).clamp(0, 1)]
-            output_video = [video for video in output_video]
-            output_video = [video.permute(1, 2, 3, 0) * 255 for video in output_video]
-            output_video = [video.cpu().numpy().astype(np.uint8) for video in output_video]
-            return output_video
+                    videos = [self.vae.decode(x0)[0]]
+                    new_video = videos[0][:, overlap_history:].clamp(-1, 1)  # c, f, h, w
+                self.output_frames(new_video, output_video, video_writer)
+                if not latent_overlap:
+                    # only the frames the next chunk is conditioned on are kept around
+                    if history_video is None:
+                        history_video = new_video.cpu()
+                    else:
+                        history_video = torch.cat([history_video, new_video.cpu()], 1)
+                    history_video = history_video[:, -overlap_history:]
+            self.transformer.clear_context_cache()
+            self.transformer.clear_causal_kv_cache()
+            if video_writer is not None:
+                return []
+            return [np.concatenate(output_video)]
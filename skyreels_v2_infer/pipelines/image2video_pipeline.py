@@ -3,18 +3,23 @@ from typing import List
 from typing import Optional
 from typing import Union
 
-import numpy as np
 import torch
 from diffusers.image_processor import PipelineImageInput
+from diffusers.utils.torch_utils import randn_tensor
 from diffusers.video_processor import VideoProcessor
 from PIL import Image
 from tqdm import tqdm
 
 from ..modules import get_image_encoder
-from ..modules import get_text_encoder
+from ..modules import get_cached_text_encoder
 from ..modules import get_transformer
 from ..modules import get_vae
 from ..scheduler.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .batching import batch_text_embeddings
+from .batching import encode_prompts
+from .batching import expand_batch
+from .batching import get_batch_size
+from .batching import unbatch_videos
 
 
 def resizecrop(image: Image.Image, th, tw):
@@ -37,13 +42,26 @@ def resizecrop(image: Image.Image, th, tw):
 
 class Image2VideoPipeline:
     def __init__(
-        self, model_path, dit_path, device: str = "cuda", weight_dtype=torch.bfloat16, use_usp=False, offload=False
+        self,
+        model_path,
+        dit_path,
+        device: str = "cuda",
+        weight_dtype=torch.bfloat16,
+        use_usp=False,
+        offload=False,
+        text_encoder=None,
+        vae=None,
+        prompt_cache_dir=None,
     ):
         load_device = "cpu" if offload else device
         self.transformer = get_transformer(dit_path, load_device, weight_dtype)
-        vae_model_path = os.path.join(model_path, "Wan2.1_VAE.pth")
-        self.vae = get_vae(vae_model_path, device, weight_dtype=torch.float32)
-        self.text_encoder = get_text_encoder(model_path, load_device, weight_dtype)
+        if vae is None:
+            vae_model_path = os.path.join(model_path, "Wan2.1_VAE.pth")
+            vae = get_vae(vae_model_path, device, weight_dtype=torch.float32)
+        self.vae = vae
+        if text_encoder is None:
+            text_encoder = get_cached_text_encoder(model_path, load_device, weight_dtype, cache_dir=prompt_cache_dir)
+        self.text_encoder = text_encoder
         self.clip = get_image_encoder(model_path, load_device, weight_dtype)
         self.sp_size = 1
         self.device = device
@@ -75,9 +93,20 @@ class Image2VideoPipeline:
         num_inference_steps: int = 50,
         guidance_scale: float = 5.0,
         shift: float = 5.0,
-        generator: Optional[torch.Generator] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        batched_cfg: bool = False,
+        variable_text_len: bool = False,
     ):
+        """
+        Generates one video per image, prompt and/or generator, all of them denoised in one batch. A single image,
+        prompt, negative prompt or generator is shared by all videos, the latents of all videos are drawn from a single
+        one.
+
+        Returns:
+            List[np.ndarray]: The uint8 frames of each video in [T, H, W, C] format
+        """
         F = num_frames
+        batch_size = get_batch_size(image, prompt, negative_prompt, generator)
 
         latent_height = height // 8 // 2 * 2
         latent_width = width // 8 // 2 * 2
@@ -103,54 +132,75 @@ class Image2VideoPipeline:
         if self.offload:
             self.clip.cpu()
             torch.cuda.empty_cache()
+        # a single image is encoded once for all videos
+        y, clip_context = expand_batch(y, batch_size), expand_batch(clip_context, batch_size)
 
         # preprocess
         self.text_encoder.to(self.device)
-        context = self.text_encoder.encode(prompt).to(self.device)
-        context_null = self.text_encoder.encode(negative_prompt).to(self.device)
+        embeddings = encode_prompts(self.text_encoder, prompt, batch_size, variable_text_len)
+        embeddings_null = encode_prompts(self.text_encoder, negative_prompt, batch_size, variable_text_len)
         if self.offload:
             self.text_encoder.cpu()
             torch.cuda.empty_cache()
+        text_dtype = embeddings[0].dtype
+        context, context_lens = batch_text_embeddings(embeddings, self.device, text_dtype)
+        context_null, context_null_lens = batch_text_embeddings(embeddings_null, self.device, text_dtype)
 
-        latent = torch.randn(
-            16, latent_length, latent_height, latent_width, dtype=torch.float32, generator=generator, device=self.device
-        )
+        latent_shape = (batch_size, 16, latent_length, latent_height, latent_width)
+        latents = randn_tensor(latent_shape, generator, device=self.device, dtype=torch.float32)
 
+        self.transformer.clear_context_cache()
         self.transformer.to(self.device)
         with torch.cuda.amp.autocast(dtype=self.transformer.dtype), torch.no_grad():
             self.scheduler.set_timesteps(num_inference_steps, device=self.device, shift=shift)
             timesteps = self.scheduler.timesteps
+            teacache = self.transformer.new_teacache(len(timesteps))
 
             arg_c = {
                 "context": context,
+                "context_lens": context_lens,
                 "clip_fea": clip_context,
                 "y": y,
+                "teacache": teacache,
             }
 
             arg_null = {
                 "context": context_null,
+                "context_lens": context_null_lens,
                 "clip_fea": clip_context,
                 "y": y,
+                "teacache": teacache,
             }
 
+            if batched_cfg:
+                context_cfg, context_cfg_lens = batch_text_embeddings(
+                    embeddings + embeddings_null, self.device, text_dtype
+                )
+                arg_cfg = {
+                    "context": context_cfg,
+                    "context_lens": context_cfg_lens,
+                    "clip_fea": clip_context.repeat(2, 1, 1),
+                    "y": y.repeat(2, 1, 1, 1, 1),
+                    "batched_cfg": True,
+                    "teacache": teacache,
+                }
+
             self.transformer.to(self.device)
             for _, t in enumerate(tqdm(timesteps)):
-                latent_model_input = torch.stack([latent]).to(self.device)
                 timestep = torch.stack([t]).to(self.device)
-                noise_pred_cond = self.transformer(latent_model_input, t=timestep, **arg_c)[0].to(self.device)
-                noise_pred_uncond = self.transformer(latent_model_input, t=timestep, **arg_null)[0].to(self.device)
+                if batched_cfg:
+                    noise_pred_cond, noise_pred_uncond = (
+                        self.transformer(latents.repeat(2, 1, 1, 1, 1), t=timestep, **arg_cfg).to(self.device).chunk(2)
+                    )
+                else:
+                    noise_pred_cond = self.transformer(latents, t=timestep, **arg_c).to(self.device)
+                    noise_pred_uncond = self.transformer(latents, t=timestep, **arg_null).to(self.device)
                 noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_cond - noise_pred_uncond)
 
-                temp_x0 = self.scheduler.step(
-                    noise_pred.unsqueeze(0), t, latent.unsqueeze(0), return_dict=False, generator=generator
-                )[0]
-                latent = temp_x0.squeeze(0)
+                latents = self.scheduler.step(noise_pred, t, latents, return_dict=False, generator=generator)[0]
+            self.transformer.clear_context_cache()
             if self.offload:
                 self.transformer.cpu()
                 torch.cuda.empty_cache()
-            videos = self.vae.decode(latent)
-            videos = (videos / 2 + 0.5).clamp(0, 1)
-            videos = [video for video in videos]
-            videos = [video.permute(1, 2, 3, 0) * 255 for video in videos]
-            videos = [video.cpu().numpy().astype(np.uint8) for video in videos]
+            videos = unbatch_videos(self.vae.decode(latents))
         return videos
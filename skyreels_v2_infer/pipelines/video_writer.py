@@ -0,0 +1,72 @@
+import queue
+import threading
+
+import imageio
+import numpy as np
+
+
+class StreamingVideoWriter:
+    """
+    Writes a video chunk by chunk while it is being generated.
+
+    Chunks of uint8 frames in [F, H, W, C] format are handed over with `write` and piped to the ffmpeg encoder from a
+    background thread, so encoding overlaps with generation. The queue between both sides is bounded, which keeps the
+    host memory constant whatever the length of the video: `write` blocks while `max_queue_size` chunks are pending.
+    """
+
+    def __init__(self, path, fps=24, quality=8, max_queue_size=2, output_params=["-loglevel", "error"]):
+        self.path = path
+        self.num_frames = 0
+        self._writer = imageio.get_writer(path, fps=fps, quality=quality, output_params=output_params)
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="StreamingVideoWriter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            frames = self._queue.get()
+            if frames is None:
+                break
+            if self._error is not None:
+                # drain the queue so that the producer never blocks on a dead writer
+                continue
+            try:
+                for frame in frames:
+                    self._writer.append_data(frame)
+            except Exception as e:
+                self._error = e
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(f"writing {self.path} failed") from self._error
+
+    def write(self, frames):
+        """
+        Queues frames in [F, H, W, C] uint8 format for encoding.
+        """
+        if self._closed:
+            raise ValueError(f"{self.path} is already closed")
+        self._raise_if_failed()
+        frames = np.ascontiguousarray(frames)
+        self.num_frames += len(frames)
+        self._queue.put(frames)
+
+    def close(self):
+        """
+        Waits until all queued frames are encoded and finalizes the file.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._writer.close()
+        self._raise_if_failed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -757,3 +757,285 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
 
     def __len__(self):
         return self.config.num_train_timesteps
+
+
+class FlowUniPCMultiFrameScheduler(FlowUniPCMultistepScheduler):
+    """
+    Frame-wise variant of [`FlowUniPCMultistepScheduler`] for diffusion forcing.
+
+    Every latent frame runs its own UniPC chain over the same timestep schedule, but the per-frame step indices,
+    solver orders and history buffers are held as tensors so that all frames selected by an update mask advance in a
+    single vectorized call. It is equivalent to keeping one [`FlowUniPCMultistepScheduler`] per frame and stepping
+    them one by one, without the Python loop and the host synchronizations that come with it.
+
+    Only `solver_order <= 2` and `solver_p=None` are supported, which covers the configurations used for inference.
+    The frame axis is dimension 1 of the samples, i.e. `[C, F, H, W]` latents.
+    """
+
+    @register_to_config
+    def __init__(
+        self,
+        num_train_timesteps: int = 1000,
+        solver_order: int = 2,
+        prediction_type: str = "flow_prediction",
+        shift: Optional[float] = 1.0,
+        use_dynamic_shifting=False,
+        thresholding: bool = False,
+        dynamic_thresholding_ratio: float = 0.995,
+        sample_max_value: float = 1.0,
+        predict_x0: bool = True,
+        solver_type: str = "bh2",
+        lower_order_final: bool = True,
+        disable_corrector: List[int] = [],
+        solver_p: SchedulerMixin = None,
+        timestep_spacing: str = "linspace",
+        steps_offset: int = 0,
+        final_sigmas_type: Optional[str] = "zero",  # "zero", "sigma_min"
+    ):
+        if solver_order > 2 or solver_p is not None:
+            raise NotImplementedError(f"{self.__class__} only supports `solver_order <= 2` without `solver_p`")
+        if thresholding:
+            raise NotImplementedError(f"{self.__class__} does not support thresholding")
+        super().__init__(
+            num_train_timesteps=num_train_timesteps,
+            solver_order=solver_order,
+            prediction_type=prediction_type,
+            shift=shift,
+            use_dynamic_shifting=use_dynamic_shifting,
+            thresholding=thresholding,
+            dynamic_thresholding_ratio=dynamic_thresholding_ratio,
+            sample_max_value=sample_max_value,
+            predict_x0=predict_x0,
+            solver_type=solver_type,
+            lower_order_final=lower_order_final,
+            disable_corrector=disable_corrector,
+            solver_p=solver_p,
+            timestep_spacing=timestep_spacing,
+            steps_offset=steps_offset,
+            final_sigmas_type=final_sigmas_type,
+        )
+        self.num_frames = None
+
+    def set_timesteps(
+        self,
+        num_inference_steps: Union[int, None] = None,
+        device: Union[str, torch.device] = None,
+        sigmas: Optional[List[float]] = None,
+        mu: Optional[Union[float, None]] = None,
+        shift: Optional[Union[float, None]] = None,
+        num_frames: int = 1,
+    ):
+        """
+        Sets the discrete timesteps shared by all frames and resets the per-frame solver state.
+        Args:
+            num_inference_steps (`int`):
+                Total number of the spacing of the time steps.
+            device (`str` or `torch.device`, *optional*):
+                The device to which the timesteps should be moved to. If `None`, the timesteps are not moved.
+            num_frames (`int`):
+                Number of frames, each with its own step counter and solver history.
+        """
+        super().set_timesteps(num_inference_steps, device=device, sigmas=sigmas, mu=mu, shift=shift)
+        self.num_frames = num_frames
+
+        device = self.timesteps.device
+        self.frame_sigmas = self.sigmas.to(device)
+        alpha, sigma = self._sigma_to_alpha_sigma_t(self.frame_sigmas)
+        self.frame_lambdas = torch.log(alpha) - torch.log(sigma)
+        corrector_enabled = torch.ones(self.num_inference_steps + 1, dtype=torch.bool)
+        for i in self.disable_corrector:
+            if 0 <= i < len(corrector_enabled):
+                corrector_enabled[i] = False
+        self.corrector_enabled = corrector_enabled.to(device)
+
+        # -1 marks a frame whose step index is not initialized yet
+        self.frame_step_index = torch.full((num_frames,), -1, dtype=torch.long, device=device)
+        self.frame_lower_order_nums = torch.zeros(num_frames, dtype=torch.long, device=device)
+        self.frame_this_order = torch.ones(num_frames, dtype=torch.long, device=device)
+        self.frame_has_last_sample = torch.zeros(num_frames, dtype=torch.bool, device=device)
+        self.frame_model_outputs = None
+        self.frame_last_sample = None
+
+    def _init_frame_step_index(self, timestep):
+        """
+        Vectorized `index_for_timestep`: the second match of a duplicated timestep, else the first one.
+        """
+        if self.begin_index is not None:
+            return torch.full_like(timestep, self.begin_index, dtype=torch.long)
+        matches = self.timesteps.view(1, -1) == timestep.to(self.timesteps.device).view(-1, 1)
+        first = matches.int().argmax(dim=1)
+        second = (matches & (matches.cumsum(dim=1) == 2)).int().argmax(dim=1)
+        return torch.where(matches.sum(dim=1) > 1, second, first)
+
+    def _bh_coefficients(self, lambda_t, lambda_s0):
+        h = lambda_t - lambda_s0
+        hh = -h if self.predict_x0 else h
+        h_phi_1 = torch.expm1(hh)  # h\phi_1(h) = e^h - 1
+        h_phi_k = h_phi_1 / hh - 1
+
+        if self.config.solver_type == "bh1":
+            B_h = hh
+        elif self.config.solver_type == "bh2":
+            B_h = torch.expm1(hh)
+        else:
+            raise NotImplementedError()
+
+        b0 = h_phi_k / B_h
+        b1 = (h_phi_k / hh - 0.5) * 2 / B_h
+        return h, h_phi_1, B_h, b0, b1
+
+    def _bh_update(self, x, m0, res, sigma_t, sigma_s0, h_phi_1, B_h):
+        """
+        The B(h) update shared by the predictor and the corrector, with `res` the residual term. The float32
+        coefficients are rounded to the dtype of the tensor they scale, as the 0-dim coefficients of the scalar
+        scheduler are, so that both compute in the dtype of the samples.
+        """
+        alpha_t, sigma_t = self._sigma_to_alpha_sigma_t(sigma_t)
+        alpha_s0, sigma_s0 = self._sigma_to_alpha_sigma_t(sigma_s0)
+        if self.predict_x0:
+            x_t_ = (sigma_t / sigma_s0).to(x.dtype) * x - (alpha_t * h_phi_1).to(m0.dtype) * m0
+            return x_t_ - (alpha_t * B_h).to(res.dtype) * res
+        x_t_ = (alpha_t / alpha_s0).to(x.dtype) * x - (sigma_t * h_phi_1).to(m0.dtype) * m0
+        return x_t_ - (sigma_t * B_h).to(res.dtype) * res
+
+    def step(
+        self,
+        model_output: torch.Tensor,
+        timestep: torch.Tensor,
+        sample: torch.Tensor,
+        update_mask: Optional[torch.Tensor] = None,
+        frame_offset: int = 0,
+        return_dict: bool = True,
+        generator=None,
+    ) -> Union[SchedulerOutput, Tuple]:
+        """
+        Advance every frame selected by `update_mask` by one UniPC step.
+
+        Args:
+            model_output (`torch.Tensor`):
+                The direct output from learned diffusion model, shape `[C, f, ...]`.
+            timestep (`torch.Tensor`):
+                The current discrete timestep of each frame, shape `[f]`.
+            sample (`torch.Tensor`):
+                The current samples, shape `[C, f, ...]`.
+            update_mask (`torch.Tensor`, *optional*):
+                Boolean mask of shape `[f]`, frames outside of the mask are returned unchanged. Defaults to all frames.
+            frame_offset (`int`):
+                Index of the first of the `f` frames among the `num_frames` frames of the scheduler.
+            return_dict (`bool`):
+                Whether or not to return a [`~schedulers.scheduling_utils.SchedulerOutput`] or `tuple`.
+
+        Returns:
+            [`~schedulers.scheduling_utils.SchedulerOutput`] or `tuple`:
+                If return_dict is `True`, [`~schedulers.scheduling_utils.SchedulerOutput`] is returned, otherwise a
+                tuple is returned where the first element is the sample tensor.
+        """
+        if self.num_inference_steps is None:
+            raise ValueError(
+                "Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler"
+            )
+
+        num_window = sample.shape[1]
+        window = slice(frame_offset, frame_offset + num_window)
+        device = sample.device
+        if update_mask is None:
+            update_mask = torch.ones(num_window, dtype=torch.bool, device=device)
+        update_mask = update_mask.to(device)
+
+        dtype = torch.result_type(sample, model_output)
+        if self.frame_model_outputs is None:
+            shape = (sample.shape[0], self.num_frames, *sample.shape[2:])
+            self.frame_model_outputs = [
+                torch.zeros(shape, dtype=dtype, device=device) for _ in range(self.config.solver_order)
+            ]
+            self.frame_last_sample = torch.zeros(shape, dtype=sample.dtype, device=device)
+
+        def per_frame(x, dtype=None):
+            return x.view(1, -1, *([1] * (sample.dim() - 2))).to(dtype)
+
+        step_index = self.frame_step_index[window]
+        step_index = torch.where(step_index < 0, self._init_frame_step_index(timestep).to(device), step_index)
+        lower_order_nums = self.frame_lower_order_nums[window]
+        last_order = self.frame_this_order[window]
+        history = [model_output[:, window] for model_output in self.frame_model_outputs]
+        last_sample = self.frame_last_sample[:, window]
+        sigmas, lambdas = self.frame_sigmas, self.frame_lambdas
+        num_steps = len(self.timesteps)
+        prev_index = (step_index - 1).clamp(min=0)
+        next_index = (step_index + 1).clamp(max=num_steps)
+
+        # convert model output
+        sigma = sigmas[step_index]
+        if self.predict_x0:
+            model_output_convert = sample - per_frame(sigma, model_output.dtype) * model_output
+        else:
+            model_output_convert = sample - per_frame(1 - sigma, model_output.dtype) * model_output
+
+        # UniC corrector with the order of the previous step, rhos_c solves [[1, 1], [rk, 1]] @ rhos_c = b
+        use_corrector = (step_index > 0) & self.corrector_enabled[prev_index] & self.frame_has_last_sample[window]
+        second_order = last_order == 2
+        h, h_phi_1, B_h, b0, b1 = self._bh_coefficients(lambdas[step_index], lambdas[prev_index])
+        rk = torch.where(second_order, (lambdas[(step_index - 2).clamp(min=0)] - lambdas[prev_index]) / h, 1.0)
+        rho_0 = (b0 - b1) / (1 - rk)
+        rho_d1 = torch.where(second_order, rho_0.to(sample.dtype), 0.0)
+        rho_t = torch.where(second_order, (b0 - rho_0).to(sample.dtype), 0.5)
+        m0 = history[-1]
+        # a division by a 0-dim tensor multiplies by its float32 reciprocal, without rounding it to the sample dtype
+        D1 = ((history[0] - m0) * per_frame(1 / rk)).to(dtype)
+        corr_res = per_frame(rho_d1, dtype) * D1 + per_frame(rho_t, dtype) * (model_output_convert - m0)
+        corrected = self._bh_update(
+            last_sample,
+            m0,
+            corr_res,
+            per_frame(sigmas[step_index]),
+            per_frame(sigmas[prev_index]),
+            per_frame(h_phi_1),
+            per_frame(B_h),
+        ).to(sample.dtype)
+        corrected = torch.where(per_frame(use_corrector), corrected, sample)
+
+        if self.config.lower_order_final:
+            this_order = (num_steps - step_index).clamp(max=self.config.solver_order)
+        else:
+            this_order = torch.full_like(step_index, self.config.solver_order)
+        this_order = torch.minimum(this_order, lower_order_nums + 1)
+        history = history[1:] + [model_output_convert]
+
+        # UniP predictor, for order 2 rhos_p is fixed to 0.5
+        second_order = this_order == 2
+        h, h_phi_1, B_h, _, _ = self._bh_coefficients(lambdas[next_index], lambdas[step_index])
+        rk = torch.where(second_order, (lambdas[prev_index] - lambdas[step_index]) / h, 1.0)
+        rho_d1 = torch.where(second_order, 0.5, 0.0)
+        m0 = history[-1]
+        D1 = ((history[0] - m0) * per_frame(1 / rk)).to(dtype)
+        prev_sample = self._bh_update(
+            corrected,
+            m0,
+            per_frame(rho_d1, dtype) * D1,
+            per_frame(sigmas[next_index]),
+            per_frame(sigmas[step_index]),
+            per_frame(h_phi_1),
+            per_frame(B_h),
+        ).to(sample.dtype)
+
+        # only the frames in the update mask move forward
+        mask = per_frame(update_mask)
+        prev_sample = torch.where(mask, prev_sample, sample)
+        history = [torch.where(mask, new, old[:, window]) for new, old in zip(history, self.frame_model_outputs)]
+        for buffer, value in zip(self.frame_model_outputs, history):
+            buffer[:, window] = value
+        # the per-frame loop writes each result back into the latent it passed as `sample`, so after a step without
+        # corrector the stored `last_sample` aliases the new sample; keep that behavior to reproduce its results
+        last_sample = torch.where(mask, torch.where(per_frame(use_corrector), corrected, prev_sample), last_sample)
+        self.frame_last_sample[:, window] = last_sample
+        self.frame_this_order[window] = torch.where(update_mask, this_order, last_order)
+        self.frame_lower_order_nums[window] = torch.where(
+            update_mask, (lower_order_nums + 1).clamp(max=self.config.solver_order), lower_order_nums
+        )
+        self.frame_has_last_sample[window] |= update_mask
+        self.frame_step_index[window] = torch.where(update_mask, step_index + 1, self.frame_step_index[window])
+
+        if not return_dict:
+            return (prev_sample,)
+
+        return SchedulerOutput(prev_sample=prev_sample)
@@ -0,0 +1,4 @@
+from .client import InferenceClient
+from .client import submit_cli_job
+from .inference_server import InferenceServer
+from .inference_server import JOB_DEFAULTS
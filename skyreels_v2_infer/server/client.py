@@ -0,0 +1,118 @@
+import http.client
+import json
+import os
+import socket
+import time
+from urllib.parse import urlparse
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix domain socket.
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class InferenceClient:
+    """
+    Client of the inference server, only depends on the standard library.
+
+    Args:
+        address (str): `http://host:port`, `host:port` or `unix:///path/to/socket`
+    """
+
+    def __init__(self, address, timeout=60):
+        self.address = address
+        self.timeout = timeout
+
+    def _connect(self):
+        if self.address.startswith("unix://"):
+            return UnixHTTPConnection(self.address[len("unix://") :], timeout=self.timeout)
+        url = urlparse(self.address if "://" in self.address else f"http://{self.address}")
+        return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=self.timeout)
+
+    def request(self, method, path, body=None):
+        conn = self._connect()
+        try:
+            headers = {}
+            if body is not None:
+                body = json.dumps(body)
+                headers["Content-Type"] = "application/json"
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = json.loads(response.read() or b"null")
+        finally:
+            conn.close()
+        if response.status >= 400:
+            message = data.get("error") if isinstance(data, dict) else data
+            raise RuntimeError(f"{method} {path} failed with {response.status}: {message}")
+        return data
+
+    def health(self):
+        return self.request("GET", "/health")
+
+    def submit(self, params):
+        """
+        Queues a generation job and returns its state, see `JOB_DEFAULTS` in `inference_server.py` for the parameters.
+        """
+        return self.request("POST", "/jobs", params)
+
+    def get(self, job_id):
+        return self.request("GET", f"/jobs/{job_id}")
+
+    def list(self):
+        return self.request("GET", "/jobs")
+
+    def cancel(self, job_id):
+        return self.request("POST", f"/jobs/{job_id}/cancel")
+
+    def wait(self, job_id, poll_interval=2.0, callback=None):
+        """
+        Polls a job until it is finished and returns its final state. `callback` is called with every state change.
+        """
+        last = None
+        while True:
+            job = self.get(job_id)
+            state = (job["status"], job["progress"])
+            if callback is not None and state != last:
+                callback(job)
+            last = state
+            if job["status"] in ("succeeded", "failed", "cancelled"):
+                return job
+            time.sleep(poll_interval)
+
+
+def submit_cli_job(address, args, job_keys):
+    """
+    Runs the job described by the parsed command line `args` on the server at `address` instead of in this process,
+    only the arguments in `job_keys` are forwarded. Returns the final state of the job.
+    """
+    params = {key: value for key, value in vars(args).items() if key in job_keys}
+    for key in ("image", "end_image", "video_path"):
+        if params.get(key):
+            params[key] = os.path.abspath(params[key])
+    client = InferenceClient(address)
+    job = client.submit(params)
+    print(f"submitted job {job['id']} to {address}")
+    try:
+        job = client.wait(
+            job["id"],
+            callback=lambda job: print(f"job {job['id']}: {job['status']}, step {job['progress']}", flush=True),
+        )
+    except KeyboardInterrupt:
+        client.cancel(job["id"])
+        job = client.wait(job["id"])
+    if job["status"] == "succeeded":
+        print(f"video saved to {job['output_path']}")
+    elif job["error"]:
+        print(f"job {job['id']} {job['status']}: {job['error']}")
+    return job
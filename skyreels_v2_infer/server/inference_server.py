@@ -0,0 +1,580 @@
+import gc
+import json
+import os
+import random
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import imageio
+import torch
+from diffusers.utils import load_image
+
+from ..modules import download_model
+from ..modules import get_cached_text_encoder
+from ..modules import get_vae
+from ..pipelines import DiffusionForcingPipeline
+from ..pipelines import Image2VideoPipeline
+from ..pipelines import Text2VideoPipeline
+from ..pipelines import StreamingVideoWriter
+from ..pipelines import resizecrop
+from .job_queue import BucketQueue
+
+T2V_NEGATIVE_PROMPT = "Bright tones, overexposed, static, blurred details, subtitles, style, works, paintings, images, static, overall gray, worst quality, low quality, JPEG compression residue, ugly, incomplete, extra fingers, poorly drawn hands, poorly drawn faces, deformed, disfigured, misshapen limbs, fused fingers, still picture, messy background, three legs, many people in the background, walking backwards"
+DF_NEGATIVE_PROMPT = "色调艳丽，过曝，静态，细节模糊不清，字幕，风格，作品，画作，画面，静止，整体发灰，最差质量，低质量，JPEG压缩残留，丑陋的，残缺的，多余的手指，画得不好的手部，画得不好的脸部，畸形的，毁容的，形态畸形的肢体，手指融合，静止不动的画面，杂乱的背景，三条腿，背景人很多，倒着走"
+
+# parameters of a generation job, they mirror the arguments of generate_video.py and generate_video_df.py
+JOB_DEFAULTS = {
+    "model_id": "Skywork/SkyReels-V2-T2V-14B-540P",
+    "prompt": "A serene lake surrounded by towering mountains, with a few swans gracefully gliding across the water and sunlight dancing on the surface.",
+    "negative_prompt": None,
+    "image": None,
+    "resolution": "540P",
+    "num_frames": 97,
+    "guidance_scale": 6.0,
+    "shift": 8.0,
+    "inference_steps": 30,
+    "fps": 24,
+    "seed": None,
+    "outdir": "video_out",
+    "teacache": False,
+    "teacache_thresh": 0.2,
+    "use_ret_steps": False,
+    "batched_cfg": False,
+    "variable_text_len": False,
+    # diffusion forcing only
+    "end_image": None,
+    "video_path": "",
+    "ar_step": 0,
+    "causal_attention": False,
+    "causal_block_size": 1,
+    "causal_kv_cache": False,
+    "token_subset": False,
+    "token_subset_blocks": 0,
+    "teacache_frame_blocks": False,
+    "base_num_frames": 97,
+    "overlap_history": None,
+    "addnoise_condition": 0,
+    "latent_overlap": False,
+    "stream_output": False,
+}
+JOB_TYPES = {key: type(value) for key, value in JOB_DEFAULTS.items() if value is not None}
+JOB_TYPES.update(seed=int, overlap_history=int, negative_prompt=str, image=str, end_image=str)
+
+FINISHED = ("succeeded", "failed", "cancelled")
+# parameters that may differ between the jobs of a batch, one video each
+PER_VIDEO_PARAMS = ("prompt", "negative_prompt", "image", "seed", "outdir")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def parse_job_params(params):
+    """
+    Validates the parameters of a job and fills in the defaults. Strings are converted to the expected types, so that
+    command line arguments can be forwarded as they are.
+    """
+    unknown = set(params) - set(JOB_DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown job parameters: {sorted(unknown)}")
+    job_params = dict(JOB_DEFAULTS)
+    for key, value in params.items():
+        if value is None or key not in JOB_TYPES:
+            job_params[key] = value
+        elif JOB_TYPES[key] is bool and isinstance(value, str):
+            job_params[key] = value.lower() in ("1", "true", "yes")
+        else:
+            job_params[key] = JOB_TYPES[key](value)
+    if job_params["resolution"] not in ("540P", "720P"):
+        raise ValueError(f"Invalid resolution: {job_params['resolution']}")
+    if job_params["causal_kv_cache"] and job_params["addnoise_condition"] > 0:
+        raise ValueError("causal_kv_cache is not supported with addnoise_condition")
+    return job_params
+
+
+class GenerationJob:
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex[:12]
+        self.params = params
+        self.status = "queued"
+        self.progress = 0
+        self.output_path = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.batch_size = None
+        # input image of an image-to-video job, loaded by the worker when the job is dispatched
+        self.image = None
+        self.cancel_event = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "progress": self.progress,
+            "output_path": self.output_path,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queue_delay": None if self.started_at is None else self.started_at - self.created_at,
+            "batch_size": self.batch_size,
+            "params": self.params,
+        }
+
+
+class InferenceServer:
+    """
+    Keeps the pipelines resident between generation jobs, which run one after another from a queue on a worker thread.
+    Queued jobs with the same model, video shape and step schedule are run together as one batch of up to
+    `max_batch_size` videos, see `get_batch_key`.
+
+    The T5 encoder and the VAE are loaded once and shared by all pipelines, the T5 encoder only when a prompt is not
+    in its embedding cache yet. Pipelines are created on their first job
+    and the least recently used one is dropped when more than `max_pipelines` would be resident.
+
+    Args:
+        device (str): Device to run on
+        offload (bool): Keep the transformers and the T5 encoder on the CPU between uses
+        block_offload (int): Stream the transformer blocks to the device with this many of them resident, implies
+            `offload`
+        max_pipelines (int): Number of pipelines kept resident
+        context_cache (bool): Enable the cross-attention context cache of the transformers
+        vae_tiling (bool): Run the shared VAE in spatial tiles
+        prompt_cache_dir (str): Directory where the prompt embeddings are cached across restarts
+        max_batch_size (int): Number of compatible jobs run together as one batch
+        max_wait (float): Seconds a job waits for compatible jobs to fill its batch before it runs with fewer
+    """
+
+    def __init__(
+        self,
+        device="cuda",
+        weight_dtype=torch.bfloat16,
+        offload=False,
+        block_offload=0,
+        max_pipelines=3,
+        context_cache=False,
+        vae_tiling=False,
+        prompt_cache_dir=None,
+        result_dir="result",
+        max_batch_size=1,
+        max_wait=0.0,
+    ):
+        self.device = device
+        self.weight_dtype = weight_dtype
+        self.offload = offload or block_offload > 0
+        self.block_offload = block_offload
+        self.max_pipelines = max_pipelines
+        self.context_cache = context_cache
+        self.vae_tiling = vae_tiling
+        self.prompt_cache_dir = prompt_cache_dir
+        self.result_dir = os.path.abspath(result_dir)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.text_encoder = None
+        self.vae = None
+        self.pipelines = OrderedDict()
+        # local directory of each model id, where calibrate_teacache.py writes its coefficients
+        self.model_paths = {}
+        self.jobs = OrderedDict()
+        self._queue = BucketQueue(lambda job: self.get_batch_key(job.params))
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run_worker, name="InferenceServerWorker", daemon=True)
+
+    def start(self):
+        self._worker.start()
+
+    def submit(self, params):
+        job = GenerationJob(parse_job_params(params))
+        with self._lock:
+            self.jobs[job.id] = job
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job, or stops a running one at its next transformer forward.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        with self._lock:
+            if job.status == "queued":
+                job.status = "cancelled"
+                job.finished_at = time.time()
+                self._queue.remove(job)
+            elif job.status == "running":
+                job.cancel_event.set()
+        return job
+
+    def queue_position(self, job):
+        if job.status != "queued":
+            return None
+        return self._queue.position(job, self.max_batch_size)
+
+    @staticmethod
+    def get_task(params):
+        if "DF" in params["model_id"]:
+            return "df"
+        return "i2v" if params["image"] else "t2v"
+
+    @staticmethod
+    def get_size(params, image=None):
+        """
+        Returns the height and width of the videos of a job, portrait when its input image is.
+        """
+        height, width = (544, 960) if params["resolution"] == "540P" else (720, 1280)
+        if image is not None and image.height > image.width:
+            height, width = width, height
+        return height, width
+
+    def get_batch_key(self, params):
+        """
+        Returns the key of the jobs that can run as one batch with this one: all parameters but the prompts, input
+        images, seeds and output directories are the same, and so are the video shape and the step schedule. Returns
+        None for the jobs that run alone, the diffusion forcing jobs with input images or videos, long videos or
+        streamed output.
+
+        The key is computed when a job is submitted, so it leaves out the orientation of the input images, which would
+        have to be loaded for it. `split_batch` splits the batches of image-to-video jobs by orientation.
+        """
+        task = self.get_task(params)
+        if task == "df" and (
+            params["image"]
+            or params["video_path"]
+            or params["stream_output"]
+            or (params["overlap_history"] is not None and params["num_frames"] > params["base_num_frames"])
+        ):
+            return None
+        shared = tuple((key, value) for key, value in sorted(params.items()) if key not in PER_VIDEO_PARAMS)
+        return (task,) + shared
+
+    def split_batch(self, jobs):
+        """
+        Loads the input images of a batch of image-to-video jobs and splits it into the batches of the jobs whose
+        images have the same orientation. A job whose image does not load runs alone and fails.
+        """
+        if self.get_task(jobs[0].params) != "i2v":
+            return [jobs]
+        batches = OrderedDict()
+        for job in jobs:
+            try:
+                job.image = load_image(job.params["image"])
+                key = self.get_size(job.params, job.image)
+            except Exception:
+                key = job.id
+            batches.setdefault(key, []).append(job)
+        return list(batches.values())
+
+    def get_pipeline(self, task, model_id, causal_block_size=None):
+        """
+        Returns the resident pipeline for `task` and `model_id`, loading it if needed.
+        """
+        key = (task, model_id, causal_block_size)
+        if key in self.pipelines:
+            self.pipelines.move_to_end(key)
+            return self.pipelines[key]
+
+        while len(self.pipelines) >= self.max_pipelines:
+            _, pipe = self.pipelines.popitem(last=False)
+            del pipe
+            gc.collect()
+            torch.cuda.empty_cache()
+
+        model_path = download_model(model_id)
+        self.model_paths[model_id] = model_path
+        if self.text_encoder is None:
+            load_device = "cpu" if self.offload else self.device
+            self.text_encoder = get_cached_text_encoder(
+                model_path, load_device, self.weight_dtype, cache_dir=self.prompt_cache_dir
+            )
+        if self.vae is None:
+            self.vae = get_vae(os.path.join(model_path, "Wan2.1_VAE.pth"), self.device, weight_dtype=torch.float32)
+            if self.vae_tiling:
+                self.vae.enable_tiling()
+        pipeline_class = {"t2v": Text2VideoPipeline, "i2v": Image2VideoPipeline, "df": DiffusionForcingPipeline}[task]
+        print(f"init {task} pipeline for {model_id}")
+        pipe = pipeline_class(
+            model_path,
+            model_path,
+            device=self.device,
+            weight_dtype=self.weight_dtype,
+            offload=self.offload,
+            text_encoder=self.text_encoder,
+            vae=self.vae,
+        )
+        if causal_block_size is not None:
+            pipe.transformer.set_ar_attention(causal_block_size)
+        if self.block_offload:
+            pipe.transformer.set_block_offload(self.device, self.block_offload)
+        if self.context_cache:
+            pipe.transformer.set_context_cache()
+        self.pipelines[key] = pipe
+        return pipe
+
+    def _run_worker(self):
+        while True:
+            batch = self._queue.get_batch(self.max_batch_size, self.max_wait)
+            with self._lock:
+                jobs = [job for job in batch if job.status == "queued"]
+                for job in jobs:
+                    job.status = "running"
+            if not jobs:
+                continue
+            for jobs in self.split_batch(jobs):
+                self._run_batch(jobs)
+
+    def _run_batch(self, jobs):
+        for job in jobs:
+            job.started_at = time.time()
+            job.batch_size = len(jobs)
+        try:
+            for job, output_path in zip(jobs, self.run_jobs(jobs)):
+                job.output_path = output_path
+                job.status = "cancelled" if job.cancel_event.is_set() else "succeeded"
+        except JobCancelled:
+            for job in jobs:
+                job.status = "cancelled"
+        except Exception as e:
+            traceback.print_exc()
+            for job in jobs:
+                job.status = "failed"
+                job.error = f"{type(e).__name__}: {e}"
+        finally:
+            for job in jobs:
+                job.finished_at = time.time()
+                job.image = None
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def run_jobs(self, jobs):
+        """
+        Runs a batch of jobs with the same `get_batch_key` in one pipeline call and returns their output paths, None
+        for the jobs cancelled meanwhile. The batch is cancelled once all of its jobs are.
+        """
+        params = jobs[0].params
+        task = self.get_task(params)
+        causal_block_size = params["causal_block_size"] if task == "df" and params["causal_attention"] else None
+        pipe = self.get_pipeline(task, params["model_id"], causal_block_size)
+
+        height, width = self.get_size(params)
+        for job in jobs:
+            if job.params["seed"] is None:
+                job.params["seed"] = random.randrange(4294967294)
+        seeds = [job.params["seed"] for job in jobs]
+        default_negative_prompt = DF_NEGATIVE_PROMPT if task == "df" else T2V_NEGATIVE_PROMPT
+        negative_prompts = [
+            default_negative_prompt if job.params["negative_prompt"] is None else job.params["negative_prompt"]
+            for job in jobs
+        ]
+
+        def per_video(values):
+            # a single job keeps the arguments of an unbatched call, which extend_video and long videos need
+            return values[0] if len(values) == 1 else values
+
+        if params["teacache"]:
+            pipe.transformer.initialize_teacache(
+                enable_teacache=True,
+                teacache_thresh=params["teacache_thresh"],
+                use_ret_steps=params["use_ret_steps"],
+                ckpt_dir=self.model_paths[params["model_id"]],
+                frame_block_size=(
+                    params["causal_block_size"] if task == "df" and params["teacache_frame_blocks"] else None
+                ),
+            )
+        else:
+            pipe.transformer.initialize_teacache(enable_teacache=False)
+        if task == "df":
+            pipe.transformer.set_causal_kv_cache(params["causal_kv_cache"] and causal_block_size is not None)
+            pipe.transformer.set_token_subset(
+                params["token_subset"] or params["token_subset_blocks"] > 0, params["token_subset_blocks"]
+            )
+
+        current_time = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
+        output_paths = []
+        for job in jobs:
+            save_dir = os.path.join(self.result_dir, job.params["outdir"])
+            os.makedirs(save_dir, exist_ok=True)
+            video_out_file = f"{job.params['prompt'][:100].replace('/','')}_{job.params['seed']}_{current_time}.mp4"
+            output_paths.append(os.path.join(save_dir, video_out_file))
+        output_path = output_paths[0]
+
+        kwargs = {
+            "prompt": per_video([job.params["prompt"] for job in jobs]),
+            "negative_prompt": per_video(negative_prompts),
+            "num_frames": params["num_frames"],
+            "num_inference_steps": params["inference_steps"],
+            "guidance_scale": params["guidance_scale"],
+            "shift": params["shift"],
+            "generator": per_video([torch.Generator(device=self.device).manual_seed(seed) for seed in seeds]),
+            "batched_cfg": params["batched_cfg"],
+            "variable_text_len": params["variable_text_len"],
+        }
+        video_writer = None
+        extend_video = False
+        if task == "df":
+            kwargs.update(
+                overlap_history=params["overlap_history"],
+                addnoise_condition=params["addnoise_condition"],
+                base_num_frames=params["base_num_frames"],
+                ar_step=params["ar_step"],
+                causal_block_size=params["causal_block_size"],
+                fps=params["fps"],
+                latent_overlap=params["latent_overlap"],
+            )
+            if params["video_path"] and os.path.exists(params["video_path"]):
+                from moviepy.editor import VideoFileClip
+
+                with VideoFileClip(params["video_path"]) as clip:
+                    v_width, v_height = clip.size
+                if v_height > v_width:
+                    height, width = width, height
+                kwargs["prefix_video_path"] = params["video_path"]
+                extend_video = True
+            elif params["image"]:
+                image = load_image(params["image"])
+                if image.height > image.width:
+                    height, width = width, height
+                kwargs["image"] = resizecrop(image, height, width).convert("RGB")
+                if params["end_image"]:
+                    kwargs["end_image"] = resizecrop(load_image(params["end_image"]), height, width).convert("RGB")
+            if params["stream_output"]:
+                video_writer = StreamingVideoWriter(output_path, fps=params["fps"], quality=8)
+                kwargs["video_writer"] = video_writer
+        elif task == "i2v":
+            images = [load_image(job.params["image"]) if job.image is None else job.image for job in jobs]
+            height, width = self.get_size(params, images[0])
+            kwargs["image"] = per_video([resizecrop(image, height, width).convert("RGB") for image in images])
+        kwargs.update(height=height, width=width)
+
+        def check_cancelled(module, args):
+            if all(job.cancel_event.is_set() for job in jobs):
+                raise JobCancelled()
+            for job in jobs:
+                job.progress += 1
+
+        hook = pipe.transformer.register_forward_pre_hook(check_cancelled)
+        try:
+            if extend_video:
+                video_frames = pipe.extend_video(**kwargs)
+            else:
+                with torch.cuda.amp.autocast(dtype=pipe.transformer.dtype), torch.no_grad():
+                    video_frames = pipe(**kwargs)
+        finally:
+            hook.remove()
+            if video_writer is not None:
+                video_writer.close()
+        if video_writer is not None:
+            return [output_path]
+        for i, job in enumerate(jobs):
+            if job.cancel_event.is_set():
+                output_paths[i] = None
+                continue
+            imageio.mimwrite(
+                output_paths[i], video_frames[i], fps=job.params["fps"], quality=8, output_params=["-loglevel", "error"]
+            )
+        return output_paths
+
+    def serve_forever(self, host="127.0.0.1", port=8000, unix_socket=None):
+        """
+        Serves the job API over HTTP, on a Unix domain socket if `unix_socket` is set:
+
+        - `POST /jobs` queues a job with the parameters of `JOB_DEFAULTS` as JSON body
+        - `GET /jobs` and `GET /jobs/<id>` return the state of the jobs
+        - `POST /jobs/<id>/cancel` or `DELETE /jobs/<id>` cancel a job
+        - `GET /health` returns the resident pipelines and the queue length
+        """
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            httpd = UnixHTTPServer(unix_socket, RequestHandler)
+        else:
+            httpd = ThreadingHTTPServer((host, port), RequestHandler)
+        httpd.inference_server = self
+        self.start()
+        print(f"serving on {unix_socket or f'http://{host}:{port}'}")
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+            if unix_socket is not None and os.path.exists(unix_socket):
+                os.remove(unix_socket)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = "SkyReelsInferenceServer"
+
+    def address_string(self):
+        # Unix domain socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job_response(self, job):
+        if job is None:
+            return self._send(404, {"error": "unknown job"})
+        body = job.to_dict()
+        body["queue_position"] = self.server.inference_server.queue_position(job)
+        self._send(200, body)
+
+    def do_GET(self):
+        server = self.server.inference_server
+        parts = self.path.strip("/").split("/")
+        if parts == ["health"]:
+            self._send(
+                200,
+                {
+                    "pipelines": [list(key) for key in server.pipelines],
+                    "queued": sum(job.status == "queued" for job in server.jobs.values()),
+                    "max_batch_size": server.max_batch_size,
+                },
+            )
+        elif parts == ["jobs"]:
+            self._send(200, [job.to_dict() for job in server.jobs.values()])
+        elif len(parts) == 2 and parts[0] == "jobs":
+            self._job_response(server.get(parts[1]))
+        else:
+            self._send(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        server = self.server.inference_server
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                params = json.loads(self.rfile.read(length) or b"{}")
+                job = server.submit(params)
+            except (ValueError, TypeError) as e:
+                return self._send(400, {"error": str(e)})
+            self._job_response(job)
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+            self._job_response(server.cancel(parts[1]))
+        else:
+            self._send(404, {"error": f"unknown path {self.path}"})
+
+    def do_DELETE(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "jobs":
+            self._job_response(self.server.inference_server.cancel(parts[1]))
+        else:
+            self._send(404, {"error": f"unknown path {self.path}"})
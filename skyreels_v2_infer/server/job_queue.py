@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class BucketQueue:
+    """
+    Queue of generation jobs grouped into buckets of jobs that can run as one batch, e.g. with the same model, latent
+    shape and step schedule. The worker takes a batch of one bucket at a time.
+
+    A bucket is dispatched once it holds `max_batch_size` jobs, or once its oldest job has waited `max_wait` seconds
+    for more compatible jobs. Among the buckets that are ready, the one with the oldest job goes first.
+
+    Args:
+        key_fn (Callable): Returns the bucket key of a job, jobs whose key is None are always run alone
+    """
+
+    def __init__(self, key_fn):
+        self.key_fn = key_fn
+        self._buckets = OrderedDict()
+        self._cond = threading.Condition()
+
+    def put(self, job):
+        key = self.key_fn(job)
+        with self._cond:
+            # unbatchable jobs get a bucket of their own
+            self._buckets.setdefault(("job", job.id) if key is None else ("batch", key), []).append(job)
+            self._cond.notify_all()
+
+    def remove(self, job):
+        """
+        Removes a queued job, e.g. a cancelled one, so that it does not take the place of another one in its batch.
+        """
+        with self._cond:
+            for key, jobs in self._buckets.items():
+                if job in jobs:
+                    jobs.remove(job)
+                    if not jobs:
+                        del self._buckets[key]
+                    return
+
+    def position(self, job, max_batch_size=1):
+        """
+        Returns the number of queued jobs that are dispatched before `job` if every bucket is ready by then, None if it
+        is not queued.
+        """
+        with self._cond:
+            buckets = [list(jobs) for jobs in self._buckets.values()]
+        ahead = 0
+        while buckets:
+            jobs = min(buckets, key=lambda jobs: jobs[0].created_at)
+            batch = jobs[:max_batch_size]
+            if job in batch:
+                return ahead
+            ahead += len(batch)
+            del jobs[:max_batch_size]
+            buckets = [jobs for jobs in buckets if jobs]
+        return None
+
+    def get_batch(self, max_batch_size=1, max_wait=0.0):
+        """
+        Blocks until a bucket is ready and returns up to `max_batch_size` of its jobs, oldest first.
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                ready, next_deadline = None, None
+                for key, jobs in self._buckets.items():
+                    deadline = jobs[0].created_at + max_wait
+                    if key[0] == "job" or len(jobs) >= max_batch_size or deadline <= now:
+                        if ready is None or jobs[0].created_at < self._buckets[ready][0].created_at:
+                            ready = key
+                    elif next_deadline is None or deadline < next_deadline:
+                        next_deadline = deadline
+                if ready is not None:
+                    jobs = self._buckets[ready]
+                    batch, self._buckets[ready] = jobs[:max_batch_size], jobs[max_batch_size:]
+                    if not self._buckets[ready]:
+                        del self._buckets[ready]
+                    return batch
+                self._cond.wait(None if next_deadline is None else next_deadline - now)
@@ -0,0 +1,101 @@
+import pytest
+import torch
+from torch import nn
+
+from skyreels_v2_infer.modules.block_offload import BlockOffloader
+from skyreels_v2_infer.modules.transformer import WanModel
+
+NUM_BLOCKS = 5
+
+
+def make_blocks():
+    torch.manual_seed(0)
+    blocks = nn.ModuleList(
+        nn.Sequential(nn.Linear(16, 16), nn.BatchNorm1d(16), nn.GELU(), nn.Linear(16, 16)) for _ in range(NUM_BLOCKS)
+    )
+    for block in blocks:
+        # non-trivial buffers, they are streamed like the parameters
+        block[1].running_mean.normal_()
+        block[1].running_var.uniform_(0.5, 2.0)
+    return blocks.eval()
+
+
+def run(blocks, x):
+    for block in blocks:
+        x = block(x)
+    return x
+
+
+def track_resident_blocks(blocks, offloader):
+    """
+    Records, while every block runs, the number of blocks whose weights are device slots instead of host tensors.
+    """
+    counts = []
+
+    def count(module, args):
+        slot_ptrs = {tensor.data_ptr() for slot in offloader.slots for tensor in slot}
+        resident = [any(p.data_ptr() in slot_ptrs for p in block.parameters()) for block in blocks]
+        assert resident[list(blocks).index(module)]
+        counts.append(sum(resident))
+
+    for block in blocks:
+        block.register_forward_pre_hook(count)
+    return counts
+
+
+@pytest.mark.parametrize("num_resident_blocks", [1, 2, 3])
+def test_offloaded_blocks_match_resident_blocks(num_resident_blocks):
+    x = torch.randn(4, 16)
+    blocks = make_blocks()
+    with torch.no_grad():
+        expected = run(blocks, x)
+        offloader = BlockOffloader(blocks, "cpu", num_resident_blocks)
+        counts = track_resident_blocks(blocks, offloader)
+        # a second forward runs on the slots prefetched at the end of the first one
+        for _ in range(2):
+            torch.testing.assert_close(run(blocks, x), expected, rtol=0, atol=0)
+    assert len(offloader.slots) == num_resident_blocks
+    assert len(counts) == 2 * NUM_BLOCKS and max(counts) <= num_resident_blocks
+
+
+def test_offloaded_blocks_run_out_of_order():
+    x = torch.randn(4, 16)
+    blocks = make_blocks()
+    with torch.no_grad():
+        expected = [block(x) for block in blocks]
+        BlockOffloader(blocks, "cpu", 2)
+        # e.g. a forward interrupted after its first blocks, followed by a new one
+        blocks[0](x)
+        for i in [3, 1, 4, 0, 2]:
+            torch.testing.assert_close(blocks[i](x), expected[i], rtol=0, atol=0)
+
+
+def test_wan_model_block_offload_keeps_weights():
+    torch.manual_seed(0)
+    model = WanModel(model_type="t2v", dim=64, ffn_dim=128, freq_dim=32, num_heads=4, num_layers=4)
+    state = {name: tensor.clone() for name, tensor in model.state_dict().items()}
+    model.set_block_offload("cpu", 2)
+    assert len(model.block_offloader.slots) == 2
+    model.to(torch.float64)
+    for name, tensor in model.state_dict().items():
+        # to() only converts the modules around the blocks, the blocks keep their host copies
+        assert tensor.dtype == (torch.float32 if name.startswith("blocks.") else torch.float64), name
+        torch.testing.assert_close(tensor.double(), state[name].double(), rtol=0, atol=0)
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available(), reason="WanModel.forward keeps its time embeddings in float32 with CUDA autocast"
+)
+def test_wan_model_block_offload_matches_resident_model():
+    torch.manual_seed(0)
+    model = WanModel(model_type="t2v", dim=64, ffn_dim=128, freq_dim=32, num_heads=4, num_layers=4, text_dim=32)
+    model = model.to("cuda", torch.bfloat16).eval()
+    x = torch.randn(1, 16, 2, 4, 4, device="cuda", dtype=torch.bfloat16)
+    t = torch.tensor([500.0], device="cuda")
+    context = torch.randn(1, 8, 32, device="cuda", dtype=torch.bfloat16)
+    with torch.no_grad(), torch.autocast("cuda", dtype=torch.bfloat16):
+        expected = model(x, t=t, context=context)
+        model.set_block_offload("cuda", 2)
+        counts = track_resident_blocks(model.blocks, model.block_offloader)
+        torch.testing.assert_close(model(x, t=t, context=context), expected, rtol=0, atol=0)
+    assert max(counts) <= 2
@@ -0,0 +1,226 @@
+import itertools
+import math
+
+import pytest
+import torch
+
+from skyreels_v2_infer.pipelines import DiffusionForcingPipeline
+from skyreels_v2_infer.scheduler.fm_solvers_unipc import FlowUniPCMultistepScheduler
+
+
+def reference_timestep_matrix(
+    num_frames,
+    step_template,
+    base_num_frames,
+    ar_step=5,
+    num_pre_ready=0,
+    casual_block_size=1,
+    shrink_interval_with_mask=False,
+):
+    """
+    The row-by-row `generate_timestep_matrix` that the closed form replaced.
+    """
+    step_matrix, step_index = [], []
+    update_mask, valid_interval = [], []
+    num_iterations = len(step_template) + 1
+    num_frames_block = num_frames // casual_block_size
+    base_num_frames_block = base_num_frames // casual_block_size
+    if base_num_frames_block < num_frames_block:
+        infer_step_num = len(step_template)
+        gen_block = base_num_frames_block
+        min_ar_step = infer_step_num / gen_block
+        assert ar_step >= min_ar_step, f"ar_step should be at least {math.ceil(min_ar_step)} in your setting"
+    step_template = torch.cat(
+        [
+            torch.tensor([999], dtype=torch.int64, device=step_template.device),
+            step_template.long(),
+            torch.tensor([0], dtype=torch.int64, device=step_template.device),
+        ]
+    )
+    pre_row = torch.zeros(num_frames_block, dtype=torch.long)
+    if num_pre_ready > 0:
+        pre_row[: num_pre_ready // casual_block_size] = num_iterations
+
+    while not torch.all(pre_row >= (num_iterations - 1)):
+        new_row = torch.zeros(num_frames_block, dtype=torch.long)
+        for i in range(num_frames_block):
+            if i == 0 or pre_row[i - 1] >= (num_iterations - 1):
+                new_row[i] = pre_row[i] + 1
+            else:
+                new_row[i] = new_row[i - 1] - ar_step
+        new_row = new_row.clamp(0, num_iterations)
+
+        update_mask.append((new_row != pre_row) & (new_row != num_iterations))
+        step_index.append(new_row)
+        step_matrix.append(step_template[new_row])
+        pre_row = new_row
+
+    terminal_flag = base_num_frames_block
+    if shrink_interval_with_mask:
+        idx_sequence = torch.arange(num_frames_block, dtype=torch.int64)
+        update_mask = update_mask[0]
+        update_mask_idx = idx_sequence[update_mask]
+        last_update_idx = update_mask_idx[-1].item()
+        terminal_flag = last_update_idx + 1
+    for curr_mask in update_mask:
+        if terminal_flag < num_frames_block and curr_mask[terminal_flag]:
+            terminal_flag += 1
+        valid_interval.append((max(terminal_flag - base_num_frames_block, 0), terminal_flag))
+
+    step_update_mask = torch.stack(update_mask, dim=0)
+    step_index = torch.stack(step_index, dim=0)
+    step_matrix = torch.stack(step_matrix, dim=0)
+
+    if casual_block_size > 1:
+        step_update_mask = step_update_mask.unsqueeze(-1).repeat(1, 1, casual_block_size).flatten(1).contiguous()
+        step_index = step_index.unsqueeze(-1).repeat(1, 1, casual_block_size).flatten(1).contiguous()
+        step_matrix = step_matrix.unsqueeze(-1).repeat(1, 1, casual_block_size).flatten(1).contiguous()
+        valid_interval = [(s * casual_block_size, e * casual_block_size) for s, e in valid_interval]
+
+    return step_matrix, step_index, step_update_mask, valid_interval
+
+
+@pytest.mark.parametrize("causal_block_size", [1, 2, 3])
+@pytest.mark.parametrize("num_inference_steps", [1, 4, 7])
+def test_timestep_matrix_matches_reference(causal_block_size, num_inference_steps):
+    pipe = DiffusionForcingPipeline.__new__(DiffusionForcingPipeline)
+    pipe._timestep_matrix_cache = {}
+    step_template = torch.linspace(1000, 0, num_inference_steps + 2)[1:-1]
+    num_blocks = range(1, 6)
+    for num_frames_block, base_num_frames_block, ar_step, num_pre_ready_block in itertools.product(
+        num_blocks, num_blocks, [0, 1, 2, 3, 5, 9], range(0, 6)
+    ):
+        if num_pre_ready_block >= num_frames_block:
+            # nothing left to generate
+            continue
+        num_frames = num_frames_block * causal_block_size
+        args = (
+            num_frames,
+            step_template,
+            base_num_frames_block * causal_block_size,
+            ar_step,
+            num_pre_ready_block * causal_block_size,
+            causal_block_size,
+        )
+        try:
+            expected = reference_timestep_matrix(*args)
+        except AssertionError:
+            with pytest.raises(AssertionError):
+                pipe.generate_timestep_matrix(*args)
+            continue
+        actual = pipe.generate_timestep_matrix(*args)
+        for expected_value, actual_value in zip(expected[:3], actual[:3]):
+            assert torch.equal(expected_value, actual_value), args
+        assert expected[3] == actual[3], args
+
+
+class FakeTextEncoder:
+    def to(self, *args, **kwargs):
+        return self
+
+    def encode(self, prompt, variable_len=False):
+        return torch.zeros(1 if isinstance(prompt, str) else len(prompt), 4, 8)
+
+
+class FakeTransformer:
+    dtype = torch.float32
+    num_frame_per_block = 1
+    enable_causal_kv_cache = False
+    enable_token_subset = False
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def clear_context_cache(self):
+        pass
+
+    def clear_causal_kv_cache(self):
+        pass
+
+    def new_teacache(self, num_steps):
+        return None
+
+    def __call__(self, x, t, context, **kwargs):
+        assert not torch.is_grad_enabled(), "the pipeline runs the transformer with autograd"
+        return torch.zeros_like(x)
+
+
+class FakeVAE:
+    """
+    Causal VAE stand-in that checks the chunked decoding protocol: a video starts with `first_chunk` and the causal
+    cache is only released by its `last_chunk`.
+    """
+
+    def __init__(self):
+        self.decoding = False
+        self.calls = []
+
+    def encode(self, video):
+        return torch.zeros(video.shape[0], 16, (video.shape[2] - 1) // 4 + 1, video.shape[3] // 8, video.shape[4] // 8)
+
+    def decode(self, z, first_chunk=True, last_chunk=True):
+        assert first_chunk != self.decoding, "a chunk is decoded without the causal cache of the previous one"
+        self.decoding = not last_chunk
+        self.calls.append((z.shape[2], first_chunk, last_chunk))
+        num_frames = 4 * z.shape[2] - (3 if first_chunk else 0)
+        return torch.zeros(z.shape[0], 3, num_frames, z.shape[3] * 8, z.shape[4] * 8)
+
+
+def fake_pipeline():
+    pipe = DiffusionForcingPipeline.__new__(DiffusionForcingPipeline)
+    pipe.transformer = FakeTransformer()
+    pipe.vae = FakeVAE()
+    pipe.text_encoder = FakeTextEncoder()
+    pipe.device = "cpu"
+    pipe.offload = False
+    pipe.scheduler = FlowUniPCMultistepScheduler()
+    pipe._timestep_matrix_cache = {}
+    pipe._kv_cache_interval_start = None
+    return pipe
+
+
+# 37 frames are 10 latent frames, two chunks of at most 8 latent frames with 5 of them overlapping
+LONG_VIDEO_KWARGS = dict(
+    height=16,
+    width=16,
+    num_frames=37,
+    num_inference_steps=2,
+    guidance_scale=1.0,
+    overlap_history=17,
+    base_num_frames=29,
+)
+
+
+@pytest.mark.parametrize(
+    "latent_overlap, expected_calls",
+    [(False, [(8, True, True), (7, True, True)]), (True, [(8, True, False), (2, False, True)])],
+)
+def test_long_video_decodes_two_chunks(latent_overlap, expected_calls):
+    pipe = fake_pipeline()
+    (video,) = pipe("prompt", latent_overlap=latent_overlap, **LONG_VIDEO_KWARGS)
+    assert video.shape == (37, 16, 16, 3)
+    assert pipe.vae.calls == expected_calls
+    assert not pipe.vae.decoding
+
+
+@pytest.mark.parametrize(
+    "latent_overlap, expected_calls",
+    [(False, [(8, True, True), (7, True, True)]), (True, [(8, True, False), (2, False, True)])],
+)
+def test_extend_video_decodes_two_chunks(latent_overlap, expected_calls):
+    pipe = fake_pipeline()
+    pipe.get_video_as_tensor = lambda video_path, width, height: torch.full((17, 3, height, width), 128.0)
+    (video,) = pipe.extend_video(
+        "prompt", prefix_video_path="prefix.mp4", latent_overlap=latent_overlap, **LONG_VIDEO_KWARGS
+    )
+    # the prefix video is returned along with the 20 new frames
+    assert video.shape == (17 + 20, 16, 16, 3)
+    assert pipe.vae.calls == expected_calls
+    assert not pipe.vae.decoding
+
+
+def test_causal_kv_cache_rejects_addnoise_condition():
+    pipe = fake_pipeline()
+    pipe.transformer.enable_causal_kv_cache = True
+    with pytest.raises(AssertionError, match="addnoise_condition"):
+        pipe("prompt", addnoise_condition=20, **LONG_VIDEO_KWARGS)
@@ -0,0 +1,87 @@
+import pytest
+import torch
+
+from skyreels_v2_infer.pipelines import DiffusionForcingPipeline
+from skyreels_v2_infer.scheduler.fm_solvers_unipc import FlowUniPCMultiFrameScheduler
+from skyreels_v2_infer.scheduler.fm_solvers_unipc import FlowUniPCMultistepScheduler
+
+NUM_INFERENCE_STEPS = 10
+SHIFT = 8.0
+
+
+def denoise(latents, model_outputs, schedule, vectorized):
+    """
+    Runs the rows of a diffusion forcing schedule on `latents` [C, F, H, W], with `model_outputs[i]` as the model
+    output of the valid interval of row i, either with the multi-frame scheduler or with one
+    `FlowUniPCMultistepScheduler` per frame like the pipeline did before.
+    """
+    step_matrix, step_update_mask, valid_interval = schedule
+    latents = latents.clone()
+    num_frames = latents.shape[1]
+    if vectorized:
+        scheduler = FlowUniPCMultiFrameScheduler(num_train_timesteps=1000, shift=1, use_dynamic_shifting=False)
+        scheduler.set_timesteps(NUM_INFERENCE_STEPS, device="cpu", shift=SHIFT, num_frames=num_frames)
+    else:
+        schedulers = []
+        for _ in range(num_frames):
+            scheduler = FlowUniPCMultistepScheduler(num_train_timesteps=1000, shift=1, use_dynamic_shifting=False)
+            scheduler.set_timesteps(NUM_INFERENCE_STEPS, device="cpu", shift=SHIFT)
+            schedulers.append(scheduler)
+    for timestep_i, update_mask_i, (start, end), model_output in zip(
+        step_matrix, step_update_mask, valid_interval, model_outputs
+    ):
+        if vectorized:
+            latents[:, start:end] = scheduler.step(
+                model_output,
+                timestep_i[start:end],
+                latents[:, start:end],
+                update_mask=update_mask_i[start:end],
+                frame_offset=start,
+                return_dict=False,
+            )[0]
+            continue
+        for idx in range(start, end):
+            if update_mask_i[idx].item():
+                latents[:, idx] = schedulers[idx].step(
+                    model_output[:, idx - start], timestep_i[idx], latents[:, idx], return_dict=False
+                )[0]
+    return latents
+
+
+@pytest.mark.parametrize(
+    "num_frames, base_num_frames, ar_step, num_pre_ready, causal_block_size",
+    [
+        (6, 6, 0, 0, 1),
+        (6, 6, 2, 0, 1),
+        (6, 6, 5, 2, 1),
+        (8, 8, 3, 0, 2),
+        (8, 8, 0, 4, 2),
+        (9, 3, 5, 0, 1),
+        (12, 6, 5, 2, 2),
+    ],
+)
+@pytest.mark.parametrize("dtype, atol", [(torch.float32, 1e-5), (torch.bfloat16, 0)])
+def test_multi_frame_scheduler_matches_per_frame_schedulers(
+    num_frames, base_num_frames, ar_step, num_pre_ready, causal_block_size, dtype, atol
+):
+    # both compute in the dtype of the samples and only differ by the float32 rhos of the corrector, which come from a
+    # closed form instead of a linear solve; rounded to bfloat16 they are the same, so the results are too
+    pipe = DiffusionForcingPipeline.__new__(DiffusionForcingPipeline)
+    pipe._timestep_matrix_cache = {}
+    scheduler = FlowUniPCMultistepScheduler(num_train_timesteps=1000, shift=1, use_dynamic_shifting=False)
+    scheduler.set_timesteps(NUM_INFERENCE_STEPS, device="cpu", shift=SHIFT)
+    step_matrix, _, step_update_mask, valid_interval = pipe.generate_timestep_matrix(
+        num_frames, scheduler.timesteps, base_num_frames, ar_step, num_pre_ready, causal_block_size
+    )
+
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn(4, num_frames, 3, 5, generator=generator).to(dtype)
+    model_outputs = [torch.randn(4, end - start, 3, 5, generator=generator).to(dtype) for start, end in valid_interval]
+    schedule = (step_matrix, step_update_mask, valid_interval)
+
+    expected = denoise(latents, model_outputs, schedule, vectorized=False)
+    actual = denoise(latents, model_outputs, schedule, vectorized=True)
+    assert actual.dtype == expected.dtype
+    torch.testing.assert_close(actual.float(), expected.float(), rtol=0, atol=atol)
+    # the prefix frames are never updated
+    assert torch.equal(actual[:, :num_pre_ready], latents[:, :num_pre_ready])
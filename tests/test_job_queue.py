@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+from skyreels_v2_infer.server import inference_server
+from skyreels_v2_infer.server import InferenceServer
+from skyreels_v2_infer.server import JOB_DEFAULTS
+from skyreels_v2_infer.server.job_queue import BucketQueue
+
+
+def make_job(job_id, key, created_at):
+    return SimpleNamespace(id=job_id, key=key, created_at=created_at)
+
+
+def test_position_follows_bucket_dispatch_order():
+    queue = BucketQueue(lambda job: job.key)
+    a1, b1, a2, c1, a3 = [
+        make_job(job_id, key, created_at)
+        for created_at, (job_id, key) in enumerate([("a1", "a"), ("b1", "b"), ("a2", "a"), ("c1", None), ("a3", "a")])
+    ]
+    for job in [a1, b1, a2, c1, a3]:
+        queue.put(job)
+    # a1 and a2 go as one batch before b1, c1 runs alone, a3 waits for the next batch of its bucket
+    assert [queue.position(job, max_batch_size=2) for job in [a1, a2, b1, c1, a3]] == [0, 0, 2, 3, 4]
+    assert [queue.position(job) for job in [a1, b1, a2, c1, a3]] == [0, 1, 2, 3, 4]
+    assert queue.get_batch(max_batch_size=2) == [a1, a2]
+    queue.remove(b1)
+    assert queue.position(b1, max_batch_size=2) is None
+    assert queue.position(a3, max_batch_size=2) == 1
+
+
+@pytest.fixture
+def images(monkeypatch):
+    sizes = {"portrait.png": (480, 832), "landscape.png": (832, 480)}
+
+    def load_image(path):
+        if path not in sizes:
+            raise FileNotFoundError(path)
+        width, height = sizes[path]
+        return SimpleNamespace(width=width, height=height)
+
+    monkeypatch.setattr(inference_server, "load_image", load_image)
+
+
+def test_i2v_batches_are_split_by_orientation(images):
+    server = InferenceServer(device="cpu")
+    jobs = [
+        inference_server.GenerationJob(
+            inference_server.parse_job_params({"model_id": "Skywork/SkyReels-V2-I2V-14B-540P", "image": image})
+        )
+        for image in ["portrait.png", "landscape.png", "missing.png", "portrait.png"]
+    ]
+    # the batch key does not load the images
+    assert len({server.get_batch_key(job.params) for job in jobs}) == 1
+    batches = server.split_batch(jobs)
+    assert batches == [[jobs[0], jobs[3]], [jobs[1]], [jobs[2]]]
+    assert jobs[0].image.height > jobs[0].image.width and jobs[2].image is None
+
+
+def test_t2v_batches_are_not_split():
+    server = InferenceServer(device="cpu")
+    jobs = [inference_server.GenerationJob(dict(JOB_DEFAULTS)) for _ in range(3)]
+    assert server.split_batch(jobs) == [jobs]
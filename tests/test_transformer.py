@@ -0,0 +1,50 @@
+import math
+
+import pytest
+import torch
+
+from skyreels_v2_infer.modules.transformer import BLOCK_MASK_CACHE_SIZE
+from skyreels_v2_infer.modules.transformer import WanModel
+
+
+def token_mask(block_mask, q_length, kv_length):
+    """
+    Returns the dense [Q, KV] mask that flex attention applies with `block_mask`: the full tiles, and the positions
+    of the partial tiles where its `mask_mod` holds.
+    """
+    num_q_blocks, num_kv_blocks = math.ceil(q_length / 128), math.ceil(kv_length / 128)
+    partial = torch.zeros(num_q_blocks, num_kv_blocks, dtype=torch.bool)
+    full = torch.zeros(num_q_blocks, num_kv_blocks, dtype=torch.bool)
+    for row in range(num_q_blocks):
+        partial[row, block_mask.kv_indices[0, 0, row, : block_mask.kv_num_blocks[0, 0, row]].long()] = True
+        full[row, block_mask.full_kv_indices[0, 0, row, : block_mask.full_kv_num_blocks[0, 0, row]].long()] = True
+    assert not (partial & full).any()
+    q_idx = torch.arange(num_q_blocks * 128)[:, None]
+    kv_idx = torch.arange(num_kv_blocks * 128)[None]
+    mask_mod = block_mask.mask_mod(0, 0, q_idx, kv_idx)
+    full = full.repeat_interleave(128, 0).repeat_interleave(128, 1)
+    partial = partial.repeat_interleave(128, 0).repeat_interleave(128, 1)
+    assert not (full & ~mask_mod).any()
+    return full | (partial & mask_mod), mask_mod
+
+
+@pytest.mark.parametrize("num_frames", [1, 3, 7])
+@pytest.mark.parametrize("frame_seqlen", [12, 60, 200])
+@pytest.mark.parametrize("num_frame_per_block", [1, 2, 3])
+def test_blockwise_causal_mask_matches_mask_mod(num_frames, frame_seqlen, num_frame_per_block):
+    for num_cached_frames in range(num_frames):
+        block_mask = WanModel._prepare_blockwise_causal_attn_mask(
+            "cpu", num_frames, frame_seqlen, num_frame_per_block, num_cached_frames
+        )
+        mask, mask_mod = token_mask(
+            block_mask, (num_frames - num_cached_frames) * frame_seqlen, num_frames * frame_seqlen
+        )
+        assert torch.equal(mask, mask_mod)
+
+
+def test_block_mask_cache_is_bounded():
+    model = WanModel(model_type="t2v", dim=64, ffn_dim=128, freq_dim=32, num_heads=4, num_layers=1)
+    for num_frames in range(1, BLOCK_MASK_CACHE_SIZE + 3):
+        model.get_block_mask(torch.tensor([num_frames, 2, 2]), "cpu")
+    assert len(model._block_mask_cache) == BLOCK_MASK_CACHE_SIZE
+    assert (BLOCK_MASK_CACHE_SIZE + 2, 2, 2, 1, 0, "cpu") in model._block_mask_cache
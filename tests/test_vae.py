@@ -0,0 +1,159 @@
+import pytest
+import torch
+from einops import rearrange
+
+from skyreels_v2_infer.modules import vae
+from skyreels_v2_infer.modules.vae import CACHE_T
+from skyreels_v2_infer.modules.vae import WanVAE_
+
+SCALE = [0.0, 1.0]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return (
+        WanVAE_(dim=8, z_dim=4, num_res_blocks=1, temperal_downsample=[False, True, True]).eval().requires_grad_(False)
+    )
+
+
+def cat_causal_conv(layer, x, feat_cache, feat_idx):
+    """
+    The causal cache as it was before the fixed buffers: the last CACHE_T input frames are concatenated into a new
+    tensor after every chunk, and the first chunk is zero-padded by the conv itself.
+    """
+    idx = feat_idx[0]
+    cache_x = x[:, :, -CACHE_T:].clone()
+    if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
+        cache_x = torch.cat([feat_cache[idx][:, :, -1:], cache_x], dim=2)
+    x = layer(x, feat_cache[idx])
+    feat_cache[idx] = cache_x
+    feat_idx[0] += 1
+    return x
+
+
+def cat_resample_forward(self, x, feat_cache=None, feat_idx=[0]):
+    """
+    `Resample.forward` as it was before the fixed buffers.
+    """
+    b, c, t, h, w = x.size()
+    if self.mode == "upsample3d" and feat_cache is not None:
+        idx = feat_idx[0]
+        if feat_cache[idx] is None:
+            feat_cache[idx] = "Rep"
+            feat_idx[0] += 1
+        else:
+            cache_x = x[:, :, -CACHE_T:].clone()
+            if feat_cache[idx] == "Rep":
+                if cache_x.shape[2] < 2:
+                    cache_x = torch.cat([torch.zeros_like(cache_x), cache_x], dim=2)
+                x = self.time_conv(x)
+            else:
+                if cache_x.shape[2] < 2:
+                    cache_x = torch.cat([feat_cache[idx][:, :, -1:], cache_x], dim=2)
+                x = self.time_conv(x, feat_cache[idx])
+            feat_cache[idx] = cache_x
+            feat_idx[0] += 1
+            x = x.reshape(b, 2, c, t, h, w)
+            x = torch.stack((x[:, 0], x[:, 1]), 3)
+            x = x.reshape(b, c, t * 2, h, w)
+    t = x.shape[2]
+    x = rearrange(x, "b c t h w -> (b t) c h w")
+    x = self.resample(x)
+    x = rearrange(x, "(b t) c h w -> b c t h w", t=t)
+    if self.mode == "downsample3d" and feat_cache is not None:
+        idx = feat_idx[0]
+        if feat_cache[idx] is None:
+            feat_cache[idx] = x.clone()
+        else:
+            cache_x = x[:, :, -1:].clone()
+            x = self.time_conv(torch.cat([feat_cache[idx][:, :, -1:], x], 2))
+            feat_cache[idx] = cache_x
+        feat_idx[0] += 1
+    return x
+
+
+@pytest.fixture
+def cat_cache(monkeypatch):
+    monkeypatch.setattr(vae, "causal_conv", cat_causal_conv)
+    monkeypatch.setattr(vae.Resample, "forward", cat_resample_forward)
+
+
+def reference_encode(model, x):
+    model.clear_cache()
+    for i in range(1 + (x.shape[2] - 1) // 4):
+        model._enc_conv_idx = [0]
+        chunk = x[:, :, :1] if i == 0 else x[:, :, 1 + 4 * (i - 1) : 1 + 4 * i]
+        out_ = model.encoder(chunk, feat_cache=model._enc_feat_map, feat_idx=model._enc_conv_idx)
+        out = out_ if i == 0 else torch.cat([out, out_], 2)
+    mu, _ = model.conv1(out).chunk(2, dim=1)
+    model.clear_cache()
+    return (mu - SCALE[0]) * SCALE[1]
+
+
+def reference_decode(model, z):
+    model.clear_cache()
+    x = model.conv2(z / SCALE[1] + SCALE[0])
+    for i in range(z.shape[2]):
+        model._conv_idx = [0]
+        out_ = model.decoder(x[:, :, i : i + 1], feat_cache=model._feat_map, feat_idx=model._conv_idx)
+        out = out_ if i == 0 else torch.cat([out, out_], 2)
+    model.clear_cache()
+    return out
+
+
+@pytest.mark.parametrize("num_frames", [1, 5, 13])
+def test_encode_matches_cat_cache(model, num_frames, request):
+    x = torch.randn(1, 3, num_frames, 32, 32)
+    mu = model.encode(x, SCALE)
+    request.getfixturevalue("cat_cache")
+    torch.testing.assert_close(mu, reference_encode(model, x), rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("chunks", [[1], [3], [1, 1, 2], [2, 2]])
+def test_decode_matches_cat_cache(model, chunks, request):
+    # the first chunk decodes its first latent frame from the zero-padded cache
+    z = torch.randn(1, 4, sum(chunks), 4, 4)
+    ends = torch.tensor(chunks).cumsum(0).tolist()
+    frames = [
+        model.decode(z[:, :, end - size : end], SCALE, first_chunk=end == size, last_chunk=end == ends[-1])
+        for size, end in zip(chunks, ends)
+    ]
+    request.getfixturevalue("cat_cache")
+    torch.testing.assert_close(torch.cat(frames, 2), reference_decode(model, z), rtol=0, atol=1e-5)
+
+
+def test_tiled_decode_keeps_a_cache_per_tile(model):
+    # 16 latent pixels in tiles of 8 overlapping by 4 are 3 x 3 tiles
+    z = torch.randn(1, 4, 4, 16, 16)
+    expected = model.tiled_decode(z, SCALE, 64, 32)
+    frames = []
+    for start, end in [(0, 1), (1, 3), (3, 4)]:
+        frames.append(model.tiled_decode(z[:, :, start:end], SCALE, 64, 32, start == 0, end == 4))
+        if end < 4:
+            feat_maps = list(model._tile_feat_maps.values())
+            assert len(feat_maps) == 9 and len({id(feat_map) for feat_map in feat_maps}) == 9
+    assert model._tile_feat_maps == {}
+    torch.testing.assert_close(torch.cat(frames, 2), expected, rtol=0, atol=1e-5)
+
+
+def test_single_tile_matches_untiled(model):
+    x = torch.randn(1, 3, 5, 64, 64)
+    torch.testing.assert_close(model.tiled_encode(x, SCALE, 64, 32), model.encode(x, SCALE), rtol=0, atol=1e-6)
+    z = torch.randn(1, 4, 2, 8, 8)
+    torch.testing.assert_close(model.tiled_decode(z, SCALE, 64, 32), model.decode(z, SCALE), rtol=0, atol=1e-6)
+
+
+def test_tiled_matches_untiled_within_tolerance(model):
+    # the receptive field of the VAE is wider than the tiles, so the seams differ from the untiled output; blending
+    # the overlaps keeps the difference within these bounds, measured on this random VAE
+    torch.manual_seed(0)
+    x = torch.randn(1, 3, 5, 128, 128)
+    z = torch.randn(1, 4, 2, 16, 16)
+    for tiled, untiled, max_bound, mean_bound in [
+        (lambda overlap: model.tiled_encode(x, SCALE, 64, overlap), model.encode(x, SCALE), 0.3, 0.04),
+        (lambda overlap: model.tiled_decode(z, SCALE, 64, overlap), model.decode(z, SCALE), 1.0, 0.08),
+    ]:
+        blended = (tiled(32) - untiled).abs()
+        assert blended.max() < max_bound and blended.mean() < mean_bound
+        assert blended.mean() < (tiled(0) - untiled).abs().mean()